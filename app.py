@@ -1,11 +1,6 @@
-from sewing_app.extensions import app, db
-from sewing_app.routes import main, auth
+from sewing_app import create_app
 
-app.register_blueprint(main)
-app.register_blueprint(auth)
-
-with app.app_context():
-    db.create_all()
+app = create_app()
 
 if __name__ == "__main__":
     app.run(debug=True)
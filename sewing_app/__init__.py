@@ -0,0 +1,82 @@
+"""Fabric and pattern tracker.
+
+create_app() returns the Flask app with its blueprints and CLI commands.
+Importing the package itself is cheap: the routes, forms and everything
+they pull in are only imported the first time create_app() is called, and
+nothing touches the database until a request or command needs it. The
+schema is changed by `flask upgrade-db` (see migrations.py), never on
+startup.
+
+Every call makes a new Flask app: the extensions (db, login_manager,
+bcrypt) and the modules with template or request hooks are bound to it
+with init_app(), and the rest of the code reads the config through
+current_app. Nothing sized or connected by the config is built at import:
+the caches are LazyCaches, made per app on first use, and the engine is
+only created when the database is first used.
+
+With WARM_UP on, create_app() also configures the mappers, loads the
+static file manifest and compiles every template, so under `gunicorn
+--preload` workers fork from a parent that has already paid for them. The
+parent never keeps a database connection open, so workers don't share one.
+It is off by default: it makes the boot slower and only pays off when the
+workers are forked from a preloaded parent.
+Compiled templates are also kept in an on-disk bytecode cache
+(TEMPLATE_BYTECODE_CACHE), so workers started without --preload and
+restarted processes load them instead of compiling them again.
+"""
+
+
+def _warm_up(app):
+    from sqlalchemy import orm
+
+    from sewing_app import assets, metrics
+    from sewing_app.extensions import db
+
+    orm.configure_mappers()
+    with app.app_context():
+        assets.manifest()
+        if app.config['METRICS_ENABLED']:
+            # Swaps the template class, so before compiling
+            metrics.install(app)
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+        # Builds the engine and its pool without connecting; anything that
+        # did connect is closed before the workers are forked
+        db.engine.dispose()
+
+
+def create_app(config=None):
+    """Return a new app, with `config` (a dict or an object with uppercase
+    attributes) applied on top of Config."""
+    from flask import Flask
+
+    from sewing_app import assets, fragments, metrics, thumbnails
+    from sewing_app.commands import maintenance
+    from sewing_app.config import Config
+    from sewing_app.extensions import bcrypt, db, login_manager
+    from sewing_app.routes import main, auth
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+
+    db.init_app(app)
+    login_manager.init_app(app)
+    bcrypt.init_app(app)
+    if app.config['TEMPLATE_BYTECODE_CACHE']:
+        from jinja2 import FileSystemBytecodeCache
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            app.config['TEMPLATE_BYTECODE_DIR'])
+    assets.init_app(app)
+    fragments.init_app(app)
+    thumbnails.init_app(app)
+    metrics.init_app(app)
+    app.register_blueprint(main)
+    app.register_blueprint(auth)
+    app.register_blueprint(maintenance)
+    if app.config['WARM_UP']:
+        _warm_up(app)
+    return app
@@ -0,0 +1,160 @@
+"""Admission control for the password hashing endpoints.
+
+Signing up and logging in spend nearly all their time in bcrypt, so a burst
+of failed logins or a credential-stuffing run can keep every worker busy
+hashing while catalog pages wait. Before a login or signup form is even
+validated, admit() charges the request to two token buckets, one for its
+client address and one for the username it names, and turns it away with
+a 429 and a Retry-After when either is empty. Separately, hashing_slot()
+caps the hash operations in flight in the process at ADMISSION_MAX_HASHING
+and rejects the rest at once instead of queueing them behind the pool.
+
+The buckets use GCRA: each key stores the time its bucket will be full
+again, one number per key. They live in a cache from make_cache(), so by
+default in process memory and with ADMISSION_STATE_URL set in redis,
+shared by every worker. Reads and writes of the shared state are not one
+atomic step, so concurrent requests can occasionally both take the last
+token; the buckets are a load shield, not an exact quota.
+
+The client address is request.remote_addr; behind a proxy, wrap the app
+in werkzeug's ProxyFix so it is the real client's. Requests turned away
+are counted per reason and reported by /metrics.
+"""
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from flask import current_app
+from werkzeug.exceptions import TooManyRequests
+
+from sewing_app.caching import LazyCache, make_cache
+
+# Reasons a request is turned away
+REASONS = ('ip', 'username', 'hashing', 'timeout')
+
+
+class Overloaded(TooManyRequests):
+    """A password request was turned away before hashing."""
+
+    def __init__(self, reason, retry_after):
+        super(Overloaded, self).__init__(
+            'Too many attempts. Please try again in a moment.',
+            retry_after=max(1, int(retry_after + 0.999)))
+        self.reason = reason
+
+
+def _make_buckets(app):
+    config = app.config
+    # A bucket untouched for this long is full again and can be forgotten
+    ttl = 60 * max(config['ADMISSION_IP_BURST'] /
+                   config['ADMISSION_IP_PER_MINUTE'],
+                   config['ADMISSION_USER_BURST'] /
+                   config['ADMISSION_USER_PER_MINUTE'])
+    return make_cache(config['ADMISSION_STATE_URL'], prefix='admission:',
+                      maxsize=config['ADMISSION_TRACKED_KEYS'], ttl=ttl)
+
+
+buckets = LazyCache(_make_buckets)
+_buckets_lock = Lock()
+
+_hashing = 0
+_hashing_lock = Lock()
+
+_counts = dict(admitted=0, **{reason: 0 for reason in REASONS})
+_counts_lock = Lock()
+
+
+def _count(name):
+    with _counts_lock:
+        _counts[name] += 1
+
+
+def shed(reason, retry_after):
+    """Count a request turned away for `reason` and return the Overloaded
+    to raise."""
+    _count(reason)
+    return Overloaded(reason, retry_after)
+
+
+def take(key, per_minute, burst, now=None):
+    """Take a token from the bucket `key` refilled with `per_minute`
+    tokens a minute and holding at most `burst`. Return 0 if one was
+    taken, else the seconds until there is one."""
+    now = time.time() if now is None else now
+    interval = 60.0 / per_minute
+    with _buckets_lock:
+        full_at = max(buckets.get(key) or now, now)
+        wait = full_at + interval - now - burst * interval
+        if wait > 0:
+            return wait
+        buckets.set(key, full_at + interval)
+    return 0
+
+
+def admit(username, address):
+    """Charge a login or signup attempt to its address and username,
+    raising Overloaded if either has run out of attempts."""
+    config = current_app.config
+    if not config['ADMISSION_ENABLED']:
+        return
+    wait = take('ip:%s' % address, config['ADMISSION_IP_PER_MINUTE'],
+                config['ADMISSION_IP_BURST'])
+    if wait:
+        raise shed('ip', wait)
+    if username:
+        wait = take('user:%s' % username.strip().lower()[:50],
+                    config['ADMISSION_USER_PER_MINUTE'],
+                    config['ADMISSION_USER_BURST'])
+        if wait:
+            raise shed('username', wait)
+    _count('admitted')
+
+
+@contextmanager
+def hashing_slot():
+    """Hold one of the ADMISSION_MAX_HASHING hashing slots of the
+    process, raising Overloaded if they are all taken."""
+    global _hashing
+    limit = current_app.config['ADMISSION_MAX_HASHING']
+    if not current_app.config['ADMISSION_ENABLED'] or not limit:
+        yield
+        return
+    with _hashing_lock:
+        if _hashing >= limit:
+            raise shed('hashing', 1)
+        _hashing += 1
+    try:
+        yield
+    finally:
+        with _hashing_lock:
+            _hashing -= 1
+
+
+def stats():
+    """Return the numbers of requests admitted and turned away, per
+    reason."""
+    with _counts_lock:
+        return dict(_counts, hashing_in_flight=_hashing)
+
+
+def render():
+    """Return the counters in the Prometheus text format."""
+    counts = stats()
+    lines = [
+        '# HELP sewing_auth_admitted_total Password requests let through.',
+        '# TYPE sewing_auth_admitted_total counter',
+        'sewing_auth_admitted_total %d' % counts['admitted'],
+        '# HELP sewing_auth_shed_total Password requests turned away.',
+        '# TYPE sewing_auth_shed_total counter',
+    ]
+    lines.extend('sewing_auth_shed_total{reason="%s"} %d'
+                 % (reason, counts[reason]) for reason in REASONS)
+    return ''.join(line + '\n' for line in lines)
+
+
+def reset():
+    """Forget every bucket and zero the counters (used by tests)."""
+    buckets.clear()
+    with _counts_lock:
+        for name in _counts:
+            _counts[name] = 0
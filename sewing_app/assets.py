@@ -0,0 +1,226 @@
+"""Fingerprinted, precompressed static files.
+
+`flask build-assets` copies every file under static/ (except the
+thumbnails) into ASSETS_DIR with a hash of its content in the name, e.g.
+style.3f2a9c1b0d4e.css, writes .gz and, when the brotli package is
+installed, .br variants of the text files next to it, and records the
+names in manifest.json. url() references between the files, like a
+stylesheet's fonts, are rewritten to the fingerprinted names.
+
+Templates link to asset_url('style.css'). Since a fingerprinted name
+never changes its content, /assets/ serves it with an immutable, far
+future Cache-Control, and with the precompressed variant the browser
+accepts, so nothing is compressed per request. Without a manifest, e.g.
+in development, asset_url() falls back to the plain /static/ URL.
+
+Files of earlier builds are left in place, so pages rendered before a
+deploy can still load theirs.
+
+With SELF_HOST_FONTS on, pages load the Manrope font from static/fonts/
+(downloaded by `flask build-assets --fetch-fonts`) instead of Google
+Fonts, saving the connections to two more hosts on the first visit.
+"""
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import urllib.request
+from threading import Lock
+from urllib.parse import urljoin
+
+from flask import current_app, safe_join, url_for
+
+
+MANIFEST = 'manifest.json'
+COMPRESSIBLE = ('.css', '.js', '.json', '.map', '.svg', '.txt', '.ttf',
+                '.otf', '.ico')
+# Preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+# Variants that save less than this are not worth a second file
+MIN_SAVING = 0.1
+
+FONT_CSS_URL = ('https://fonts.googleapis.com/css2'
+                '?family=Manrope:wght@200..800&display=swap')
+FONT_DIR = 'fonts'
+FONT_CSS = 'fonts/manrope.css'
+# Google Fonts picks the font format by browser; ask for woff2
+FONT_USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+                   'AppleWebKit/537.36 (KHTML, like Gecko) '
+                   'Chrome/120.0 Safari/537.36')
+
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+# Key of the loaded manifest in app.extensions
+MANIFEST_KEY = 'sewing_asset_manifest'
+_manifest_lock = Lock()
+
+
+def _compress(data, encoding):
+    if encoding == 'gzip':
+        # mtime=0 so a rebuild of the same file gives the same bytes
+        return gzip.compress(data, 9, mtime=0)
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli.compress(data, quality=11)
+
+
+def _source_files(static_dir):
+    """Yield the paths under `static_dir`, relative and with slashes."""
+    skip = {os.path.realpath(current_app.config['ASSETS_DIR']),
+            os.path.realpath(current_app.config['THUMBNAIL_DIR'])}
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.') and
+                         os.path.realpath(os.path.join(root, name)) not in skip)
+        for name in sorted(files):
+            if not name.startswith('.'):
+                path = os.path.relpath(os.path.join(root, name), static_dir)
+                yield path.replace(os.sep, '/')
+
+
+def _rewrite_urls(path, css, manifest):
+    """Point the relative url()s of the stylesheet `path` at the
+    fingerprinted files."""
+    base = posixpath.dirname(path)
+
+    def replace(match):
+        target = match.group(2).strip()
+        if re.match(r'^([a-z]+:|/|#)', target, re.I):
+            return match.group(0)
+        clean = target.split('#')[0].split('?')[0]
+        entry = manifest.get(posixpath.normpath(posixpath.join(base, clean)))
+        if entry is None:
+            return match.group(0)
+        return 'url(%s)' % posixpath.relpath(entry['path'], base or '.')
+
+    return CSS_URL.sub(replace, css)
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def build(static_dir=None):
+    """Fingerprint and compress the static files into ASSETS_DIR and
+    return the new manifest."""
+    static_dir = static_dir or current_app.static_folder
+    out_dir = current_app.config['ASSETS_DIR']
+    manifest = {}
+    # Stylesheets last, so the files they refer to are already named
+    paths = sorted(_source_files(static_dir),
+                   key=lambda path: (path.endswith('.css'), path))
+    for path in paths:
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            data = f.read()
+        if path.endswith('.css'):
+            data = _rewrite_urls(path, data.decode('utf-8'),
+                                 manifest).encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        stem, ext = posixpath.splitext(path)
+        name = '%s.%s%s' % (stem, digest, ext)
+        target = os.path.join(out_dir, name)
+        _write(target, data)
+        encodings = []
+        if ext.lower() in COMPRESSIBLE:
+            for encoding, suffix in ENCODINGS:
+                compressed = _compress(data, encoding)
+                if compressed is not None and \
+                        len(compressed) <= len(data) * (1 - MIN_SAVING):
+                    _write(target + suffix, compressed)
+                    encodings.append(encoding)
+        manifest[path] = dict(path=name, encodings=encodings)
+
+    _write(os.path.join(out_dir, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    with _manifest_lock:
+        current_app.extensions[MANIFEST_KEY] = manifest
+    return manifest
+
+
+def fetch_fonts(css_url=FONT_CSS_URL, static_dir=None):
+    """Download the Manrope stylesheet and its font files into
+    static/fonts/, for SELF_HOST_FONTS. Return the number of files."""
+    static_dir = static_dir or current_app.static_folder
+
+    def get(url):
+        request = urllib.request.Request(
+            url, headers={'User-Agent': FONT_USER_AGENT})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.read()
+
+    css = get(css_url).decode('utf-8')
+    fonts = {}
+
+    def replace(match):
+        url = urljoin(css_url, match.group(2))
+        if url not in fonts:
+            ext = posixpath.splitext(url.split('?')[0])[1] or '.woff2'
+            fonts[url] = 'manrope-%d%s' % (len(fonts) + 1, ext)
+        return 'url(%s)' % fonts[url]
+
+    css = CSS_URL.sub(replace, css)
+    for url, name in fonts.items():
+        _write(os.path.join(static_dir, FONT_DIR, name), get(url))
+    _write(os.path.join(static_dir, *FONT_CSS.split('/')), css.encode('utf-8'))
+    return len(fonts) + 1
+
+
+###########################
+# Serving
+###########################
+
+def manifest():
+    """Return the manifest of the app's last build ({} if there is
+    none)."""
+    with _manifest_lock:
+        loaded = current_app.extensions.get(MANIFEST_KEY)
+        if loaded is None:
+            try:
+                with open(os.path.join(current_app.config['ASSETS_DIR'],
+                                       MANIFEST)) as f:
+                    loaded = json.load(f)
+            except FileNotFoundError:
+                loaded = {}
+            current_app.extensions[MANIFEST_KEY] = loaded
+        return loaded
+
+
+def asset_url(path):
+    """Template global: the URL of the static file `path`, fingerprinted
+    when it has been built."""
+    entry = manifest().get(path)
+    if entry is None:
+        return url_for('static', filename=path)
+    return url_for('main.asset', filename=entry['path'])
+
+
+def init_app(app):
+    app.add_template_global(asset_url)
+
+
+def negotiate(filename, accept_encodings):
+    """Return the path of the built file `filename` to send, in the best
+    encoding of the request's `accept_encodings`, and that encoding (None
+    for the file itself). The path is None for unknown files."""
+    # Raises NotFound for paths outside ASSETS_DIR
+    path = safe_join(current_app.config['ASSETS_DIR'], filename)
+    if filename == MANIFEST or \
+            filename.endswith(tuple(suffix for _, suffix in ENCODINGS)) or \
+            not os.path.isfile(path):
+        return None, None
+    for encoding, suffix in ENCODINGS:
+        if accept_encodings[encoding] and os.path.isfile(path + suffix):
+            return path + suffix, encoding
+    return path, None
+
+
+def reset():
+    """Forget the loaded manifest (used by tests)."""
+    with _manifest_lock:
+        current_app.extensions.pop(MANIFEST_KEY, None)
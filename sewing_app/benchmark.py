@@ -0,0 +1,434 @@
+"""Benchmarks of the real routes against seeded synthetic data.
+
+generate() fills a scratch database with users, fabrics and patterns, with
+skewed tag and list densities: a few popular fabrics are tagged and stashed
+far more often than the rest. run_benchmark() then drives the routes
+through app.test_client() and reports, per endpoint and data size, latency
+percentiles, SQL statements per request and peak Python memory
+(tracemalloc). Results are plain dicts that can be saved as JSON and
+checked against a saved baseline with compare().
+
+Run it with `flask benchmark`. It never touches the configured database:
+every size gets a fresh temporary SQLite file, or the scratch --database.
+
+cold_start() (`flask cold-start`) times how long a fresh interpreter takes
+to import the app and to serve its first request, i.e. what each worker
+pays at boot without gunicorn --preload, with and without WARM_UP.
+"""
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+from sewing_app import cooccurrence, fragments, ledger, matcher, summaries
+from sewing_app.extensions import db, user_cache
+from sewing_app.hashing import hash_password
+from sewing_app.models import Fabric, Pattern, PatternCategory, User, \
+    fabrics_list, fabrics_patterns, patterns_list, recount_tags
+from sewing_app.search import rebuild_index
+
+SIZES = {
+    'small': dict(users=20, fabrics=1000, patterns=400),
+    'medium': dict(users=200, fabrics=10000, patterns=4000),
+    'large': dict(users=1000, fabrics=50000, patterns=20000),
+}
+
+COLORS = ('red', 'orange', 'yellow', 'green', 'blue', 'navy', 'purple',
+          'pink', 'white', 'black', 'gray', 'brown', 'cream', 'teal')
+MATERIALS = ('canvas', 'linen', 'cotton', 'denim', 'twill', 'jersey',
+             'flannel', 'voile', 'corduroy', 'velvet', 'poplin', 'chambray')
+GARMENTS = ('shirt', 'jumpsuit', 'trousers', 'tote', 'dress', 'jacket',
+            'skirt', 'shorts', 'apron', 'hoodie', 'blouse', 'scarf')
+CATEGORIES = list(PatternCategory)
+
+# Probability of tagging a pattern with 0, 1, 2... fabrics
+TAG_WEIGHTS = (10, 25, 25, 20, 10, 6, 4)
+# Fabrics and patterns on each user's lists
+STASH_SIZE = (5, 60)
+SAVED_PATTERNS = (2, 25)
+
+PASSWORD = 'password'
+BATCH_SIZE = 1000
+
+# Config used while benchmarking: no CSRF, cheap hashes, no background work
+CONFIG = dict(WTF_CSRF_ENABLED=False, BCRYPT_LOG_ROUNDS=4, BCRYPT_POOL_SIZE=0,
+              THUMBNAIL_WORKERS=0, METRICS_ENABLED=False, ADMISSION_ENABLED=False,
+              TESTING=True)
+
+
+def _popular(rng, n):
+    """Return an id in 1..n, skewed towards the low (popular) ones."""
+    return int(n * rng.random() ** 2) + 1
+
+
+def _distinct(rng, n, count):
+    count = min(count, n)
+    chosen = set()
+    while len(chosen) < count:
+        chosen.add(_popular(rng, n))
+    return sorted(chosen)
+
+
+def _insert(table, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(table.insert(), rows[start:start + BATCH_SIZE])
+
+
+def generate(users, fabrics, patterns, seed=1):
+    """Fill the (empty) database with synthetic rows and return row counts.
+
+    The same arguments always generate the same rows. Every user's password
+    is PASSWORD and their usernames are bench1, bench2...
+    """
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    password = hash_password(PASSWORD)
+
+    _insert(User.__table__, [
+        dict(id=i, username='bench%d' % i, password=password, updated_at=now)
+        for i in range(1, users + 1)])
+    _insert(Fabric.__table__, [
+        dict(id=i, name='%s %s %d' % (rng.choice(COLORS),
+                                      rng.choice(MATERIALS), i),
+             color=rng.choice(COLORS),
+             quantity=round(rng.uniform(0.25, 10), 2),
+             photo_url='https://example.com/fabrics/%d.jpg' % i,
+             created_by_id=rng.randint(1, users), pattern_count=0,
+             updated_at=now)
+        for i in range(1, fabrics + 1)])
+    _insert(Pattern.__table__, [
+        dict(id=i, name='%s %s %d' % (rng.choice(MATERIALS),
+                                      rng.choice(GARMENTS), i),
+             category=rng.choice(CATEGORIES),
+             photo_url='https://example.com/patterns/%d.jpg' % i,
+             created_by_id=rng.randint(1, users), fabric_count=0,
+             updated_at=now)
+        for i in range(1, patterns + 1)])
+
+    tags = [dict(fabric_id=fabric_id, pattern_id=pattern_id)
+            for pattern_id in range(1, patterns + 1)
+            for fabric_id in _distinct(rng, fabrics, rng.choices(
+                range(len(TAG_WEIGHTS)), TAG_WEIGHTS)[0])]
+    stashes = [dict(user_id=user_id, fabric_id=fabric_id)
+               for user_id in range(1, users + 1)
+               for fabric_id in _distinct(rng, fabrics,
+                                          rng.randint(*STASH_SIZE))]
+    saved = [dict(user_id=user_id, pattern_id=pattern_id)
+             for user_id in range(1, users + 1)
+             for pattern_id in _distinct(rng, patterns,
+                                         rng.randint(*SAVED_PATTERNS))]
+    _insert(fabrics_patterns, tags)
+    _insert(fabrics_list, stashes)
+    _insert(patterns_list, saved)
+
+    recount_tags()
+    rebuild_index()
+    summaries.rebuild()
+    cooccurrence.rebuild()
+    ledger.open_balances()
+    ledger.take_snapshots(lag=0)
+    db.session.commit()
+    return dict(users=users, fabrics=fabrics, patterns=patterns,
+                fabrics_patterns=len(tags), fabrics_list=len(stashes),
+                patterns_list=len(saved))
+
+
+###########################
+# Scenarios
+###########################
+
+# name -> (logged in, method, URL made from (rng, row counts))
+SCENARIOS = {
+    'homepage': (False, 'GET', lambda rng, rows: '/'),
+    'homepage_page': (False, 'GET', lambda rng, rows: '/?after=%d' % (
+        rng.randint(1, rows['fabrics']))),
+    'patterns': (False, 'GET', lambda rng, rows: '/patterns'),
+    'fabric_detail': (True, 'GET', lambda rng, rows: '/fabric/%d' % (
+        _popular(rng, rows['fabrics']))),
+    'pattern_detail': (True, 'GET', lambda rng, rows: '/pattern/%d' % (
+        _popular(rng, rows['patterns']))),
+    'search': (False, 'GET', lambda rng, rows: '/search?q=%s+%s' % (
+        rng.choice(COLORS), rng.choice(MATERIALS))),
+    'api_fabrics': (False, 'GET', lambda rng, rows: '/api/fabrics?q=%s' % (
+        rng.choice(COLORS)[:3])),
+    'fabrics_list': (True, 'GET', lambda rng, rows: '/fabrics_list'),
+    'patterns_list': (True, 'GET', lambda rng, rows: '/patterns_list'),
+    'add_to_fabrics_list': (True, 'POST', lambda rng, rows:
+                            '/add_to_fabrics_list/%d' % (
+                                rng.randint(1, rows['fabrics']))),
+    'api_matches': (True, 'GET', lambda rng, rows: '/api/matches'),
+    'dashboard': (True, 'GET', lambda rng, rows: '/dashboard'),
+    'login': (False, 'POST', lambda rng, rows: '/login'),
+}
+
+WARMUP_REQUESTS = 3
+MEMORY_REQUESTS = 5
+
+
+class QueryCounter(object):
+    """Counts the SQL statements of every engine while installed."""
+
+    def __init__(self):
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(Engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(Engine, 'before_cursor_execute', self._count)
+
+
+def _request(client, method, url):
+    if method == 'POST' and url == '/login':
+        response = client.post(url, data=dict(username='bench1',
+                                              password=PASSWORD))
+    elif method == 'POST':
+        response = client.post(url)
+    else:
+        response = client.get(url)
+    response.get_data()
+    response.close()
+    return response.status_code
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of `values`."""
+    values = sorted(values)
+    rank = max(math.ceil(fraction * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def run_scenario(client, method, make_url, rows, requests, rng):
+    """Return the latency, query and memory figures of one endpoint."""
+    for _ in range(WARMUP_REQUESTS):
+        _request(client, method, make_url(rng, rows))
+
+    latencies, queries, errors = [], [], 0
+    with QueryCounter() as counter:
+        for _ in range(requests):
+            url = make_url(rng, rows)
+            counter.count = 0
+            start = time.perf_counter()
+            status = _request(client, method, url)
+            latencies.append(time.perf_counter() - start)
+            queries.append(counter.count)
+            errors += status >= 400
+
+    tracemalloc.start()
+    try:
+        for _ in range(MEMORY_REQUESTS):
+            _request(client, method, make_url(rng, rows))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return dict(
+        requests=requests,
+        errors=errors,
+        p50_ms=round(percentile(latencies, 0.5) * 1000, 3),
+        p90_ms=round(percentile(latencies, 0.9) * 1000, 3),
+        p99_ms=round(percentile(latencies, 0.99) * 1000, 3),
+        mean_ms=round(sum(latencies) / len(latencies) * 1000, 3),
+        queries=percentile(queries, 0.5),
+        max_queries=max(queries),
+        peak_kib=round(peak / 1024, 1),
+    )
+
+
+###########################
+# Running
+###########################
+
+@contextmanager
+def _config(**values):
+    saved = {key: current_app.config.get(key) for key in values}
+    current_app.config.update(values)
+    try:
+        yield
+    finally:
+        current_app.config.update(saved)
+
+
+@contextmanager
+def scratch_database(url=None):
+    """Point the app at an empty database for the duration of the block.
+
+    Without `url` a temporary SQLite file is used. A `url` is wiped.
+    """
+    if url is not None and url == current_app.config['SQLALCHEMY_DATABASE_URI']:
+        raise ValueError('Refusing to benchmark the configured database')
+    directory = None
+    if url is None:
+        directory = tempfile.mkdtemp(prefix='sewing-benchmark-')
+        url = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+
+    db.session.remove()
+    with _config(SQLALCHEMY_DATABASE_URI=url, SQLALCHEMY_BINDS=None):
+        try:
+            db.drop_all()
+            db.create_all()
+            user_cache.clear()
+            fragments.reset()
+            matcher.reset()
+            yield
+        finally:
+            db.session.remove()
+            db.drop_all()
+            db.get_engine().dispose()
+    db.session.remove()
+    user_cache.clear()
+    fragments.reset()
+    matcher.reset()
+    if directory is not None:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_benchmark(sizes=('small',), requests=50, seed=1, database=None,
+                  scenarios=None):
+    """Benchmark every scenario at each data size and return the results.
+
+    `sizes` are names in SIZES or dicts of users/fabrics/patterns counts.
+    """
+    results = dict(meta=dict(
+        seed=seed, requests=requests,
+        python=platform.python_version(),
+        created_at=datetime.utcnow().isoformat(timespec='seconds'),
+    ), sizes={})
+    scenarios = scenarios or list(SCENARIOS)
+
+    with _config(**CONFIG):
+        for size in sizes:
+            params = SIZES[size] if isinstance(size, str) else size
+            name = size if isinstance(size, str) else \
+                '%(users)du-%(fabrics)df-%(patterns)dp' % params
+            with scratch_database(database):
+                results['meta']['database'] = db.engine.dialect.name
+                rows = generate(seed=seed, **params)
+                rng = random.Random(seed)
+                anonymous, member = (current_app.test_client(),
+                                     current_app.test_client())
+                _request(member, 'POST', '/login')
+
+                endpoints = {}
+                for scenario in scenarios:
+                    logged_in, method, make_url = SCENARIOS[scenario]
+                    client = member if logged_in else anonymous
+                    endpoints[scenario] = run_scenario(
+                        client, method, make_url, rows, requests, rng)
+                results['sizes'][name] = dict(rows=rows, endpoints=endpoints)
+    return results
+
+
+def compare(baseline, results, tolerance=0.25):
+    """Return the regressions of `results` against `baseline`.
+
+    An endpoint regresses when its median latency grows by more than
+    `tolerance` or it issues more queries.
+    """
+    regressions = []
+    for size, current in sorted(results['sizes'].items()):
+        previous = baseline.get('sizes', {}).get(size)
+        if previous is None:
+            continue
+        for endpoint, now in sorted(current['endpoints'].items()):
+            before = previous['endpoints'].get(endpoint)
+            if before is None:
+                continue
+            if now['p50_ms'] > before['p50_ms'] * (1 + tolerance):
+                regressions.append('%s %s: p50 %.1f ms -> %.1f ms' % (
+                    size, endpoint, before['p50_ms'], now['p50_ms']))
+            if now['queries'] > before['queries']:
+                regressions.append('%s %s: %d -> %d queries' % (
+                    size, endpoint, before['queries'], now['queries']))
+    return regressions
+
+
+def format_report(results):
+    """Return the results as lines of a table."""
+    header = '%-20s %9s %9s %9s %8s %10s %6s' % (
+        'endpoint', 'p50 ms', 'p90 ms', 'p99 ms', 'queries', 'peak KiB',
+        'errors')
+    lines = []
+    for size, result in results['sizes'].items():
+        lines.append('%s: %s' % (size, ', '.join(
+            '%d %s' % (count, table) for table, count in result['rows'].items())))
+        lines.append(header)
+        for endpoint, figures in result['endpoints'].items():
+            lines.append('%-20s %9.2f %9.2f %9.2f %8d %10.1f %6d' % (
+                endpoint, figures['p50_ms'], figures['p90_ms'],
+                figures['p99_ms'], figures['queries'], figures['peak_kib'],
+                figures['errors']))
+        lines.append('')
+    return lines
+
+
+###########################
+# Worker cold start
+###########################
+
+# Run by a fresh interpreter from the project root
+BOOT_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from app import app
+booted = time.perf_counter()
+status = app.test_client().get('/').status_code
+served = time.perf_counter()
+print(json.dumps(dict(boot_ms=(booted - start) * 1000,
+                      first_request_ms=(served - booted) * 1000,
+                      status=status)))
+"""
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _boot(url, warm_up):
+    env = dict(os.environ, DATABASE_URL=url, WARM_UP='1' if warm_up else '0',
+               THUMBNAIL_WORKERS='0', BCRYPT_POOL_SIZE='0')
+    env.setdefault('SECRET_KEY', 'benchmark')
+    output = subprocess.run([sys.executable, '-c', BOOT_SCRIPT], env=env,
+                            cwd=PROJECT_ROOT, check=True,
+                            stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def cold_start(runs=5):
+    """Boot the app `runs` times in fresh interpreters, with and without
+    WARM_UP, against an empty temporary SQLite database. Returns the median
+    milliseconds to import the app and to serve the first request."""
+    directory = tempfile.mkdtemp(prefix='sewing-cold-start-')
+    url = 'sqlite:///' + os.path.join(directory, 'cold-start.db')
+    engine = create_engine(url)
+    try:
+        db.metadata.create_all(engine)
+        results = {}
+        for warm_up in (False, True):
+            boots = [_boot(url, warm_up) for _ in range(runs)]
+            results['warm_up' if warm_up else 'no_warm_up'] = dict(
+                boot_ms=round(statistics.median(
+                    boot['boot_ms'] for boot in boots), 1),
+                first_request_ms=round(statistics.median(
+                    boot['first_request_ms'] for boot in boots), 1),
+                errors=sum(1 for boot in boots if boot['status'] >= 400))
+        return results
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,212 @@
+"""Small caches with hit/miss counters.
+
+LRUCache keeps values in process memory and FragmentCache keeps rendered
+HTML under a memory limit. SharedCache stores values in any
+client with a redis-like get/set/delete interface, so every worker sees the
+same entries and invalidations; tests can pass a dict-backed stand-in.
+LazyCache builds one of them per app from its config on first use.
+"""
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app
+
+
+class CacheStats(object):
+    """Hit and miss counters of a cache."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def as_dict(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    hit_ratio=self.hit_ratio)
+
+
+class LRUCache(object):
+    """In-process cache that evicts the least recently used entries.
+
+    Entries older than `ttl` seconds are treated as missing.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and \
+                    entry[1] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.stats.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FragmentCache(object):
+    """LRU cache of rendered HTML that holds at most `max_bytes` of text."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.stats.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return html
+
+    def set(self, key, html):
+        size = len(html.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.encode('utf-8'))
+            self._entries[key] = html
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.encode('utf-8'))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedCache(object):
+    """Cache stored in a shared key-value store such as redis.
+
+    `client` needs get(key), set(key, value, ex=seconds) and delete(key).
+    Values must be JSON serializable.
+    """
+
+    def __init__(self, client, prefix='', ttl=None):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.stats = CacheStats()
+
+    def _key(self, key):
+        return '%s%s' % (self.prefix, key)
+
+    def get(self, key, default=None):
+        raw = self.client.get(self._key(key))
+        if raw is None:
+            self.stats.misses += 1
+            return default
+        self.stats.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value):
+        ttl = int(self.ttl) if self.ttl is not None else None
+        self.client.set(self._key(key), json.dumps(value), ex=ttl)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        # Shared entries simply expire; there is no cheap way to scan them
+        pass
+
+
+class LazyCache(object):
+    """A cache per app, made by `build(app)` the first time it is used in
+    that app, so module level caches are sized by the config of the app
+    create_app() made rather than by whatever was configured at import."""
+
+    def __init__(self, build):
+        self._build = build
+        self._lock = Lock()
+
+    @property
+    def cache(self):
+        app = current_app._get_current_object()
+        caches = app.extensions.setdefault('sewing_caches', {})
+        cache = caches.get(self)
+        if cache is None:
+            with self._lock:
+                cache = caches.get(self)
+                if cache is None:
+                    cache = caches[self] = self._build(app)
+        return cache
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def __len__(self):
+        return len(self.cache)
+
+
+def render_stats(caches):
+    """Return the hit and miss counters of `caches`, a dict of name ->
+    cache, in the Prometheus text format."""
+    lines = [
+        '# HELP sewing_cache_hits_total Lookups answered from a cache.',
+        '# TYPE sewing_cache_hits_total counter',
+    ]
+    lines.extend('sewing_cache_hits_total{cache="%s"} %d'
+                 % (name, cache.stats.hits) for name, cache in caches.items())
+    lines.extend([
+        '# HELP sewing_cache_misses_total Lookups a cache could not answer.',
+        '# TYPE sewing_cache_misses_total counter',
+    ])
+    lines.extend('sewing_cache_misses_total{cache="%s"} %d'
+                 % (name, cache.stats.misses)
+                 for name, cache in caches.items())
+    return ''.join(line + '\n' for line in lines)
+
+
+def make_cache(url=None, prefix='', maxsize=1024, ttl=None):
+    """Return a SharedCache for a redis `url`, else an LRUCache."""
+    if url:
+        import redis
+        return SharedCache(redis.Redis.from_url(url), prefix=prefix, ttl=ttl)
+    return LRUCache(maxsize=maxsize, ttl=ttl)
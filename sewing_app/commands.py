@@ -0,0 +1,221 @@
+"""Flask CLI commands for maintaining the database.
+
+Run them with `flask <command>` (FLASK_APP=app.py). They are registered
+through the `maintenance` blueprint, at the top level of the app's CLI.
+"""
+import json
+
+import click
+from flask import Blueprint, current_app
+
+from sewing_app import assets, benchmark, cooccurrence, exporter, ledger, \
+    photo_checks, summaries, thumbnails
+from sewing_app.extensions import db
+from sewing_app.fragments import bump_version
+from sewing_app.importer import IMPORTERS, FORMATS, guess_format, read_rows
+from sewing_app.migrations import upgrade
+from sewing_app.models import User, recount_tags
+from sewing_app.search import rebuild_index
+
+maintenance = Blueprint('maintenance', __name__, cli_group=None)
+
+
+@maintenance.cli.command('recount-tags')
+def recount_tags_command():
+    """Recompute the fabric/pattern tag counters."""
+    recount_tags()
+    bump_version('catalog')
+    db.session.commit()
+    click.echo('Tag counters recomputed.')
+
+
+@maintenance.cli.command('reindex-search')
+def reindex_search_command():
+    """Rebuild the full-text search index."""
+    rebuild_index()
+    db.session.commit()
+    click.echo('Search index rebuilt.')
+
+
+@maintenance.cli.command('rebuild-summaries')
+def rebuild_summaries_command():
+    """Recompute the stash dashboard summaries."""
+    users = summaries.rebuild()
+    db.session.commit()
+    click.echo('Summaries rebuilt for the catalog and %d users.' % users)
+
+
+@maintenance.cli.command('fold-summaries')
+def fold_summaries_command():
+    """Add the pending changes into the stash dashboard summaries."""
+    folded = summaries.fold()
+    db.session.commit()
+    click.echo('Folded the changes of %d summaries.' % folded)
+
+
+@maintenance.cli.command('rebuild-pairs')
+def rebuild_pairs_command():
+    """Recompute the "often paired with" fabric co-occurrence index."""
+    cooccurrence.rebuild()
+    bump_version('catalog')
+    db.session.commit()
+    click.echo('Fabric pairs rebuilt.')
+
+
+@maintenance.cli.command('snapshot-yardage')
+@click.option('--lag', type=int,
+              help='Only fold entries older than this many seconds '
+                   '(YARDAGE_SNAPSHOT_LAG).')
+def snapshot_yardage_command(lag):
+    """Fold the yardage ledger entries into the balance snapshots."""
+    fabrics = ledger.take_snapshots(lag)
+    db.session.commit()
+    click.echo('Snapshots updated for %d fabrics.' % fabrics)
+
+
+@maintenance.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create the tables and apply the pending schema migrations."""
+    applied = upgrade()
+    for version, name in applied:
+        click.echo('Applied migration %d: %s' % (version, name))
+    if not applied:
+        click.echo('The database is up to date.')
+
+
+@maintenance.cli.command('import-data')
+@click.argument('kind', type=click.Choice(sorted(IMPORTERS)))
+@click.argument('path', type=click.File('rb'))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS),
+              help='Input format (guessed from the file name by default).')
+@click.option('--user', 'username', help='Record the rows as created by this user.')
+def import_data_command(kind, path, fmt, username):
+    """Bulk import fabrics or patterns from a CSV or JSONL file."""
+    fmt = fmt or guess_format(path.name)
+    if fmt is None:
+        raise click.UsageError('Cannot guess the format of %s, use --format.'
+                               % path.name)
+    user_id = None
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.UsageError('No user named %s.' % username)
+        user_id = user.id
+
+    report = IMPORTERS[kind](read_rows(path, fmt), user_id=user_id)
+    for error in report.errors:
+        click.echo('line %(line)s: %(errors)s' % error, err=True)
+    click.echo('Imported %d %s, rejected %d rows.'
+               % (report.inserted, kind, report.failed))
+
+
+@maintenance.cli.command('export-data')
+@click.argument('kind', type=click.Choice(sorted(exporter.QUERIES)))
+@click.argument('username')
+@click.option('--format', 'fmt', type=click.Choice(exporter.FORMATS),
+              default='csv', show_default=True)
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output.')
+@click.option('--output', '-o', type=click.File('wb'), default='-',
+              help='File to write (stdout by default).')
+def export_data_command(kind, username, fmt, compress, output):
+    """Export a user's fabrics, patterns or tags as CSV or JSONL."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.UsageError('No user named %s.' % username)
+    for chunk in exporter.export_chunks(kind, user.id, fmt, compress):
+        output.write(chunk)
+
+
+@maintenance.cli.command('fetch-thumbnails')
+@click.option('--retry', is_flag=True, help='Also retry photos that failed.')
+def fetch_thumbnails_command(retry):
+    """Download the photos that have no thumbnail yet."""
+    thumbnails.register_all()
+    db.session.commit()
+    stored, failed = thumbnails.fetch_pending(retry=retry)
+    click.echo('Stored %d thumbnails, %d photos failed.' % (stored, failed))
+
+
+@maintenance.cli.command('build-assets')
+@click.option('--fetch-fonts', is_flag=True,
+              help='First download the Manrope font into static/fonts.')
+def build_assets_command(fetch_fonts):
+    """Fingerprint and precompress the static files."""
+    if fetch_fonts:
+        click.echo('Fetched %d font files.' % assets.fetch_fonts())
+    built = assets.build()
+    compressed = sum(1 for entry in built.values() if entry['encodings'])
+    click.echo('Built %d static files (%d precompressed) into %s.' % (
+        len(built), compressed, current_app.config['ASSETS_DIR']))
+
+
+@maintenance.cli.command('check-photos')
+@click.option('--unchecked', is_flag=True,
+              help='Only check the URLs never checked before.')
+@click.option('--concurrency', type=int,
+              help='Requests in flight (PHOTO_CHECK_CONCURRENCY).')
+@click.option('--per-host', type=int,
+              help='Requests in flight per host (PHOTO_CHECK_PER_HOST).')
+@click.option('--timeout', type=float,
+              help='Seconds to wait for a response (PHOTO_CHECK_TIMEOUT).')
+def check_photos_command(unchecked, concurrency, per_host, timeout):
+    """Check that the photo URLs still point at images."""
+    checked, dead = photo_checks.check_all(
+        unchecked, concurrency=concurrency, per_host=per_host,
+        timeout=timeout)
+    for check, used_by in photo_checks.dead_links():
+        click.echo('%s: %s (%s)' % (
+            check.url, photo_checks.reason(check),
+            ', '.join('%s %d' % (type(obj).__name__.lower(), obj.id)
+                      for obj in used_by) or 'unused'))
+    click.echo('Checked %d photo URLs, %d dead.' % (checked, dead))
+
+
+@maintenance.cli.command('benchmark')
+@click.option('--sizes', default='small', show_default=True,
+              help='Comma separated data sizes: %s.' % ', '.join(benchmark.SIZES))
+@click.option('--requests', 'count', default=50, show_default=True,
+              help='Timed requests per endpoint and size.')
+@click.option('--seed', default=1, show_default=True)
+@click.option('--database', help='Scratch database URL, which is wiped '
+              '(a temporary SQLite file by default).')
+@click.option('--output', '-o', type=click.File('w'),
+              help='Save the results as JSON.')
+@click.option('--baseline', type=click.File('r'),
+              help='Compare with the JSON results of an earlier run.')
+@click.option('--tolerance', default=0.25, show_default=True,
+              help='Allowed growth of the median latency.')
+def benchmark_command(sizes, count, seed, database, output, baseline,
+                      tolerance):
+    """Benchmark the routes against generated data."""
+    sizes = [size.strip() for size in sizes.split(',') if size.strip()]
+    unknown = [size for size in sizes if size not in benchmark.SIZES]
+    if unknown:
+        raise click.UsageError('Unknown sizes: %s' % ', '.join(unknown))
+
+    results = benchmark.run_benchmark(sizes, requests=count, seed=seed,
+                                      database=database)
+    for line in benchmark.format_report(results):
+        click.echo(line)
+    if output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    if baseline:
+        regressions = benchmark.compare(json.load(baseline), results,
+                                        tolerance)
+        for regression in regressions:
+            click.echo('Regression: %s' % regression, err=True)
+        if regressions:
+            raise SystemExit(1)
+        click.echo('No regressions against the baseline.')
+
+
+@maintenance.cli.command('cold-start')
+@click.option('--runs', default=5, show_default=True,
+              help='Fresh interpreters booted per setting.')
+def cold_start_command(runs):
+    """Time a worker boot: importing the app and its first request."""
+    results = benchmark.cold_start(runs)
+    click.echo('%-12s %10s %18s' % ('', 'boot ms', 'first request ms'))
+    for setting, figures in results.items():
+        click.echo('%-12s %10.1f %18.1f' % (setting, figures['boot_ms'],
+                                            figures['first_request_ms']))
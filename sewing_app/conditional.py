@@ -0,0 +1,80 @@
+"""Conditional GET support (ETag / Last-Modified) for rendered pages.
+
+Views decorated with @conditional compute cheap validators (a cache version
+counter or a row's updated_at) before doing any real work, and answer a
+matching If-None-Match / If-Modified-Since with 304 Not Modified without
+loading relationships or rendering templates.
+
+Only give a Last-Modified for pages whose every input it covers: a client
+revalidating with If-Modified-Since alone gets a 304 whenever the page is
+not newer than it, whatever the ETag parts say.
+"""
+import hashlib
+import time
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+
+
+
+def _etag(parts, forms):
+    """Hash the validator `parts` together with what else the page shows."""
+    parts = list(parts)
+    # Pages show who is logged in
+    if current_user.is_authenticated:
+        parts += [current_user.get_id(), current_user.username]
+    if forms:
+        # Pages with forms embed a CSRF token that is tied to the session and
+        # expires, so cached copies are only reused for half its lifetime
+        time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600) or 3600
+        parts += [session.get('csrf_token'),
+                  int(time.time() // (time_limit / 2))]
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def _set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Caches may keep the page but must revalidate it on every use
+    response.cache_control.no_cache = True
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    response.vary.add('Cookie')
+    return response
+
+
+def conditional(validators, forms=False):
+    """Answer conditional GETs of the decorated view with 304 Not Modified.
+
+    `validators(**view_args)` returns (etag_parts, last_modified), where
+    last_modified may be None, or None to skip the check. Set `forms` for
+    pages that render forms with a CSRF token.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            # Pending flash messages are shown once, so always render them
+            if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+                return view(**kwargs)
+            result = validators(**kwargs)
+            if result is None:
+                return view(**kwargs)
+
+            parts, last_modified = result
+            etag = _etag(parts, forms)
+            if not is_resource_modified(request.environ, etag=etag,
+                                        last_modified=last_modified):
+                return _set_validators(make_response('', 304), etag,
+                                       last_modified)
+
+            response = make_response(view(**kwargs))
+            if response.status_code == 200:
+                _set_validators(response, etag, last_modified)
+            return response
+        return wrapper
+    return decorator
@@ -10,3 +10,140 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL")
     SECRET_KEY = os.getenv('SECRET_KEY')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Connection pool of each worker process (Postgres)
+    DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', 5))
+    DATABASE_MAX_OVERFLOW = int(os.getenv('DATABASE_MAX_OVERFLOW', 10))
+    # Seconds after which a pooled connection is replaced
+    DATABASE_POOL_RECYCLE = int(os.getenv('DATABASE_POOL_RECYCLE', 1800))
+    # Test pooled connections before use, surviving database restarts
+    DATABASE_POOL_PRE_PING = os.getenv('DATABASE_POOL_PRE_PING', '1') != '0'
+    # Pragmas set on every SQLite connection (empty to keep SQLite's default)
+    SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'wal')
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'normal')
+    SQLITE_MMAP_SIZE = os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))
+    # Optional read replica used by GET requests, see database.py
+    DATABASE_REPLICA_URL = os.getenv('DATABASE_REPLICA_URL')
+    SQLALCHEMY_BINDS = {'replica': DATABASE_REPLICA_URL} \
+        if DATABASE_REPLICA_URL else None
+    # Seconds a client reads from the primary after writing
+    REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', 10))
+    # Number of fabrics shown per homepage page
+    FABRICS_PER_PAGE = int(os.getenv('FABRICS_PER_PAGE', 24))
+    # Number of results shown per search page
+    SEARCH_RESULTS_PER_PAGE = int(os.getenv('SEARCH_RESULTS_PER_PAGE', 20))
+    # bcrypt cost factor; stored hashes are upgraded on login when it changes
+    BCRYPT_LOG_ROUNDS = int(os.getenv('BCRYPT_LOG_ROUNDS', 12))
+    # gunicorn worker processes (gunicorn reads the same variable), used to
+    # split the CPUs between the per-worker pools below
+    WEB_CONCURRENCY = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+    # Processes used for password hashing by each worker (0 hashes inline);
+    # by default the CPUs are shared out between the workers
+    BCRYPT_POOL_SIZE = int(os.getenv(
+        'BCRYPT_POOL_SIZE', max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+    # Seconds to wait for a hashing worker before answering 429
+    BCRYPT_TIMEOUT = float(os.getenv('BCRYPT_TIMEOUT', 10))
+    # Admission control of login and signup, see admission.py: attempts
+    # per minute and burst per client address and per username, hash
+    # operations in flight per process (0 for no cap), and a redis URL to
+    # share the buckets between workers
+    ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', '1') != '0'
+    ADMISSION_IP_PER_MINUTE = float(os.getenv('ADMISSION_IP_PER_MINUTE', 60))
+    ADMISSION_IP_BURST = int(os.getenv('ADMISSION_IP_BURST', 30))
+    ADMISSION_USER_PER_MINUTE = float(os.getenv('ADMISSION_USER_PER_MINUTE', 6))
+    ADMISSION_USER_BURST = int(os.getenv('ADMISSION_USER_BURST', 10))
+    ADMISSION_MAX_HASHING = int(os.getenv('ADMISSION_MAX_HASHING',
+                                          2 * max(1, BCRYPT_POOL_SIZE)))
+    ADMISSION_STATE_URL = os.getenv('ADMISSION_STATE_URL')
+    ADMISSION_TRACKED_KEYS = int(os.getenv('ADMISSION_TRACKED_KEYS', 100000))
+    # Logged in users are cached between requests; set USER_CACHE_URL to a
+    # redis URL to share the cache between workers. A change to a user only
+    # clears the cache of the worker making it, so without a shared cache
+    # other workers see the old user for up to USER_CACHE_TTL seconds,
+    # which is only long by default when there is a single worker
+    USER_CACHE_URL = os.getenv('USER_CACHE_URL')
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 1024))
+    USER_CACHE_TTL = float(os.getenv(
+        'USER_CACHE_TTL',
+        300 if USER_CACHE_URL or WEB_CONCURRENCY == 1 else 5))
+    # Memory limit of the rendered fragment cache (0 disables it)
+    FRAGMENT_CACHE_MAX_BYTES = int(os.getenv('FRAGMENT_CACHE_MAX_BYTES',
+                                             16 * 1024 * 1024))
+    # Seconds a worker trusts its copy of a cache version before rereading it,
+    # i.e. how long other workers' writes can take to show up
+    FRAGMENT_VERSION_TTL = float(os.getenv('FRAGMENT_VERSION_TTL', 2))
+    # Rows inserted per transaction by the bulk importer
+    IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+    # Rows fetched per round trip by the stash export
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+    # Directory of the photo thumbnails, stored under their content hash
+    THUMBNAIL_DIR = os.getenv('THUMBNAIL_DIR', os.path.join(
+        os.path.dirname(__file__), 'static', 'img'))
+    # Longest side of a thumbnail in pixels (resizing needs Pillow)
+    THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', 400))
+    # Disk space used by thumbnails; the least recently used are evicted
+    THUMBNAIL_MAX_BYTES = int(os.getenv('THUMBNAIL_MAX_BYTES',
+                                        256 * 1024 * 1024))
+    # Largest photo downloaded, and seconds to wait for it
+    THUMBNAIL_MAX_SOURCE_BYTES = int(os.getenv('THUMBNAIL_MAX_SOURCE_BYTES',
+                                               20 * 1024 * 1024))
+    THUMBNAIL_FETCH_TIMEOUT = float(os.getenv('THUMBNAIL_FETCH_TIMEOUT', 10))
+    # Networks photos may be fetched from although they are not public,
+    # comma separated (e.g. 10.0.0.0/8); loopback, private, link-local and
+    # other internal addresses are refused otherwise, see thumbnails.py
+    PHOTO_ALLOWED_NETWORKS = [
+        network.strip() for network in
+        os.getenv('PHOTO_ALLOWED_NETWORKS', '').split(',') if network.strip()]
+    # Background threads fetching photos (0 leaves it to fetch-thumbnails)
+    THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', 2))
+    # Seconds before a photo that failed to download is tried again
+    THUMBNAIL_RETRY_AFTER = int(os.getenv('THUMBNAIL_RETRY_AFTER', 24 * 3600))
+    # max-age of served thumbnails; a photo URL always gets the same one
+    THUMBNAIL_MAX_AGE = int(os.getenv('THUMBNAIL_MAX_AGE', 365 * 24 * 3600))
+    # Keep compiled templates in TEMPLATE_BYTECODE_DIR (a private directory
+    # under the system temp dir by default), so new workers skip compiling
+    TEMPLATE_BYTECODE_CACHE = os.getenv('TEMPLATE_BYTECODE_CACHE', '1') != '0'
+    TEMPLATE_BYTECODE_DIR = os.getenv('TEMPLATE_BYTECODE_DIR')
+    # Fingerprinted static files written by `flask build-assets`, and their
+    # max-age; a fingerprinted name always gets the same content
+    ASSETS_DIR = os.getenv('ASSETS_DIR', os.path.join(
+        os.path.dirname(__file__), 'static', 'build'))
+    ASSETS_MAX_AGE = int(os.getenv('ASSETS_MAX_AGE', 365 * 24 * 3600))
+    # Load the Manrope font from static/fonts instead of Google Fonts (fetch
+    # it with `flask build-assets --fetch-fonts`)
+    SELF_HOST_FONTS = os.getenv('SELF_HOST_FONTS', '0') == '1'
+    # Photo link checker, see photo_checks.py: requests in flight, overall
+    # and per host, and seconds to wait for each response
+    PHOTO_CHECK_CONCURRENCY = int(os.getenv('PHOTO_CHECK_CONCURRENCY', 100))
+    PHOTO_CHECK_PER_HOST = int(os.getenv('PHOTO_CHECK_PER_HOST', 4))
+    PHOTO_CHECK_TIMEOUT = float(os.getenv('PHOTO_CHECK_TIMEOUT', 10))
+    # Also check photo URLs in the background when they are saved
+    PHOTO_CHECK_ON_SAVE = os.getenv('PHOTO_CHECK_ON_SAVE', '0') == '1'
+    # Yardage ledger entries shown on the fabric page, and the age in seconds
+    # an entry must reach before `flask snapshot-yardage` folds it into the
+    # balance snapshot (longer than any transaction), see ledger.py
+    YARDAGE_HISTORY_SHOWN = int(os.getenv('YARDAGE_HISTORY_SHOWN', 10))
+    YARDAGE_SNAPSHOT_LAG = int(os.getenv('YARDAGE_SNAPSHOT_LAG', 60))
+    # Pending changes a stash summary can have before the writer adding one
+    # folds them into it, i.e. the most the dashboard reads besides the row
+    SUMMARY_MAX_PENDING = int(os.getenv('SUMMARY_MAX_PENDING', 16))
+    # Fabrics listed under "Often paired with" on the detail pages
+    PAIRED_FABRICS_SHOWN = int(os.getenv('PAIRED_FABRICS_SHOWN', 8))
+    # Neighbours read per fabric of a pattern to rank its "often paired
+    # with"; fabrics paired with it less often are not considered
+    PAIRED_FABRICS_CANDIDATES = int(os.getenv('PAIRED_FABRICS_CANDIDATES', 50))
+    # Time SQL and template rendering per request: Server-Timing header, slow
+    # request log and /metrics, see metrics.py
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', '0') == '1'
+    # /metrics is only served to requests with "Authorization: Bearer
+    # <METRICS_TOKEN>", and not at all while it is unset
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    # Requests taking at least this many seconds are logged
+    SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', 0.5))
+    # Users whose list ids the stash matcher keeps in memory, see matcher.py
+    MATCHER_CACHE_SIZE = int(os.getenv('MATCHER_CACHE_SIZE', 1024))
+    # Tag changes kept for other processes to catch up with; a process
+    # further behind reloads every tag
+    MATCHER_TAG_CHANGES_KEPT = int(os.getenv('MATCHER_TAG_CHANGES_KEPT', 1000))
+    # Configure the mappers and compile the templates in create_app, before
+    # gunicorn --preload forks the workers (slows down a boot without it)
+    WARM_UP = os.getenv('WARM_UP', '0') == '1'
@@ -0,0 +1,191 @@
+"""Fabric co-occurrence index: "often paired with" on the detail pages.
+
+FabricPair holds, for every two fabrics tagged on the same pattern, the
+number of patterns they share, once per direction. Its (fabric_id, count)
+index makes the top neighbours of a fabric one indexed query, where
+computing them from fabrics_patterns is a self-join that grows with the
+square of a popular fabric's patterns.
+
+Pairs are counted per pattern, so a tag change only touches the pairs of
+the fabrics it adds or removes: each one gains or loses a pair with every
+other fabric of the pattern, which costs the number of changed fabrics
+times the pattern's, not the square of the pattern's. Tag changes made
+through the ORM are picked up by flush listeners; code inserting tags with
+Core calls patterns_changed(). rebuild() recomputes the whole table with
+one INSERT ... SELECT.
+
+A pattern's "often paired with" adds up the top PAIRED_FABRICS_CANDIDATES
+neighbours of each of its fabrics, each an indexed range read, rather than
+every neighbour: a fabric that is in none of those lists is left out even
+if its total would rank it, in exchange for a read bounded by the number
+of the pattern's fabrics instead of the size of their neighbourhoods.
+"""
+from collections import Counter
+from itertools import permutations
+
+from flask import current_app
+from sqlalchemy import and_, bindparam, event, func, inspect, select, \
+    union_all
+
+from sewing_app.extensions import db
+from sewing_app.models import Fabric, FabricPair, fabrics_patterns, \
+    insert_ignore_many, tag_changes
+
+table = FabricPair.__table__
+
+# Fabrics whose neighbours are read in one UNION (SQLite allows 500 SELECTs)
+UNION_SIZE = 100
+
+
+def tag_sets(pattern_ids):
+    """Return pattern id -> set of the ids of its fabrics."""
+    tags = {pattern_id: set() for pattern_id in pattern_ids}
+    if tags:
+        query = select([fabrics_patterns.c.pattern_id,
+                        fabrics_patterns.c.fabric_id]).where(
+            fabrics_patterns.c.pattern_id.in_(list(tags)))
+        for pattern_id, fabric_id in db.session.execute(query):
+            tags[pattern_id].add(fabric_id)
+    return tags
+
+
+def _pair_deltas(changes):
+    """Return the pair count changes of patterns whose tags changed, given
+    as (kept fabric ids, added ids, removed ids) triples."""
+    deltas = Counter()
+    for kept, added, removed in changes:
+        for sign, changed in ((1, added), (-1, removed)):
+            for fabric_id in changed:
+                for other_id in kept:
+                    deltas[fabric_id, other_id] += sign
+                    deltas[other_id, fabric_id] += sign
+            for pair in permutations(changed, 2):
+                deltas[pair] += sign
+    return deltas
+
+
+def _apply(deltas):
+    """Add `deltas` ((fabric id, other id) -> change) to the counts."""
+    deltas = {pair: delta for pair, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    insert_ignore_many(table, [
+        dict(fabric_id=fabric_id, other_id=other_id, count=0)
+        for (fabric_id, other_id), delta in deltas.items() if delta > 0])
+    db.session.execute(
+        table.update().where(and_(
+            table.c.fabric_id == bindparam('pair_fabric_id'),
+            table.c.other_id == bindparam('pair_other_id')))
+        .values(count=table.c.count + bindparam('delta')),
+        [dict(pair_fabric_id=fabric_id, pair_other_id=other_id, delta=delta)
+         for (fabric_id, other_id), delta in deltas.items()])
+    db.session.execute(table.delete().where(and_(
+        table.c.count <= 0,
+        table.c.fabric_id.in_({fabric_id for fabric_id, _ in deltas}))))
+
+
+def patterns_changed(pattern_ids, before=None):
+    """Update the pairs after the tags of `pattern_ids` changed, given
+    their tag_sets() from before (None for new patterns)."""
+    before = before or {}
+    changes = []
+    for pattern_id, after in tag_sets(pattern_ids).items():
+        was = before.get(pattern_id, set())
+        changes.append((after & was, after - was, was - after))
+    _apply(_pair_deltas(changes))
+
+
+def rebuild():
+    """Recompute every pair from fabrics_patterns."""
+    db.session.execute(table.delete())
+    mine, theirs = fabrics_patterns.alias(), fabrics_patterns.alias()
+    pairs = select([mine.c.fabric_id, theirs.c.fabric_id, func.count()]) \
+        .select_from(mine.join(theirs, and_(
+            mine.c.pattern_id == theirs.c.pattern_id,
+            mine.c.fabric_id != theirs.c.fabric_id))) \
+        .group_by(mine.c.fabric_id, theirs.c.fabric_id)
+    db.session.execute(table.insert().from_select(
+        ['fabric_id', 'other_id', 'count'], pairs))
+
+
+###########################
+# Reading
+###########################
+
+def paired_with_fabric(fabric_id, limit=None):
+    """Return the fabrics most often tagged with `fabric_id`, as
+    (Fabric, number of shared patterns) pairs."""
+    limit = limit or current_app.config['PAIRED_FABRICS_SHOWN']
+    return db.session.query(Fabric, FabricPair.count).join(
+        FabricPair, FabricPair.other_id == Fabric.id).filter(
+        FabricPair.fabric_id == fabric_id).order_by(
+        FabricPair.count.desc(), Fabric.id).limit(limit).all()
+
+
+def paired_with_pattern(pattern_id, limit=None):
+    """Return the fabrics most often tagged with those of `pattern_id`,
+    leaving out its own, as (Fabric, number of shared patterns) pairs."""
+    limit = limit or current_app.config['PAIRED_FABRICS_SHOWN']
+    candidates = current_app.config['PAIRED_FABRICS_CANDIDATES']
+    tagged = {fabric_id for fabric_id, in db.session.execute(
+        select([fabrics_patterns.c.fabric_id]).where(
+            fabrics_patterns.c.pattern_id == pattern_id))}
+    shared = Counter()
+    tagged_ids = sorted(tagged)
+    for start in range(0, len(tagged_ids), UNION_SIZE):
+        tops = [select([table.c.other_id, table.c.count]).where(
+                    table.c.fabric_id == fabric_id).order_by(
+                    table.c.count.desc(), table.c.other_id).limit(
+                    candidates).alias()
+                for fabric_id in tagged_ids[start:start + UNION_SIZE]]
+        query = union_all(*[select([top.c.other_id, top.c.count])
+                            for top in tops])
+        for other_id, count in db.session.execute(query):
+            if other_id not in tagged:
+                shared[other_id] += count
+
+    top = sorted(shared, key=lambda other_id: (-shared[other_id],
+                                               other_id))[:limit]
+    fabrics = {fabric.id: fabric
+               for fabric in Fabric.query.filter(Fabric.id.in_(top))}
+    return [(fabrics[fabric_id], shared[fabric_id]) for fabric_id in top
+            if fabric_id in fabrics]
+
+
+###########################
+# ORM changes
+###########################
+
+@event.listens_for(db.session, 'before_flush')
+def snapshot_tagged_patterns(session, flush_context, instances):
+    added, removed = tag_changes(session)
+    patterns = {pattern for fabric, pattern in added | removed}
+    if patterns:
+        before = tag_sets([inspect(pattern).identity[0]
+                           for pattern in patterns
+                           if inspect(pattern).identity is not None])
+        session.info.setdefault('pair_snapshots', []).append(
+            (added, removed, before))
+
+
+@event.listens_for(db.session, 'after_flush')
+def update_pairs(session, flush_context):
+    for added, removed, before in session.info.pop('pair_snapshots', ()):
+        # New fabrics and patterns only have their id from here on
+        added_ids, removed_ids = {}, {}
+        for fabric, pattern in added:
+            added_ids.setdefault(pattern.id, set()).add(fabric.id)
+        for fabric, pattern in removed:
+            removed_ids.setdefault(pattern.id, set()).add(fabric.id)
+        changes = []
+        for pattern_id in set(added_ids) | set(removed_ids):
+            was = before.get(pattern_id, set())
+            gone = was & removed_ids.get(pattern_id, set())
+            changes.append((was - gone, added_ids.get(pattern_id, set()) - was,
+                            gone))
+        _apply(_pair_deltas(changes))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_pair_snapshots(session):
+    session.info.pop('pair_snapshots', None)
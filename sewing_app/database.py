@@ -0,0 +1,101 @@
+"""Engine profiles and read-replica routing for Flask-SQLAlchemy.
+
+Database applies the pool settings of Config to Postgres engines and the
+journal, synchronous and mmap pragmas to every SQLite connection.
+
+When DATABASE_REPLICA_URL is set, RoutingSession sends the reads of GET and
+HEAD requests to the replica and everything else to the primary: flushes,
+INSERT/UPDATE/DELETE statements and whatever follows them in the same
+transaction, other requests and code running outside a request (CLI
+commands, background threads). A client that wrote something reads from
+the primary for REPLICA_STICKY_SECONDS afterwards, so they see their own
+writes even if the replica lags behind.
+"""
+import time
+
+from flask import has_request_context, request, session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_BIND = 'replica'
+
+# Flask session key holding the time until which a client reads the primary
+STICKY_KEY = '_read_primary_until'
+
+
+def replica_configured(app):
+    return REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or ())
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from the replica during GET requests."""
+
+    def _use_replica(self, clause):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        if self.info.get('wrote') or not replica_configured(self.app):
+            return False
+        if not has_request_context() or request.method not in ('GET', 'HEAD'):
+            return False
+        return flask_session.get(STICKY_KEY, 0) < time.time()
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._use_replica(clause):
+            return get_state(self.app).db.get_engine(self.app,
+                                                     bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+def stick_to_primary(session):
+    wrote = session.info.pop('wrote', False)
+    if wrote and replica_configured(session.app) and has_request_context() \
+            and request.method not in ('GET', 'HEAD'):
+        flask_session[STICKY_KEY] = \
+            time.time() + session.app.config['REPLICA_STICKY_SECONDS']
+
+
+def forget_writes(session):
+    session.info.pop('wrote', None)
+
+
+def _set_sqlite_pragmas(config):
+    pragmas = [('journal_mode', config['SQLITE_JOURNAL_MODE']),
+               ('synchronous', config['SQLITE_SYNCHRONOUS']),
+               ('mmap_size', config['SQLITE_MMAP_SIZE'])]
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            if value not in (None, ''):
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    return set_pragmas
+
+
+class Database(SQLAlchemy):
+    """SQLAlchemy with the engine profiles of Config and RoutingSession."""
+
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, 'after_commit', stick_to_primary)
+        event.listen(factory, 'after_rollback', forget_writes)
+        return factory
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername.startswith('postgresql'):
+            options.setdefault('pool_size', app.config['DATABASE_POOL_SIZE'])
+            options.setdefault('max_overflow',
+                               app.config['DATABASE_MAX_OVERFLOW'])
+            options.setdefault('pool_recycle',
+                               app.config['DATABASE_POOL_RECYCLE'])
+            options.setdefault('pool_pre_ping',
+                               app.config['DATABASE_POOL_PRE_PING'])
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect',
+                         _set_sqlite_pragmas(self.get_app().config))
+        return engine
@@ -0,0 +1,161 @@
+"""Streaming CSV/JSONL export of a user's stash.
+
+The rows are read through a server-side cursor (stream_results) in batches
+of EXPORT_BATCH_SIZE and serialized chunk by chunk, optionally through
+gzip, so exporting costs the same memory whatever the size of the stash.
+The fabrics and patterns files use the columns read by importer.py, so an
+export can be imported again: the fabrics column of the patterns file
+holds the names of the pattern's fabrics, looked up a batch at a time and
+joined with '|' in CSV files or listed in JSONL files.
+"""
+import csv
+import io
+import json
+import zlib
+
+from flask import current_app
+from sqlalchemy import bindparam, select
+
+from sewing_app.extensions import db
+from sewing_app.models import Fabric, Pattern, fabrics_list, \
+    patterns_list, fabrics_patterns
+
+FORMATS = ('csv', 'jsonl')
+
+fabric_table = Fabric.__table__
+pattern_table = Pattern.__table__
+
+
+def _fabrics_query(user_id):
+    return select([fabric_table.c.id, fabric_table.c.name,
+                   fabric_table.c.color, fabric_table.c.quantity,
+                   fabric_table.c.photo_url]).select_from(
+        fabric_table.join(fabrics_list,
+                          fabrics_list.c.fabric_id == fabric_table.c.id)
+    ).where(fabrics_list.c.user_id == user_id).order_by(fabric_table.c.id)
+
+
+def _patterns_query(user_id):
+    return select([pattern_table.c.id, pattern_table.c.name,
+                   pattern_table.c.category,
+                   pattern_table.c.photo_url]).select_from(
+        pattern_table.join(patterns_list,
+                           patterns_list.c.pattern_id == pattern_table.c.id)
+    ).where(patterns_list.c.user_id == user_id).order_by(pattern_table.c.id)
+
+
+def _tags_query(user_id):
+    """Tags of the patterns on the user's patterns list."""
+    return select([pattern_table.c.id.label('pattern_id'),
+                   pattern_table.c.name.label('pattern_name'),
+                   fabric_table.c.id.label('fabric_id'),
+                   fabric_table.c.name.label('fabric_name')]).select_from(
+        patterns_list.join(
+            fabrics_patterns,
+            fabrics_patterns.c.pattern_id == patterns_list.c.pattern_id)
+        .join(pattern_table, pattern_table.c.id == patterns_list.c.pattern_id)
+        .join(fabric_table, fabric_table.c.id == fabrics_patterns.c.fabric_id)
+    ).where(patterns_list.c.user_id == user_id).order_by(
+        pattern_table.c.id, fabric_table.c.id)
+
+
+def _fabric_names(pattern_ids):
+    """Return {pattern id: [fabric name, ...]} for `pattern_ids`."""
+    query = select([fabrics_patterns.c.pattern_id,
+                    fabric_table.c.name]).select_from(
+        fabrics_patterns.join(
+            fabric_table, fabric_table.c.id == fabrics_patterns.c.fabric_id)
+    ).where(fabrics_patterns.c.pattern_id.in_(
+        bindparam('pattern_ids', expanding=True))
+    ).order_by(fabrics_patterns.c.pattern_id, fabric_table.c.id)
+    names = {pattern_id: [] for pattern_id in pattern_ids}
+    for pattern_id, name in db.session.connection().execute(
+            query, pattern_ids=list(pattern_ids)):
+        names[pattern_id].append(name)
+    return names
+
+
+QUERIES = {
+    'fabrics': _fabrics_query,
+    'patterns': _patterns_query,
+    'tags': _tags_query,
+}
+
+
+def _value(value):
+    """Turn a column value into something CSV and JSON can hold."""
+    if hasattr(value, 'name') and not isinstance(value, str):
+        # PatternCategory members are exported by name, like the form posts them
+        return value.name
+    if value is not None and not isinstance(value, (int, float, str, list)):
+        # Decimal quantities and URL objects
+        return float(value) if hasattr(value, 'as_tuple') else str(value)
+    return value
+
+
+def iter_rows(kind, user_id):
+    """Yield the column names, then every row of `kind` as a tuple."""
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    result = db.session.connection().execution_options(
+        stream_results=True).execute(QUERIES[kind](user_id))
+    columns = tuple(result.keys())
+    yield columns + ('fabrics',) if kind == 'patterns' else columns
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        if kind == 'patterns':
+            names = _fabric_names([row[0] for row in rows])
+            rows = [tuple(row) + (names[row[0]],) for row in rows]
+        for row in rows:
+            yield tuple(_value(value) for value in row)
+
+
+def _serialize(rows, fmt):
+    """Yield text chunks of `rows` serialized as CSV or JSONL."""
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    columns = next(rows)
+    if fmt == 'csv':
+        writer.writerow(columns)
+    for count, row in enumerate(rows, start=1):
+        if fmt == 'csv':
+            # Lists of fabric names as importer.read_rows() splits them
+            writer.writerow(['|'.join(value) if isinstance(value, list)
+                             else value for value in row])
+        else:
+            buffer.write(json.dumps(dict(zip(columns, row))))
+            buffer.write('\n')
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_chunks(kind, user_id, fmt='csv', compress=False):
+    """Yield the bytes of the export of a user's `kind` rows."""
+    chunks = (chunk.encode('utf-8')
+              for chunk in _serialize(iter_rows(kind, user_id), fmt))
+    if not compress:
+        yield from chunks
+        return
+
+    # wbits=31 writes a gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_filename(kind, fmt, compress=False):
+    return '%s.%s%s' % (kind, fmt, '.gz' if compress else '')
+
+
+MIMETYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
@@ -1,14 +1,10 @@
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_bcrypt import Bcrypt
-from sewing_app.config import Config
-import os
+from sewing_app.caching import LazyCache, make_cache
+from sewing_app.database import Database
 
-app = Flask(__name__)
-app.config.from_object(Config)
-
-db = SQLAlchemy(app)
+# Bound to each app by create_app() with init_app()
+db = Database()
 
 ###########################
 # Authentication
@@ -16,13 +12,17 @@ db = SQLAlchemy(app)
 
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
-login_manager.init_app(app)
+
+# Cache of the logged in users' columns, see User.load_cached
+user_cache = LazyCache(lambda app: make_cache(
+    app.config['USER_CACHE_URL'], prefix='user:',
+    maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL']))
 
 
 @login_manager.user_loader
 def load_user(user_id):
     from .models import User
-    return User.query.get(user_id)
+    return User.load_cached(user_id)
 
 
-bcrypt = Bcrypt(app)
+bcrypt = Bcrypt()
@@ -1,9 +1,47 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, DateField, SelectField, SubmitField, FloatField, PasswordField
-from wtforms.ext.sqlalchemy.fields import QuerySelectField, QuerySelectMultipleField
-from wtforms.validators import DataRequired, Length, URL, ValidationError
-from sewing_app.models import PatternCategory, Fabric, Pattern, User
-from sewing_app.extensions import app, db, bcrypt
+from wtforms import Field, StringField, DateField, SelectField, SubmitField, FloatField, PasswordField, DecimalField
+from wtforms.ext.sqlalchemy.fields import QuerySelectField
+from wtforms.widgets import Select
+from wtforms.validators import DataRequired, Length, NumberRange, Optional, URL, ValidationError
+from sewing_app.models import PatternCategory, Fabric, Pattern, User, YardageKind
+from sewing_app.extensions import db, bcrypt
+from sewing_app.hashing import check_password
+
+
+class FabricsField(Field):
+    """Multiple select of fabrics that only ever loads the selected fabrics.
+
+    The options are not rendered up front; the typeahead in fabric_picker.js
+    adds them from the /api/fabrics lookup. The submitted ids are loaded with
+    a single IN query, and unknown ids fail validation.
+    """
+    widget = Select(multiple=True)
+
+    def __init__(self, label=None, validators=None, **kwargs):
+        super(FabricsField, self).__init__(label, validators, **kwargs)
+        self._invalid_formdata = False
+
+    def process_data(self, value):
+        self.data = list(value or [])
+
+    def process_formdata(self, valuelist):
+        try:
+            ids = {int(value) for value in valuelist if value}
+        except ValueError:
+            self.data = []
+            self._invalid_formdata = True
+            return
+
+        self.data = Fabric.query.filter(Fabric.id.in_(ids)).all() if ids else []
+        self._invalid_formdata = len(self.data) != len(ids)
+
+    def pre_validate(self, form):
+        if self._invalid_formdata:
+            raise ValidationError(self.gettext('Not a valid choice'))
+
+    def iter_choices(self):
+        for fabric in self.data:
+            yield (fabric.id, fabric.name, True)
 
 
 class FabricForm(FlaskForm):
@@ -16,18 +54,34 @@ class FabricForm(FlaskForm):
                                                     Length(min=2, max=80,
                                                            message="Your name needs to be between 2 and 80 chars")])
     quantity = FloatField('Fabric Quantity', validators=[
-        DataRequired(message="Quantity is required (no letters)")
+        DataRequired(message="Quantity is required (no letters)"),
+        NumberRange(min=0.01, max=9999999.99)
     ])
     photo_url = StringField('Fabric photo url', validators=[DataRequired(), Length(
         min=5, max=1000, message="Your message needs to be between 5 and 1000 characters")])
     submit = SubmitField('Submit')
 
 
+class YardageForm(FlaskForm):
+    """Form for recording yards cut from or purchased for a Fabric."""
+
+    kind = SelectField('Change', choices=[
+        (kind.name, kind) for kind in (YardageKind.CUT, YardageKind.PURCHASED)])
+    yards = DecimalField('Yards', places=2, validators=[
+        DataRequired(message="Yards are required (no letters)"),
+        NumberRange(min=0.01, max=999.99)])
+    # The route limits the choices to the patterns tagged with the fabric
+    pattern = QuerySelectField('For pattern', allow_blank=True,
+                               blank_text='No pattern', get_label='name')
+    note = StringField('Note', validators=[Optional(), Length(max=200)])
+    submit = SubmitField('Record')
+
+
 class PatternForm(FlaskForm):
     """Form for adding/updating a Pattern."""
 
     name = StringField('Pattern Name', validators=[DataRequired(), Length(
-        min=2, max=100, message="Your message needs to be between 2 and 100 characters")])
+        min=2, max=80, message="Your message needs to be between 2 and 80 characters")])
 
     category = SelectField('Pattern Category',
                            choices=PatternCategory.choices())
@@ -35,13 +89,7 @@ class PatternForm(FlaskForm):
     photo_url = StringField('Sewing Pattern photo url', validators=[DataRequired(), Length(
         min=5, max=1000, message="Your message needs to be between 5 and 1000 characters")])
 
-    def fabric_query():
-        """Retrieve all fabrics from the database."""
-        return Fabric.query.all()
-
-    # Assign the fabric_query function to the query_factory param of the QuerySelectMultipleField
-    fabrics = QuerySelectMultipleField('Fabrics for patterns',
-                                       query_factory=fabric_query, get_label='name')
+    fabrics = FabricsField('Fabrics for patterns')
     submit = SubmitField('Submit')
 
 
@@ -64,14 +112,24 @@ class LoginForm(FlaskForm):
     password = PasswordField('Password', validators=[DataRequired()])
     submit = SubmitField('Log In')
 
-    def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if not user:
-            raise ValidationError(
-                'No user with that username. Please try again.')
+    def validate(self):
+        """Validate the credentials with a single user lookup.
+
+        The matching user is kept on `self.user` for the login route.
+        """
+        self.user = None
+        if not super(LoginForm, self).validate():
+            return False
 
-    def validate_password(self, password):
         user = User.query.filter_by(username=self.username.data).first()
-        if user and not bcrypt.check_password_hash(
-                user.password, password.data):
-            raise ValidationError('Password doesn\'t match. Please try again.')
+        if not user:
+            self.username.errors.append(
+                'No user with that username. Please try again.')
+            return False
+        if not check_password(user.password, self.password.data):
+            self.password.errors.append(
+                'Password doesn\'t match. Please try again.')
+            return False
+
+        self.user = user
+        return True
@@ -0,0 +1,137 @@
+"""Versioned cache of rendered template fragments.
+
+Every fragment is cached under the current version of one or more named
+counters, e.g. 'catalog' for anything that shows fabrics or patterns and
+'fabrics_list:<user id>' for a user's fabrics list. Write routes call
+bump_version() for the counters they affect, so stale fragments are never
+served again and simply age out of the LRU.
+
+Templates cache a block with
+
+    {% cache 'catalog', 'fabric', fabric.id %}...{% endcache %}
+
+where the first argument is the counter and the rest is the key.
+"""
+import time
+from threading import Lock
+
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from sqlalchemy import event, select
+from sqlalchemy.dialects import postgresql
+
+from sewing_app.caching import FragmentCache, LazyCache
+from sewing_app.extensions import db
+from sewing_app.models import CacheVersion, insert_ignore
+
+fragment_cache = LazyCache(
+    lambda app: FragmentCache(app.config['FRAGMENT_CACHE_MAX_BYTES']))
+
+# Counter name -> (version, time after which it is read again)
+_versions = {}
+_versions_lock = Lock()
+
+
+def current_version(name):
+    """Return the current version of the counter `name`."""
+    now = time.monotonic()
+    memo = _versions.get(name)
+    if memo is not None and memo[1] > now:
+        return memo[0]
+    version = db.session.query(CacheVersion.version).filter_by(
+        name=name).scalar() or 0
+    with _versions_lock:
+        _versions[name] = (version, now + current_app.config['FRAGMENT_VERSION_TTL'])
+    return version
+
+
+def bump_version(*names):
+    """Invalidate the fragments cached under the counters `names`.
+
+    The new version is written in the current transaction, and this worker
+    forgets its copy once the transaction commits.
+    """
+    for name in names:
+        insert_ignore(CacheVersion.__table__, name=name, version=0)
+        CacheVersion.query.filter_by(name=name).update(
+            {CacheVersion.version: CacheVersion.version + 1},
+            synchronize_session=False)
+    db.session.info.setdefault('bumped_versions', set()).update(names)
+
+
+@event.listens_for(db.session, 'after_commit')
+def forget_bumped_versions(session):
+    with _versions_lock:
+        for name in session.info.pop('bumped_versions', ()):
+            _versions.pop(name, None)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_bumped_versions(session):
+    session.info.pop('bumped_versions', None)
+
+
+def next_version(name):
+    """Bump the counter `name` like bump_version() and return its new
+    version. The row stays locked until the transaction ends, so call this
+    as close to the commit as possible."""
+    table = CacheVersion.__table__
+    if db.session.get_bind().dialect.name == 'postgresql':
+        # One round trip: create or bump the row and read it back
+        statement = postgresql.insert(table).values(
+            name=name, version=1).on_conflict_do_update(
+            index_elements=[table.c.name],
+            set_=dict(version=table.c.version + 1)).returning(table.c.version)
+        version = db.session.execute(statement).scalar()
+    else:
+        insert_ignore(table, name=name, version=0)
+        db.session.execute(table.update().where(table.c.name == name).values(
+            version=table.c.version + 1))
+        version = db.session.execute(select([table.c.version]).where(
+            table.c.name == name)).scalar()
+    db.session.info.setdefault('bumped_versions', set()).add(name)
+    return version
+
+
+def cached_fragment(names, key, render):
+    """Return the fragment cached under `key` and the versions of `names`,
+    calling `render()` to build it on a miss."""
+    if not current_app.config['FRAGMENT_CACHE_MAX_BYTES']:
+        return Markup(render())
+    full_key = (tuple((name, current_version(name)) for name in names),
+                tuple(key))
+    html = fragment_cache.get(full_key)
+    if html is None:
+        html = str(render())
+        fragment_cache.set(full_key, html)
+    return Markup(html)
+
+
+def reset():
+    """Drop every cached fragment and version (used by tests)."""
+    fragment_cache.clear()
+    with _versions_lock:
+        _versions.clear()
+
+
+class FragmentCacheExtension(Extension):
+    """Adds the {% cache name, key... %}...{% endcache %} tag."""
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache', [nodes.List(args)]),
+                               [], [], body).set_lineno(lineno)
+
+    def _cache(self, args, caller):
+        return cached_fragment(args[:1], args[1:], caller)
+
+
+def init_app(app):
+    app.jinja_env.add_extension(FragmentCacheExtension)
@@ -0,0 +1,79 @@
+"""Password hashing in a bounded process pool.
+
+bcrypt is deliberately slow, so hashing and checking run in a pool of
+BCRYPT_POOL_SIZE worker processes instead of the request thread. The pool
+is created lazily in each process, which keeps it fork-safe for gunicorn.
+Set BCRYPT_POOL_SIZE to 0 to hash inline (e.g. in tests). Every gunicorn
+worker has its own pool, so the default splits the CPUs between the
+WEB_CONCURRENCY workers. Each operation holds an admission slot, so
+requests beyond ADMISSION_MAX_HASHING are turned away instead of queueing
+for the pool, and one still waiting after BCRYPT_TIMEOUT gets the same 429.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import Lock
+
+import bcrypt
+from flask import current_app
+
+from sewing_app.admission import hashing_slot, shed
+
+_pool = None
+_pool_pid = None
+_pool_lock = Lock()
+
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _checkpw(password, pw_hash):
+    try:
+        return bcrypt.checkpw(password, pw_hash)
+    except ValueError:
+        # Not a valid bcrypt hash
+        return False
+
+
+def _get_pool(size):
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=size)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _run(fn, *args):
+    """Run `fn` in the hashing pool and wait for its result."""
+    size = current_app.config['BCRYPT_POOL_SIZE']
+    with hashing_slot():
+        if not size:
+            return fn(*args)
+        future = _get_pool(size).submit(fn, *args)
+        try:
+            return future.result(timeout=current_app.config['BCRYPT_TIMEOUT'])
+        except TimeoutError:
+            # The pool is backed up; don't leave the work queued behind us
+            future.cancel()
+            raise shed('timeout', current_app.config['BCRYPT_TIMEOUT'])
+
+
+def hash_password(password):
+    """Return the bcrypt hash of `password` at the configured cost."""
+    return _run(_hashpw, password.encode('utf-8'),
+                current_app.config['BCRYPT_LOG_ROUNDS'])
+
+
+def check_password(pw_hash, password):
+    """Return whether `password` matches the bcrypt hash `pw_hash`."""
+    return _run(_checkpw, password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+
+def needs_rehash(pw_hash):
+    """Return whether `pw_hash` was made with a different cost than configured."""
+    try:
+        rounds = int(pw_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+    return rounds != current_app.config['BCRYPT_LOG_ROUNDS']
@@ -0,0 +1,390 @@
+"""Streaming bulk import of fabrics and patterns from CSV or JSONL.
+
+Rows are read one at a time, checked with the validators of FabricForm and
+PatternForm (without building a form per row) and against the lengths and
+precision of the columns they go into, and inserted in batches, each
+batch in its own transaction. Memory use is bounded by the batch size,
+whatever the size of the input. Lines that are not UTF-8 or not valid CSV
+or JSON are reported as row errors like any other.
+
+Fabric rows have name, color, quantity and photo_url. Pattern rows have
+name, category, photo_url and fabrics: the names of the fabrics to tag,
+separated by '|' in CSV files or as a list in JSONL files.
+"""
+import codecs
+import csv
+import json
+from collections import Counter
+from datetime import datetime
+from decimal import Decimal
+
+from flask import current_app
+from sqlalchemy import Numeric, String, bindparam, func
+from wtforms.validators import StopValidation, ValidationError
+
+from sewing_app.cooccurrence import patterns_changed
+from sewing_app.extensions import db
+from sewing_app.forms import FabricForm, PatternForm
+from sewing_app.fragments import bump_version
+from sewing_app.ledger import open_balances
+from sewing_app.matcher import tags_changed
+from sewing_app.photo_checks import check_later
+from sewing_app.models import Fabric, Pattern, PatternCategory, fabrics_patterns
+from sewing_app.search import index_for
+from sewing_app.summaries import fabrics_changed, snapshot
+from sewing_app.thumbnails import register_urls
+
+FORMATS = ('csv', 'jsonl')
+
+# Lowercase PatternForm.category choice -> choice
+CATEGORY_CHOICES = {choice.lower(): choice
+                    for choice, label in PatternCategory.choices()}
+
+# Only the first errors are reported in full; the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+
+
+class ImportReport(object):
+    """Outcome of an import, with the errors of every rejected row."""
+
+    def __init__(self):
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def add_error(self, line, errors):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(dict(line=line, errors=errors))
+
+    def as_dict(self):
+        # Unknown fabric names are only found when a batch is flushed
+        return dict(inserted=self.inserted, failed=self.failed,
+                    errors=sorted(self.errors, key=lambda error: error['line']))
+
+
+def guess_format(filename=None, content_type=None):
+    """Return 'csv' or 'jsonl' for an upload, or None when unknown."""
+    filename = (filename or '').lower()
+    content_type = content_type or ''
+    if filename.endswith('.csv') or 'csv' in content_type:
+        return 'csv'
+    if filename.endswith(('.jsonl', '.ndjson')) or 'json' in content_type:
+        return 'jsonl'
+    return None
+
+
+def _decode_lines(stream, bad_lines):
+    """Yield the lines of a binary stream decoded as UTF-8.
+
+    Lines that are not UTF-8 are decoded with replacement characters, so a
+    CSV reader keeps its place, and their numbers appended to `bad_lines`.
+    """
+    for line_num, line in enumerate(stream, start=1):
+        if line_num == 1 and line.startswith(codecs.BOM_UTF8):
+            line = line[len(codecs.BOM_UTF8):]
+        try:
+            yield line.decode('utf-8')
+        except UnicodeDecodeError:
+            bad_lines.append(line_num)
+            yield line.decode('utf-8', 'replace')
+
+
+def _read_csv(lines, bad_lines):
+    reader = csv.DictReader(lines)
+    try:
+        reader.fieldnames
+    except csv.Error as error:
+        yield reader.line_num, None, 'Invalid CSV: %s' % error
+        return
+    if bad_lines:
+        yield 1, None, 'The header is not valid UTF-8'
+        return
+
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as error:
+            yield reader.line_num, None, 'Invalid CSV: %s' % error
+            del bad_lines[:]
+            continue
+        if bad_lines:
+            # A quoted value may span lines; any of them being bad spoils it
+            yield reader.line_num, None, 'Invalid UTF-8'
+            del bad_lines[:]
+            continue
+        yield reader.line_num, row, None
+
+
+def read_rows(stream, fmt):
+    """Yield (line number, row dict or None, error or None) from a binary
+    stream of UTF-8 text."""
+    bad_lines = []
+    lines = _decode_lines(stream, bad_lines)
+    if fmt == 'csv':
+        yield from _read_csv(lines, bad_lines)
+        return
+
+    for line_num, line in enumerate(lines, start=1):
+        if bad_lines:
+            yield line_num, None, 'Invalid UTF-8'
+            del bad_lines[:]
+            continue
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield line_num, None, 'Invalid JSON: %s' % error
+            continue
+        if not isinstance(row, dict):
+            yield line_num, None, 'Each line must be a JSON object'
+            continue
+        yield line_num, row, None
+
+
+###########################
+# Validation
+###########################
+
+class _RowField(object):
+    """Just enough of a WTForms field to run its validators on a raw value."""
+
+    def __init__(self, data):
+        self.data = data
+        self.raw_data = [data]
+        self.errors = []
+
+    def gettext(self, string):
+        return string
+
+    def ngettext(self, singular, plural, n):
+        return singular if n == 1 else plural
+
+
+def _check(form_class, name, value, errors):
+    """Run the validators of `form_class`'s field `name` on `value`."""
+    field = _RowField(value)
+    for validator in getattr(form_class, name).kwargs.get('validators', ()):
+        try:
+            validator(None, field)
+        except StopValidation as error:
+            if error.args and error.args[0]:
+                errors[name] = error.args[0]
+            return
+        except ValidationError as error:
+            errors[name] = error.args[0]
+            return
+
+
+def _text(row, name):
+    value = row.get(name)
+    return '' if value is None else str(value).strip()
+
+
+def _check_columns(table, values, errors):
+    """Reject values that `table`'s columns cannot hold, so one bad row is
+    reported instead of failing its whole batch."""
+    for name, value in values.items():
+        if name in errors or value is None:
+            continue
+        column_type = table.c[name].type
+        if isinstance(column_type, String) and column_type.length:
+            if len(value) > column_type.length:
+                errors[name] = ('Field cannot be longer than %d characters.'
+                                % column_type.length)
+        elif isinstance(column_type, Numeric) and column_type.precision:
+            scale = column_type.scale or 0
+            step = Decimal(1).scaleb(-scale)
+            largest = Decimal(10) ** (column_type.precision - scale) - step
+            if abs(Decimal(str(value)).quantize(step)) > largest:
+                errors[name] = 'Number must be at most %s.' % largest
+
+
+def validate_fabric(row):
+    """Return (column values, errors) for a fabric row."""
+    errors = {}
+    values = dict(name=_text(row, 'name'), color=_text(row, 'color'),
+                  photo_url=_text(row, 'photo_url'))
+    for name, value in values.items():
+        _check(FabricForm, name, value, errors)
+
+    # FloatField coerces before its validators run
+    try:
+        values['quantity'] = float(_text(row, 'quantity'))
+    except ValueError:
+        values['quantity'] = None
+    _check(FabricForm, 'quantity', values['quantity'], errors)
+    if values['quantity'] is None and 'quantity' not in errors:
+        errors['quantity'] = 'Not a valid float value'
+    _check_columns(Fabric.__table__, values, errors)
+    return values, errors
+
+
+def validate_pattern(row):
+    """Return (column values, fabric names, errors) for a pattern row."""
+    errors = {}
+    values = dict(name=_text(row, 'name'), photo_url=_text(row, 'photo_url'))
+    for name, value in values.items():
+        _check(PatternForm, name, value, errors)
+
+    category = _text(row, 'category') or PatternCategory.OTHER.name
+    values['category'] = CATEGORY_CHOICES.get(category.lower())
+    if values['category'] is None:
+        errors['category'] = 'Not a valid choice'
+    _check_columns(Pattern.__table__, values, errors)
+
+    fabric_names = row.get('fabrics') or []
+    if isinstance(fabric_names, str):
+        fabric_names = fabric_names.split('|')
+    fabric_names = [str(name).strip() for name in fabric_names
+                    if str(name).strip()]
+    return values, fabric_names, errors
+
+
+###########################
+# Inserting
+###########################
+
+def insert_returning_ids(table, rows):
+    """Insert `rows` into `table` and return their new ids, in order."""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        # One multi-row INSERT ... RETURNING per batch
+        result = db.session.execute(
+            table.insert().values(rows).returning(table.c.id))
+        return [row_id for row_id, in result]
+
+    # SQLite has no multi-row RETURNING here and rowids need not be
+    # contiguous (AUTOINCREMENT, or ids freed by deletes), so take each
+    # row's id from its own insert; the inserts are in-process and cheap
+    statement = table.insert()
+    return [db.session.execute(statement, row).lastrowid for row in rows]
+
+
+def _index(documents):
+    connection = db.session.connection()
+    index = index_for(connection)
+    if index is not None:
+        index.insert(connection, documents)
+
+
+def _flush_fabrics(batch, user_id, report):
+    now = datetime.utcnow()
+    rows = [dict(values, created_by_id=user_id, pattern_count=0,
+                 updated_at=now) for line, values in batch]
+    ids = insert_returning_ids(Fabric.__table__, rows)
+    _index([('fabric', fabric_id, row['name'], row['color'], '')
+            for fabric_id, row in zip(ids, rows)])
+    open_balances(ids)
+    fabrics_changed(ids)
+    register_urls(row['photo_url'] for row in rows)
+    check_later(row['photo_url'] for row in rows)
+    bump_version('catalog')
+    db.session.commit()
+    report.inserted += len(rows)
+
+
+def _flush_patterns(batch, user_id, report):
+    # Resolve every fabric name in the batch with one query; the oldest
+    # fabric wins when several share a name
+    names = {name for line, values, fabric_names in batch
+             for name in fabric_names}
+    fabric_ids = {}
+    if names:
+        query = db.session.query(Fabric.name, func.min(Fabric.id)).filter(
+            Fabric.name.in_(bindparam('names', expanding=True))
+        ).group_by(Fabric.name)
+        fabric_ids = dict(query.params(names=list(names)))
+
+    now = datetime.utcnow()
+    rows, tags = [], []
+    for line, values, fabric_names in batch:
+        unknown = [name for name in fabric_names if name not in fabric_ids]
+        if unknown:
+            report.add_error(line, {'fabrics': 'Unknown fabrics: %s'
+                                    % ', '.join(unknown)})
+            continue
+        tagged = sorted({fabric_ids[name] for name in fabric_names})
+        rows.append(dict(values, created_by_id=user_id,
+                         fabric_count=len(tagged), updated_at=now))
+        tags.append(tagged)
+    if not rows:
+        return
+
+    ids = insert_returning_ids(Pattern.__table__, rows)
+    tag_rows = [dict(fabric_id=fabric_id, pattern_id=pattern_id)
+                for pattern_id, tagged in zip(ids, tags)
+                for fabric_id in tagged]
+    if tag_rows:
+        counts = Counter(row['fabric_id'] for row in tag_rows)
+        before = snapshot(counts)
+        db.session.execute(fabrics_patterns.insert(), tag_rows)
+        db.session.execute(
+            Fabric.__table__.update()
+            .where(Fabric.__table__.c.id == bindparam('fabric_id'))
+            .values(pattern_count=Fabric.__table__.c.pattern_count +
+                    bindparam('added'), updated_at=now),
+            [dict(fabric_id=fabric_id, added=added)
+             for fabric_id, added in counts.items()])
+        tags_changed((row['fabric_id'], row['pattern_id'])
+                     for row in tag_rows)
+        fabrics_changed(counts, before)
+        patterns_changed(ids)
+    _index([('pattern', pattern_id, row['name'], '',
+             str(PatternCategory[row['category']]))
+            for pattern_id, row in zip(ids, rows)])
+    register_urls(row['photo_url'] for row in rows)
+    check_later(row['photo_url'] for row in rows)
+    bump_version('catalog')
+    db.session.commit()
+    report.inserted += len(rows)
+
+
+def import_fabrics(rows, user_id=None, batch_size=None):
+    """Import fabrics from read_rows() output and return an ImportReport."""
+    batch_size = batch_size or current_app.config['IMPORT_BATCH_SIZE']
+    report, batch = ImportReport(), []
+    for line, row, error in rows:
+        if error:
+            report.add_error(line, {'row': error})
+            continue
+        values, errors = validate_fabric(row)
+        if errors:
+            report.add_error(line, errors)
+            continue
+        batch.append((line, values))
+        if len(batch) >= batch_size:
+            _flush_fabrics(batch, user_id, report)
+            batch = []
+    if batch:
+        _flush_fabrics(batch, user_id, report)
+    return report
+
+
+def import_patterns(rows, user_id=None, batch_size=None):
+    """Import patterns from read_rows() output and return an ImportReport."""
+    batch_size = batch_size or current_app.config['IMPORT_BATCH_SIZE']
+    report, batch = ImportReport(), []
+    for line, row, error in rows:
+        if error:
+            report.add_error(line, {'row': error})
+            continue
+        values, fabric_names, errors = validate_pattern(row)
+        if errors:
+            report.add_error(line, errors)
+            continue
+        batch.append((line, values, fabric_names))
+        if len(batch) >= batch_size:
+            _flush_patterns(batch, user_id, report)
+            batch = []
+    if batch:
+        _flush_patterns(batch, user_id, report)
+    return report
+
+
+IMPORTERS = {
+    'fabrics': import_fabrics,
+    'patterns': import_patterns,
+}
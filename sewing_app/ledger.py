@@ -0,0 +1,225 @@
+"""Append-only yardage ledger.
+
+Every change of a fabric's yardage is a YardageEntry: cut for a pattern,
+purchased, or adjusted (a new fabric's starting quantity, or an edit of
+the quantity on the fabric form). Entries are only ever inserted, so two
+people recording cuts at once both count, where overwriting one quantity
+lost one of them.
+
+The balance of a fabric is its YardageSnapshot plus the entries after it,
+read together in one indexed query. take_snapshots() (`flask
+snapshot-yardage`, run it periodically) folds the entries into the
+snapshots, so the tail stays short. It only folds entries older than
+YARDAGE_SNAPSHOT_LAG seconds, so a transaction still open when it runs
+does not commit an entry behind its snapshot.
+
+Fabric.quantity is a cached copy of the balance for the listings, the
+export and the dashboard summaries. record() updates it relative to its
+current value in the same transaction as the entry, refusing a change that
+would take the balance below zero or past MAX_BALANCE. So writes are not
+conflict-free: the UPDATE holds the fabric's row lock until the commit,
+and concurrent writers of the same fabric queue on it (writers of other
+fabrics don't). That lock is what makes the range check safe; checking
+the snapshot and tail before a plain insert would let two cuts at once
+both take the last yards. Quantity changes made through the ORM are
+turned into adjustments by a flush listener, and rows inserted with Core
+get their opening entries from open_balances().
+"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from flask import current_app
+from sqlalchemy import and_, bindparam, event, exists, func, inspect, \
+    literal, select
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql.elements import ClauseElement
+
+from sewing_app import summaries
+from sewing_app.extensions import db
+from sewing_app.models import Fabric, YardageEntry, YardageKind, \
+    YardageSnapshot, insert_ignore_many
+
+entries = YardageEntry.__table__
+snapshots = YardageSnapshot.__table__
+fabrics = Fabric.__table__
+
+CENT = Decimal('0.01')
+OPENING_NOTE = 'Starting quantity'
+# Largest balance Fabric.quantity holds
+MAX_BALANCE = Decimal('9999999.99')
+
+
+class YardageError(ValueError):
+    """A change would take a fabric's balance out of range."""
+
+
+def yards(value):
+    """Return `value` as a Decimal rounded to the cent."""
+    return Decimal(str(value)).quantize(CENT)
+
+
+def record(fabric, kind, change, user_id=None, pattern_id=None, note=None):
+    """Append an entry of `change` yards to the ledger of `fabric` and
+    update its cached quantity. Raises YardageError, recording nothing, if
+    the balance would drop below zero or exceed MAX_BALANCE.
+
+    Locks the fabric's row until the transaction ends, so commit soon.
+    """
+    change = yards(change)
+    if not change:
+        return
+    now = datetime.utcnow()
+    before = summaries.snapshot([fabric.id])
+    # Checked and applied in one statement, so concurrent cuts can't both
+    # take the last yards
+    updated = db.session.execute(
+        fabrics.update().where(and_(
+            fabrics.c.id == fabric.id,
+            fabrics.c.quantity + change >= 0,
+            fabrics.c.quantity + change <= MAX_BALANCE))
+        .values(quantity=fabrics.c.quantity + change, updated_at=now))
+    db.session.expire(fabric, ['quantity', 'updated_at'])
+    if not updated.rowcount:
+        if change < 0:
+            raise YardageError('Only %s yards of this fabric are left.'
+                               % balance(fabric.id))
+        raise YardageError('The balance cannot exceed %s yards.'
+                           % MAX_BALANCE)
+    db.session.execute(entries.insert().values(
+        fabric_id=fabric.id, kind=kind, change=change, pattern_id=pattern_id,
+        note=note, created_by_id=user_id, created_at=now))
+    summaries.fabrics_changed([fabric.id], before)
+
+
+def open_balances(fabric_ids=None):
+    """Give the fabrics without any entry (of `fabric_ids`, or all) an
+    adjustment of their current quantity, e.g. after Core inserts."""
+    kind = literal(YardageKind.ADJUSTED, entries.c.kind.type)
+    query = select([fabrics.c.id, kind, fabrics.c.quantity,
+                    literal(OPENING_NOTE, entries.c.note.type),
+                    literal(datetime.utcnow(), entries.c.created_at.type)]) \
+        .where(~exists().where(entries.c.fabric_id == fabrics.c.id))
+    if fabric_ids is not None:
+        query = query.where(fabrics.c.id.in_(list(fabric_ids)))
+    db.session.execute(entries.insert().from_select(
+        ['fabric_id', 'kind', 'change', 'note', 'created_at'], query))
+
+
+def balances(fabric_ids):
+    """Return fabric id -> balance from the snapshots and their tails."""
+    fabric_ids = list(fabric_ids)
+    if not fabric_ids:
+        return {}
+    query = select([
+        fabrics.c.id,
+        func.coalesce(snapshots.c.balance, 0) +
+        func.coalesce(func.sum(entries.c.change), 0),
+    ]).select_from(
+        fabrics.outerjoin(snapshots, snapshots.c.fabric_id == fabrics.c.id)
+        .outerjoin(entries, and_(
+            entries.c.fabric_id == fabrics.c.id,
+            entries.c.id > func.coalesce(snapshots.c.entry_id, 0)))
+    ).where(fabrics.c.id.in_(fabric_ids)).group_by(
+        fabrics.c.id, snapshots.c.balance)
+    return {fabric_id: yards(balance)
+            for fabric_id, balance in db.session.execute(query)}
+
+
+def balance(fabric_id):
+    """Return the balance of one fabric."""
+    return balances([fabric_id]).get(fabric_id)
+
+
+def history(fabric_id, limit=None):
+    """Return the latest entries of a fabric, newest first."""
+    limit = limit or current_app.config['YARDAGE_HISTORY_SHOWN']
+    return YardageEntry.query.options(
+        joinedload(YardageEntry.pattern), joinedload(YardageEntry.created_by)
+    ).filter_by(fabric_id=fabric_id).order_by(
+        YardageEntry.id.desc()).limit(limit).all()
+
+
+def take_snapshots(lag=None):
+    """Fold the entries older than `lag` seconds (YARDAGE_SNAPSHOT_LAG)
+    into the snapshots and return the number of fabrics updated."""
+    lag = current_app.config['YARDAGE_SNAPSHOT_LAG'] if lag is None else lag
+    cutoff = datetime.utcnow() - timedelta(seconds=lag)
+    upto = db.session.query(func.max(entries.c.id)).filter(
+        entries.c.created_at <= cutoff).scalar()
+    if upto is None:
+        return 0
+    previous = func.coalesce(snapshots.c.entry_id, 0)
+    tails = db.session.execute(
+        select([entries.c.fabric_id, previous, func.sum(entries.c.change),
+                func.max(entries.c.id)])
+        .select_from(entries.outerjoin(
+            snapshots, snapshots.c.fabric_id == entries.c.fabric_id))
+        .where(and_(entries.c.id > previous, entries.c.id <= upto))
+        .group_by(entries.c.fabric_id, previous)).fetchall()
+    if not tails:
+        return 0
+
+    now = datetime.utcnow()
+    insert_ignore_many(snapshots, [
+        dict(fabric_id=fabric_id, entry_id=0, balance=0, taken_at=now)
+        for fabric_id, _, _, _ in tails])
+    # Only moves a snapshot still where this run found it, so two runs at
+    # once cannot add the same tail twice
+    db.session.execute(
+        snapshots.update().where(and_(
+            snapshots.c.fabric_id == bindparam('snapshot_fabric_id'),
+            snapshots.c.entry_id == bindparam('previous_id')))
+        .values(balance=snapshots.c.balance + bindparam('tail'),
+                entry_id=bindparam('last_id'), taken_at=now),
+        [dict(snapshot_fabric_id=fabric_id, previous_id=previous_id,
+              tail=yards(tail), last_id=last_id)
+         for fabric_id, previous_id, tail, last_id in tails])
+    return len(tails)
+
+
+###########################
+# ORM changes
+###########################
+
+@event.listens_for(db.session, 'before_flush')
+def collect_quantity_changes(session, flush_context, instances):
+    changes = []
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Fabric) or obj in session.deleted:
+            continue
+        if obj in session.new:
+            if obj.quantity is not None:
+                changes.append((obj, yards(obj.quantity), True))
+            continue
+        quantity = inspect(obj).attrs.quantity.history
+        if not quantity.added or \
+                isinstance(quantity.added[0], ClauseElement):
+            continue
+        old = quantity.deleted[0] if quantity.deleted else \
+            session.query(Fabric.quantity).filter_by(id=obj.id).scalar()
+        change = yards(quantity.added[0]) - yards(old)
+        if change:
+            # Written relative to the stored value, so concurrent changes
+            # add up
+            obj.quantity = Fabric.quantity + change
+            changes.append((obj, change, False))
+    if changes:
+        session.info.setdefault('yardage_changes', []).extend(changes)
+
+
+@event.listens_for(db.session, 'after_flush')
+def record_quantity_changes(session, flush_context):
+    changes = session.info.pop('yardage_changes', ())
+    now = datetime.utcnow()
+    rows = [dict(fabric_id=fabric.id, kind=YardageKind.ADJUSTED,
+                 change=change, note=OPENING_NOTE if opening else None,
+                 created_by_id=fabric.created_by_id if opening else None,
+                 created_at=now)
+            for fabric, change, opening in changes]
+    if rows:
+        session.execute(entries.insert(), rows)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_quantity_changes(session):
+    session.info.pop('yardage_changes', None)
@@ -0,0 +1,298 @@
+"""Match saved patterns to owned fabric: "what can I sew from my stash".
+
+Each process keeps
+  - the fabric ids tagged on every pattern, versioned by the 'tags' counter,
+  - for recently active users, the ids on their fabrics list and patterns
+    list, versioned by the 'fabrics_list:<id>' and 'patterns_list:<id>'
+    counters that also key their cached fragments (see fragments.py),
+so matching a user is a set intersection per saved pattern, without
+touching fabrics_patterns.
+
+Writers record what they changed with list_changed(), and tag changes made
+through the ORM are recorded by a flush listener. Just before the
+transaction commits, each counter it changed is bumped once, so the row
+lock the bump takes is held for no longer than the commit itself. Once
+it commits, this process applies the change to its copy in place when
+that copy was up to date, instead of reloading it. Other processes see a
+newer counter and reload the user's lists. Tag changes are also written
+to the tag_change table under the version they bumped the counter to, so
+other processes apply the ones they missed to their tags instead of
+reloading fabrics_patterns; only a process more than
+MATCHER_TAG_CHANGES_KEPT versions behind reloads.
+"""
+from collections import namedtuple
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import event, inspect, select
+
+from sewing_app.caching import LRUCache, LazyCache
+from sewing_app.extensions import db
+from sewing_app.fragments import current_version, next_version
+from sewing_app.models import TagChange, fabrics_list, \
+    fabrics_patterns, patterns_list, tag_changes
+
+Match = namedtuple('Match', 'pattern_id owned needed missing')
+
+TAGS = 'tags'
+
+LISTS = {
+    'fabrics': (fabrics_list, 'fabric_id'),
+    'patterns': (patterns_list, 'pattern_id'),
+}
+
+
+class IdSet(object):
+    """The ids on one user's list at a counter version."""
+
+    def __init__(self, version, ids):
+        self.version = version
+        self.ids = frozenset(ids)
+
+    def apply(self, changes):
+        ids = set(self.ids)
+        for added, item_id in changes:
+            if added:
+                ids.add(item_id)
+            else:
+                ids.discard(item_id)
+        # Replaced rather than changed, as other threads may be matching
+        self.ids = frozenset(ids)
+
+
+class TagIndex(object):
+    """Pattern id -> frozenset of the ids of its fabrics."""
+
+    def __init__(self, version, pairs):
+        self.version = version
+        tags = {}
+        for fabric_id, pattern_id in pairs:
+            tags.setdefault(pattern_id, set()).add(fabric_id)
+        self.tags = {pattern_id: frozenset(fabric_ids)
+                     for pattern_id, fabric_ids in tags.items()}
+
+    def apply(self, changes):
+        for added, fabric_id, pattern_id in changes:
+            fabric_ids = set(self.tags.get(pattern_id, ()))
+            if added:
+                fabric_ids.add(fabric_id)
+            else:
+                fabric_ids.discard(fabric_id)
+            if fabric_ids:
+                self.tags[pattern_id] = frozenset(fabric_ids)
+            else:
+                self.tags.pop(pattern_id, None)
+
+
+_tags = None
+_tags_lock = Lock()
+# Counter name -> IdSet
+_lists = LazyCache(
+    lambda app: LRUCache(maxsize=current_app.config['MATCHER_CACHE_SIZE']))
+
+
+def _counter(kind, user_id):
+    return '%s_list:%d' % (kind, user_id)
+
+
+def _tag_ids(changes):
+    """Return tag changes made of fabrics and patterns or their ids as
+    (added, fabric id, pattern id) tuples."""
+    return [(added, _identity(fabric), _identity(pattern))
+            for added, fabric, pattern in changes]
+
+
+def _identity(obj):
+    if isinstance(obj, int):
+        return obj
+    # Objects only get an identity once their flush is over, and lose their
+    # loaded attributes at commit
+    identity = inspect(obj).identity
+    return obj.id if identity is None else identity[0]
+
+
+def _catch_up(index, version):
+    """Apply the tag changes logged since `index`'s version up to `version`
+    to it, returning None when the log no longer has them all."""
+    before = index.version
+    if version < before:
+        return None
+    table = TagChange.__table__
+    rows = db.session.execute(select([table.c.changes]).where(
+        table.c.version > before).where(table.c.version <= version).order_by(
+        table.c.version)).fetchall()
+    if len(rows) != version - before:
+        return None
+    with _tags_lock:
+        # Another thread may have caught up meanwhile
+        if index.version == before:
+            for changes, in rows:
+                index.apply(changes)
+            index.version = version
+    return index if index.version == version else None
+
+
+def _tag_index():
+    global _tags
+    version = current_version(TAGS)
+    index = _tags
+    if index is not None and index.version != version:
+        index = _catch_up(index, version)
+    if index is None:
+        pairs = db.session.execute(select([fabrics_patterns.c.fabric_id,
+                                           fabrics_patterns.c.pattern_id]))
+        index = TagIndex(version, pairs)
+        with _tags_lock:
+            _tags = index
+    return index
+
+
+def _list_ids(kind, user_id):
+    name = _counter(kind, user_id)
+    version = current_version(name)
+    index = _lists.get(name)
+    if index is None or index.version != version:
+        table, column = LISTS[kind]
+        ids = db.session.execute(select([table.c[column]]).where(
+            table.c.user_id == user_id))
+        index = IdSet(version, (item_id for item_id, in ids))
+        _lists.set(name, index)
+    return index.ids
+
+
+def match(user_id):
+    """Return the saved patterns of a user that can be made, at least in
+    part, from their fabrics list, as (full, partial) lists of Match.
+
+    Full matches are ordered by pattern id. Partial matches come with the
+    ids of the missing fabrics, the most complete first.
+    """
+    tags = _tag_index().tags
+    owned = _list_ids('fabrics', user_id)
+    full, partial = [], []
+    for pattern_id in _list_ids('patterns', user_id):
+        needed = tags.get(pattern_id)
+        if not needed:
+            continue
+        have = needed & owned
+        if len(have) == len(needed):
+            full.append(Match(pattern_id, len(have), len(needed), []))
+        elif have:
+            partial.append(Match(pattern_id, len(have), len(needed),
+                                 sorted(needed - have)))
+    full.sort(key=lambda m: m.pattern_id)
+    partial.sort(key=lambda m: (-m.owned / m.needed, len(m.missing),
+                                m.pattern_id))
+    return full, partial
+
+
+###########################
+# Recording changes
+###########################
+
+def _record(name, changes):
+    """Keep `changes` (None to reload) to the counter `name` until the
+    transaction ends."""
+    pending = db.session.info.setdefault('matcher_changes', {})
+    if name not in pending:
+        pending[name] = None if changes is None else list(changes)
+    elif pending[name] is not None and changes is not None:
+        pending[name].extend(changes)
+    else:
+        pending[name] = None
+
+
+def list_changed(user_id, kind, item_ids, added):
+    """Record that the fabrics or patterns (`kind`) `item_ids` were added
+    to or removed from a user's list; invalidates its cached fragments."""
+    _record(_counter(kind, user_id),
+            [(added, item_id) for item_id in item_ids])
+
+
+def tags_changed(added):
+    """Record that the (fabric id, pattern id) pairs `added` were inserted
+    into fabrics_patterns behind the ORM's back."""
+    _record(TAGS, [(True, fabric_id, pattern_id)
+                   for fabric_id, pattern_id in added])
+
+
+@event.listens_for(db.session, 'before_flush')
+def record_tag_changes(session, flush_context, instances):
+    added, removed = tag_changes(session)
+    if added or removed:
+        _record(TAGS,
+                [(True, fabric, pattern) for fabric, pattern in added] +
+                [(False, fabric, pattern) for fabric, pattern in removed])
+
+
+@event.listens_for(db.session, 'before_commit')
+def bump_counters(session):
+    """Bump the counters of the recorded changes and write the tag log.
+
+    The last changes are flushed first so their tag changes are recorded
+    and their new fabrics and patterns have ids.
+    """
+    session.flush()
+    pending = session.info.pop('matcher_changes', None)
+    if not pending:
+        return
+    bumped = session.info.setdefault('matcher_versions', {})
+    # Always in the same order, so two writers can't deadlock on them
+    for name in sorted(pending):
+        changes = pending[name]
+        version = next_version(name)
+        if name == TAGS:
+            changes = _tag_ids(changes)
+            _write_tag_log(session, version, changes)
+        bumped[name] = (version - 1, version, changes)
+
+
+def _write_tag_log(session, version, changes):
+    """Log the tag `changes` under `version` and forget the ones no process
+    should still need."""
+    table = TagChange.__table__
+    session.execute(table.insert().values(
+        version=version, changes=[list(change) for change in changes]))
+    session.execute(table.delete().where(
+        table.c.version <=
+        version - current_app.config['MATCHER_TAG_CHANGES_KEPT']))
+
+
+@event.listens_for(db.session, 'after_commit')
+def apply_changes(session):
+    global _tags
+    for name, (before, after, changes) in \
+            session.info.pop('matcher_versions', {}).items():
+        if name == TAGS:
+            with _tags_lock:
+                if _tags is None:
+                    continue
+                if changes is None or _tags.version != before:
+                    _tags = None
+                    continue
+                _tags.apply(changes)
+                _tags.version = after
+            continue
+
+        index = _lists.get(name)
+        if index is None:
+            continue
+        if changes is None or index.version != before:
+            _lists.delete(name)
+            continue
+        index.apply(changes)
+        index.version = after
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_changes(session):
+    session.info.pop('matcher_changes', None)
+    session.info.pop('matcher_versions', None)
+
+
+def reset():
+    """Forget every index (used by tests)."""
+    global _tags
+    with _tags_lock:
+        _tags = None
+    _lists.clear()
@@ -0,0 +1,217 @@
+"""Per-request SQL and template render instrumentation.
+
+With METRICS_ENABLED, every request to the main and auth blueprints counts
+and times its SQL statements (engine events) and its template rendering,
+and
+  - answers with a Server-Timing header (sql, render and total),
+  - logs a warning when it takes SLOW_REQUEST_SECONDS or more,
+  - is added to the per-endpoint histograms served by /metrics in the
+    Prometheus text format.
+
+Render time includes the queries issued while rendering, e.g. lazy loads
+from templates. The histograms are kept per process, so each gunicorn
+worker reports its own. Nothing is hooked into SQLAlchemy or Jinja until
+the first instrumented request, so with METRICS_ENABLED off the only cost
+is one config lookup per request.
+"""
+import time
+from threading import Lock
+
+from flask import current_app, g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+BLUEPRINTS = ('main', 'auth')
+
+_installed = False
+_install_lock = Lock()
+
+
+class RequestStats(object):
+    """SQL and render timings of the current request."""
+    __slots__ = ('start', 'queries', 'sql_time', 'render_time',
+                 'rendering', 'query_start')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.rendering = False
+        self.query_start = None
+
+
+def _stats():
+    return g.get('request_stats') if has_request_context() else None
+
+
+###########################
+# Histograms
+###########################
+
+class Histogram(object):
+    """Prometheus histogram with an `endpoint` label."""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # endpoint -> [count per bucket..., count above the last, sum]
+        self._values = {}
+        self._lock = Lock()
+
+    def observe(self, endpoint, value):
+        with self._lock:
+            values = self._values.get(endpoint)
+            if values is None:
+                values = self._values[endpoint] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+                    break
+            else:
+                values[len(self.buckets)] += 1
+            values[-1] += value
+
+    def lines(self):
+        yield '# HELP %s %s' % (self.name, self.help_text)
+        yield '# TYPE %s histogram' % self.name
+        with self._lock:
+            values = {endpoint: list(counts)
+                      for endpoint, counts in self._values.items()}
+        for endpoint, counts in sorted(values.items()):
+            label = endpoint.replace('\\', r'\\').replace('"', r'\"')
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield '%s_bucket{endpoint="%s",le="%s"} %d' % (
+                    self.name, label, le, cumulative)
+            yield '%s_sum{endpoint="%s"} %r' % (self.name, label, counts[-1])
+            yield '%s_count{endpoint="%s"} %d' % (self.name, label, cumulative)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+request_duration = Histogram('sewing_request_duration_seconds',
+                             'Time spent handling requests.', SECONDS)
+sql_duration = Histogram('sewing_request_sql_seconds',
+                         'Time spent in SQL statements per request.', SECONDS)
+render_duration = Histogram('sewing_request_render_seconds',
+                            'Time spent rendering templates per request.',
+                            SECONDS)
+query_count = Histogram('sewing_request_queries',
+                        'SQL statements issued per request.',
+                        (0, 1, 2, 5, 10, 20, 50, 100, 200))
+
+HISTOGRAMS = (request_duration, sql_duration, render_duration, query_count)
+
+
+def render():
+    """Return every histogram in the Prometheus text format."""
+    return ''.join(line + '\n' for histogram in HISTOGRAMS
+                   for line in histogram.lines())
+
+
+def reset():
+    """Drop every observation (used by tests)."""
+    for histogram in HISTOGRAMS:
+        histogram.clear()
+
+
+###########################
+# Hooks
+###########################
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    stats = _stats()
+    if stats is not None:
+        stats.query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = _stats()
+    if stats is not None and stats.query_start is not None:
+        stats.queries += 1
+        stats.sql_time += time.perf_counter() - stats.query_start
+        stats.query_start = None
+
+
+class TimedTemplate(Template):
+    """Template that adds its render time to the request's stats."""
+
+    def render(self, *args, **kwargs):
+        stats = _stats()
+        # Templates rendered while rendering are part of the outer one
+        if stats is None or stats.rendering:
+            return super().render(*args, **kwargs)
+        stats.rendering = True
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            stats.render_time += time.perf_counter() - start
+            stats.rendering = False
+
+
+def install(app):
+    """Hook the timers into SQLAlchemy (once per process) and into `app`'s
+    templates."""
+    global _installed
+    with _install_lock:
+        if not _installed:
+            event.listen(Engine, 'before_cursor_execute',
+                         _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+            _installed = True
+        if app.jinja_env.template_class is not TimedTemplate:
+            app.jinja_env.template_class = TimedTemplate
+            # Templates compiled so far are plain Templates
+            app.jinja_env.cache.clear()
+
+
+def start_request_stats():
+    if current_app.config['METRICS_ENABLED'] and request.blueprint in BLUEPRINTS:
+        install(current_app)
+        g.request_stats = RequestStats()
+
+
+def record_request_stats(response):
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return response
+
+    total = time.perf_counter() - stats.start
+    response.headers['Server-Timing'] = (
+        'sql;dur=%.1f;desc="%d queries", render;dur=%.1f, total;dur=%.1f'
+        % (stats.sql_time * 1000, stats.queries, stats.render_time * 1000,
+           total * 1000))
+
+    endpoint = request.endpoint
+    request_duration.observe(endpoint, total)
+    sql_duration.observe(endpoint, stats.sql_time)
+    render_duration.observe(endpoint, stats.render_time)
+    query_count.observe(endpoint, stats.queries)
+
+    if total >= current_app.config['SLOW_REQUEST_SECONDS']:
+        current_app.logger.warning(
+            'Slow request: %s %s took %.0f ms, %d queries in %.0f ms, '
+            'rendering %.0f ms', request.method, request.full_path,
+            total * 1000, stats.queries, stats.sql_time * 1000,
+            stats.render_time * 1000)
+    return response
+
+
+def init_app(app):
+    app.before_request(start_request_stats)
+    app.after_request(record_request_stats)
@@ -0,0 +1,248 @@
+"""Versioned schema migrations, applied by `flask upgrade-db`.
+
+Nothing creates or changes tables when the app starts. MIGRATIONS lists
+every change in order and upgrade() applies the ones a database has not
+had yet, each in its own transaction, recording it in schema_migrations.
+New changes are appended to MIGRATIONS with the next version.
+
+`create_all()` only creates missing tables, so tables that already exist
+are upgraded by the functions below. Each one checks the live schema first
+and can safely be run again, so databases made before schema_migrations
+existed simply get every migration.
+"""
+from datetime import datetime
+
+from sqlalchemy import MetaData, inspect, select, text
+from sqlalchemy.schema import CreateIndex
+
+from sewing_app import cooccurrence, ledger, summaries, thumbnails
+from sewing_app.extensions import db
+from sewing_app.fragments import bump_version
+from sewing_app.models import User, Fabric, FabricPair, Pattern, PhotoCheck, \
+    StashSummaryChange, TagChange, YardageEntry, YardageSnapshot, \
+    fabrics_patterns, patterns_list, fabrics_list, recount_tags
+from sewing_app.search import rebuild_index
+
+ASSOCIATION_TABLES = (fabrics_patterns, patterns_list, fabrics_list)
+
+# Migrations applied to the database
+schema_migrations = db.Table('schema_migrations',
+                             db.Column('version', db.Integer,
+                                       primary_key=True,
+                                       autoincrement=False),
+                             db.Column('name', db.String(80), nullable=False),
+                             db.Column('applied_at', db.DateTime,
+                                       nullable=False)
+                             )
+
+
+def _quote(connection, name):
+    # "user" is a reserved word in Postgres
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def add_missing_columns(connection, model, names, default=None):
+    """Add the columns `names` of `model` that its table doesn't have yet.
+
+    Existing rows get `default` (an SQL literal), or the column's server
+    default. Returns the added columns as 'table.column' names.
+    """
+    table = model.__table__
+    existing = {column['name']
+                for column in inspect(connection).get_columns(table.name)}
+    added = []
+    for name in names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        connection.execute(text(
+            'ALTER TABLE %s ADD COLUMN %s %s NOT NULL DEFAULT %s' % (
+                _quote(connection, table.name), name,
+                column.type.compile(dialect=connection.dialect),
+                default or column.server_default.arg)))
+        added.append('%s.%s' % (table.name, name))
+    return added
+
+
+def add_tag_counters(connection):
+    """Add Fabric.pattern_count and Pattern.fabric_count."""
+    return (add_missing_columns(connection, Fabric, ['pattern_count']) +
+            add_missing_columns(connection, Pattern, ['fabric_count']))
+
+
+def add_timestamps(connection):
+    """Add the updated_at columns, set to the time of the upgrade."""
+    added = []
+    for model in (Fabric, Pattern, User):
+        columns = add_missing_columns(connection, model, ['updated_at'],
+                                      default="'1970-01-01 00:00:00'")
+        if columns:
+            table = model.__table__
+            connection.execute(
+                table.update().values(updated_at=datetime.utcnow()))
+            connection.execute(text(
+                'CREATE INDEX IF NOT EXISTS ix_%s_updated_at ON %s (updated_at)'
+                % (table.name, _quote(connection, table.name))))
+            added += columns
+    return added
+
+
+def dedupe_association_tables(connection):
+    """Rebuild the association tables with their composite primary keys.
+
+    Duplicate and half-empty rows are dropped on the way. Tables that already
+    have a primary key are left alone. The rows are copied before the old
+    table is dropped, so an interrupted run never loses data. Returns the
+    names of rebuilt tables.
+    """
+    inspector = inspect(connection)
+    existing = inspector.get_table_names()
+    rebuilt = []
+    for table in ASSOCIATION_TABLES:
+        if table.name not in existing or \
+                inspector.get_pk_constraint(table.name)['constrained_columns']:
+            continue
+
+        # Build the new table in a scratch MetaData that knows the referenced
+        # tables, so it isn't picked up by create_all later
+        metadata = MetaData()
+        for referenced in (User.__table__, Fabric.__table__, Pattern.__table__):
+            referenced.tometadata(metadata)
+        new_table = table.tometadata(metadata, name='%s_new' % table.name)
+        new_table.drop(connection, checkfirst=True)
+        new_table.create(connection)
+        columns = ', '.join(column.name for column in table.columns)
+        not_null = ' AND '.join('%s IS NOT NULL' % column.name
+                                for column in table.columns)
+        connection.execute(text(
+            'INSERT INTO %s (%s) SELECT DISTINCT %s FROM %s WHERE %s'
+            % (new_table.name, columns, columns, table.name, not_null)))
+        connection.execute(text('DROP TABLE %s' % table.name))
+        connection.execute(text(
+            'ALTER TABLE %s RENAME TO %s' % (new_table.name, table.name)))
+        rebuilt.append(table.name)
+    return rebuilt
+
+
+def create_tables(connection):
+    """Create the tables that don't exist yet."""
+    # On the primary only, unlike db.create_all() which also does the binds
+    db.metadata.create_all(connection)
+
+
+def recount_and_reindex(connection):
+    """Recompute the tag counters, the search index and the thumbnails."""
+    # Counters of new columns start at 0 and duplicate tags counted twice
+    recount_tags()
+    rebuild_index()
+    thumbnails.register_all()
+    bump_version('catalog')
+
+
+def rebuild_stash_summaries(connection):
+    """Fill the stash dashboard summaries."""
+    summaries.rebuild()
+
+
+def create_photo_checks(connection):
+    """Add the table of the photo link checker."""
+    PhotoCheck.__table__.create(connection, checkfirst=True)
+
+
+def create_fabric_pairs(connection):
+    """Add and fill the fabric co-occurrence index."""
+    FabricPair.__table__.create(connection, checkfirst=True)
+    cooccurrence.rebuild()
+    bump_version('catalog')
+
+
+def create_yardage_ledger(connection):
+    """Add the yardage ledger, opened with every fabric's quantity."""
+    YardageEntry.__table__.create(connection, checkfirst=True)
+    YardageSnapshot.__table__.create(connection, checkfirst=True)
+    ledger.open_balances()
+    ledger.take_snapshots(lag=0)
+
+
+def create_summary_changes(connection):
+    """Add the table of the pending stash summary changes."""
+    StashSummaryChange.__table__.create(connection, checkfirst=True)
+
+
+def widen_yardage_columns(connection):
+    """Let Fabric.quantity and YardageEntry.change hold any ledger balance."""
+    # SQLite doesn't enforce the precision of NUMERIC columns
+    if connection.dialect.name != 'postgresql':
+        return
+    for column in (Fabric.__table__.c.quantity, YardageEntry.__table__.c.change):
+        connection.execute(text('ALTER TABLE %s ALTER COLUMN %s TYPE %s' % (
+            _quote(connection, column.table.name), column.name,
+            column.type.compile(dialect=connection.dialect))))
+
+
+def index_fabric_name_key(connection):
+    """Add the (name_key(name), id) index of the fabric typeahead."""
+    # Expression indexes are not reflected, so let the database check
+    index, = [index for index in Fabric.__table__.indexes
+              if index.name == 'ix_fabric_name_key_id']
+    ddl = str(CreateIndex(index).compile(dialect=connection.dialect))
+    connection.execute(text(ddl.replace(
+        'CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1)))
+
+
+def reindex_search_by_rowid(connection):
+    """Rebuild the search index, whose SQLite rows are now keyed by rowid."""
+    rebuild_index()
+
+
+def create_tag_changes(connection):
+    """Add the log of the tag changes read by the matchers of other
+    processes."""
+    TagChange.__table__.create(connection, checkfirst=True)
+
+
+# (version, migration) in the order they are applied. Never renumber or
+# remove one; append new ones at the end.
+MIGRATIONS = [
+    (1, create_tables),
+    (2, add_tag_counters),
+    (3, add_timestamps),
+    (4, dedupe_association_tables),
+    (5, recount_and_reindex),
+    (6, rebuild_stash_summaries),
+    (7, create_photo_checks),
+    (8, create_fabric_pairs),
+    (9, create_yardage_ledger),
+    (10, create_summary_changes),
+    (11, widen_yardage_columns),
+    (12, index_fabric_name_key),
+    (13, reindex_search_by_rowid),
+    (14, create_tag_changes),
+]
+
+
+def applied_versions():
+    """Return the versions of the migrations applied to the database."""
+    connection = db.session.connection()
+    if schema_migrations.name not in inspect(connection).get_table_names():
+        return set()
+    return {version for version, in connection.execute(
+        select([schema_migrations.c.version]))}
+
+
+def upgrade():
+    """Apply the pending migrations and return their (version, name)."""
+    applied = []
+    done = applied_versions()
+    for version, migration in MIGRATIONS:
+        if version in done:
+            continue
+        connection = db.session.connection()
+        migration(connection)
+        schema_migrations.create(connection, checkfirst=True)
+        connection.execute(schema_migrations.insert().values(
+            version=version, name=migration.__name__,
+            applied_at=datetime.utcnow()))
+        db.session.commit()
+        applied.append((version, migration.__name__))
+    return applied
@@ -1,28 +1,102 @@
+from collections import Counter
+from datetime import datetime
+from decimal import Decimal
+from itertools import chain
+from sqlalchemy import and_, event, func, inspect, literal, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import make_transient_to_detached, object_session
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_INITIALIZE
 from sqlalchemy_utils import URLType
 from flask_login import UserMixin
 
-from sewing_app.extensions import db
+from sewing_app.extensions import db, user_cache
 from sewing_app.utils import FormEnum
 
 # Create a many-to-many relationship between fabrics and patterns
 fabrics_patterns = db.Table('fabrics_patterns',
                             db.Column('fabric_id', db.Integer,
-                                      db.ForeignKey('fabric.id')),
+                                      db.ForeignKey('fabric.id'),
+                                      primary_key=True),
                             db.Column('pattern_id', db.Integer,
-                                      db.ForeignKey('pattern.id'))
+                                      db.ForeignKey('pattern.id'),
+                                      primary_key=True),
+                            db.Index('ix_fabrics_patterns_pattern_id',
+                                     'pattern_id')
                             )
 
 # Bridge table between users and patterns, users-patterns many-to-many relationship
 patterns_list = db.Table('patterns_list',
                          db.Column('user_id', db.Integer,
-                                   db.ForeignKey('user.id')),
+                                   db.ForeignKey('user.id'),
+                                   primary_key=True),
                          db.Column('pattern_id', db.Integer,
-                                   db.ForeignKey('pattern.id'))
+                                   db.ForeignKey('pattern.id'),
+                                   primary_key=True),
+                         db.Index('ix_patterns_list_pattern_id', 'pattern_id')
                          )
 
 # Bridge table between users and fabrics, users-fabrics many-to-many relationship
-fabrics_list = db.Table('fabrics_list', db.Column('user_id', db.Integer, db.ForeignKey(
-    'user.id')), db.Column('fabric_id', db.Integer, db.ForeignKey('fabric.id')))
+fabrics_list = db.Table('fabrics_list',
+                        db.Column('user_id', db.Integer,
+                                  db.ForeignKey('user.id'),
+                                  primary_key=True),
+                        db.Column('fabric_id', db.Integer,
+                                  db.ForeignKey('fabric.id'),
+                                  primary_key=True),
+                        db.Index('ix_fabrics_list_fabric_id', 'fabric_id')
+                        )
+
+
+def insert_ignore(table, **values):
+    """Insert a row into `table` unless its primary key already exists.
+
+    Returns the number of rows inserted.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        statement = postgresql.insert(table).values(
+            **values).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        statement = table.insert().prefix_with('OR IGNORE').values(**values)
+    else:
+        exists = select([table]).where(
+            and_(*[table.c[key] == value for key, value in values.items()]))
+        statement = table.insert().from_select(
+            list(values), select([literal(value) for value in values.values()])
+            .where(~exists.exists()))
+    return db.session.execute(statement).rowcount
+
+
+def insert_ignore_many(table, rows, connection=None):
+    """Insert `rows` into `table` with one executemany, skipping those whose
+    primary key already exists (Postgres and SQLite). Runs on `connection`
+    if given, else on the session."""
+    if not rows:
+        return
+    dialect = (connection or db.session.get_bind()).dialect.name
+    connection = connection or db.session
+    if dialect == 'postgresql':
+        statement = postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        statement = table.insert().prefix_with('OR IGNORE')
+    else:
+        statement = table.insert()
+    connection.execute(statement, rows)
+
+
+class Timestamped(object):
+    """Adds an updated_at column that is refreshed on every UPDATE."""
+    updated_at = db.Column(db.DateTime, nullable=False, index=True,
+                           default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class YardageKind(FormEnum):
+    """Kinds of yardage ledger entries."""
+    CUT = 'Cut for a pattern'
+    PURCHASED = 'Purchased'
+    ADJUSTED = 'Adjusted'
 
 
 class PatternCategory(FormEnum):
@@ -34,13 +108,17 @@ class PatternCategory(FormEnum):
     OTHER = 'Other'
 
 
-class Fabric(db.Model):
+class Fabric(Timestamped, db.Model):
     """Fabric model."""
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(80), nullable=False)
+    name = db.Column(db.String(80), nullable=False, index=True)
     color = db.Column(db.String(80), nullable=False)
-    quantity = db.Column(db.Numeric(precision=5, scale=2), nullable=False)
+    # Cached balance of the yardage ledger, see ledger.py
+    quantity = db.Column(db.Numeric(precision=9, scale=2), nullable=False)
     photo_url = db.Column(URLType)
+    # Denormalized number of patterns tagged with this fabric
+    pattern_count = db.Column(db.Integer, nullable=False,
+                              default=0, server_default='0')
     patterns = db.relationship(
         'Pattern', secondary=fabrics_patterns, back_populates='fabrics')
     created_by_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -49,7 +127,37 @@ class Fabric(db.Model):
                             back_populates='fabrics_list_items')
 
 
-class Pattern(db.Model):
+class name_key(FunctionElement):
+    """lower(name), compared byte by byte: with COLLATE "C" on Postgres,
+    whose default collation can sort a name outside the range of its
+    prefix. Indexed for the fabric typeahead."""
+    type = db.String()
+    name = 'name_key'
+
+
+@compiles(name_key)
+def _compile_name_key(element, compiler, **kw):
+    return 'lower(%s)' % compiler.process(element.clauses, **kw)
+
+
+@compiles(name_key, 'postgresql')
+def _compile_name_key_postgresql(element, compiler, **kw):
+    return 'lower(%s) COLLATE "C"' % compiler.process(element.clauses, **kw)
+
+
+def lower_name(text, dialect):
+    """Return `text` lowercased like name_key() does on `dialect`."""
+    if dialect == 'sqlite':
+        # SQLite's lower() only folds ASCII letters
+        return ''.join(char.lower() if char.isascii() else char
+                       for char in text)
+    return text.lower()
+
+
+db.Index('ix_fabric_name_key_id', name_key(Fabric.name), Fabric.id)
+
+
+class Pattern(Timestamped, db.Model):
     """Pattern model."""
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False)
@@ -58,6 +166,9 @@ class Pattern(db.Model):
     photo_url = db.Column(URLType)
     # fabric_id = db.Column(
     #     db.Integer, db.ForeignKey('fabric.id'), nullable=False)
+    # Denormalized number of fabrics tagged on this pattern
+    fabric_count = db.Column(db.Integer, nullable=False,
+                             default=0, server_default='0')
     fabrics = db.relationship(
         'Fabric', secondary=fabrics_patterns, back_populates='patterns')
     created_by_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -66,7 +177,7 @@ class Pattern(db.Model):
                             back_populates='patterns_list_items')
 
 
-class User(UserMixin, db.Model):
+class User(Timestamped, UserMixin, db.Model):
     """User model."""
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), nullable=False, unique=True)
@@ -75,3 +186,330 @@ class User(UserMixin, db.Model):
         'Pattern', secondary=patterns_list, back_populates='users')
     fabrics_list_items = db.relationship(
         'Fabric', secondary=fabrics_list, back_populates='users')
+
+    def _list_for(self, item):
+        """Return the bridge table, item column and relationship for `item`."""
+        if isinstance(item, Pattern):
+            return patterns_list, 'pattern_id', 'patterns_list_items'
+        return fabrics_list, 'fabric_id', 'fabrics_list_items'
+
+    def add_to_list(self, item):
+        """Add a fabric or pattern to this user's list.
+
+        Issues one idempotent INSERT instead of loading the whole list.
+        Returns whether the item was newly added.
+        """
+        table, column, attr = self._list_for(item)
+        added = insert_ignore(table, user_id=self.id, **{column: item.id})
+        db.session.expire(self, [attr])
+        db.session.expire(item, ['users'])
+        return bool(added)
+
+    def remove_from_list(self, item):
+        """Remove a fabric or pattern from this user's list with one DELETE.
+
+        Returns whether the item was on the list.
+        """
+        table, column, attr = self._list_for(item)
+        removed = db.session.execute(table.delete().where(and_(
+            table.c.user_id == self.id, table.c[column] == item.id))).rowcount
+        db.session.expire(self, [attr])
+        db.session.expire(item, ['users'])
+        return bool(removed)
+
+    # List kind -> bridge table, item column, relationship and item model
+    LISTS = {
+        'fabrics': (fabrics_list, 'fabric_id', 'fabrics_list_items', Fabric),
+        'patterns': (patterns_list, 'pattern_id', 'patterns_list_items',
+                     Pattern),
+    }
+
+    def change_list(self, kind, add=(), remove=()):
+        """Add and remove many fabrics or patterns (`kind`) by id.
+
+        Checks that the ids exist and whether they are on the list with one
+        query, then issues one executemany INSERT and one DELETE. Returns
+        the sorted ids added, removed and not found.
+        """
+        table, column, attr, model = self.LISTS[kind]
+        ids = set(add) | set(remove)
+        if not ids:
+            return [], [], []
+        items = model.__table__
+        rows = db.session.execute(
+            select([items.c.id, table.c.user_id]).select_from(
+                items.outerjoin(table, and_(table.c[column] == items.c.id,
+                                            table.c.user_id == self.id)))
+            .where(items.c.id.in_(list(ids))))
+        found, listed = set(), set()
+        for item_id, user_id in rows:
+            found.add(item_id)
+            if user_id is not None:
+                listed.add(item_id)
+
+        added = sorted((set(add) & found) - listed)
+        removed = sorted(set(remove) & listed)
+        insert_ignore_many(table, [dict(user_id=self.id, **{column: item_id})
+                                   for item_id in added])
+        if removed:
+            db.session.execute(table.delete().where(and_(
+                table.c.user_id == self.id, table.c[column].in_(removed))))
+        if added or removed:
+            db.session.expire(self, [attr])
+        return added, removed, sorted(ids - found)
+
+    # Columns kept in user_cache; the password hash is never cached
+    CACHED_COLUMNS = ('id', 'username')
+
+    @classmethod
+    def load_cached(cls, user_id):
+        """Return the user with `user_id`, from user_cache when possible."""
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+
+        data = user_cache.get(user_id)
+        if data is None:
+            user = cls.query.get(user_id)
+            if user is not None:
+                user_cache.set(user_id, {column: getattr(user, column)
+                                         for column in cls.CACHED_COLUMNS})
+            return user
+
+        # Attach the cached columns to the session without a query; any
+        # other attribute or relationship loads on first access
+        user = cls(**data)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    # Dropped once the change is committed: dropping it now would let a
+    # request load the uncommitted row back into the cache, or let a
+    # rolled back change empty it for nothing
+    object_session(target).info.setdefault('changed_users', set()).add(
+        target.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def forget_changed_users(session):
+    # Only reaches the other workers when user_cache is shared (see
+    # USER_CACHE_URL); otherwise their copies live out USER_CACHE_TTL
+    for user_id in session.info.pop('changed_users', ()):
+        user_cache.delete(user_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_changed_users(session):
+    session.info.pop('changed_users', None)
+
+
+class CacheVersion(db.Model):
+    """Version counter of a group of cached fragments, see fragments.py."""
+    name = db.Column(db.String(80), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class TagChange(db.Model):
+    """The fabrics_patterns rows added and removed by one bump of the
+    'tags' counter, so other processes can catch up, see matcher.py."""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # [[added, fabric_id, pattern_id], ...]
+    changes = db.Column(db.JSON, nullable=False)
+
+
+class Thumbnail(db.Model):
+    """A photo URL and the content-addressed thumbnail made from it, see
+    thumbnails.py."""
+    # sha1 of the URL
+    key = db.Column(db.String(40), primary_key=True)
+    url = db.Column(db.Text, nullable=False)
+    # sha256 of the thumbnail file, None until it is fetched
+    digest = db.Column(db.String(64), index=True)
+    content_type = db.Column(db.String(40))
+    size = db.Column(db.Integer, nullable=False, default=0)
+    # Last fetch attempt, and why it failed
+    fetched_at = db.Column(db.DateTime)
+    error = db.Column(db.String(200))
+    used_at = db.Column(db.DateTime, index=True)
+
+
+class FabricPair(db.Model):
+    """Number of patterns tagged with both fabrics, stored both ways round,
+    see cooccurrence.py."""
+    __table_args__ = (db.Index('ix_fabric_pair_fabric_id_count',
+                               'fabric_id', 'count'),)
+    # No foreign keys: rows of a deleted fabric are removed after its tags
+    fabric_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    other_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False)
+
+
+class YardageEntry(db.Model):
+    """One change of a fabric's yardage; entries are only ever appended,
+    see ledger.py."""
+    __table_args__ = (db.Index('ix_yardage_entry_fabric_id_id',
+                               'fabric_id', 'id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    fabric_id = db.Column(db.Integer, db.ForeignKey(
+        'fabric.id', ondelete='CASCADE'), nullable=False)
+    kind = db.Column(db.Enum(YardageKind), nullable=False)
+    # Yards added, negative for cuts
+    change = db.Column(db.Numeric(precision=9, scale=2), nullable=False)
+    # The pattern a cut was for
+    pattern_id = db.Column(db.Integer, db.ForeignKey(
+        'pattern.id', ondelete='SET NULL'))
+    pattern = db.relationship('Pattern')
+    note = db.Column(db.String(200))
+    created_by_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_by = db.relationship('User')
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+
+
+class YardageSnapshot(db.Model):
+    """Balance of a fabric's ledger up to and including entry_id."""
+    fabric_id = db.Column(db.Integer, db.ForeignKey(
+        'fabric.id', ondelete='CASCADE'), primary_key=True,
+        autoincrement=False)
+    entry_id = db.Column(db.Integer, nullable=False)
+    balance = db.Column(db.Numeric(precision=9, scale=2), nullable=False)
+    taken_at = db.Column(db.DateTime, nullable=False)
+
+
+class PhotoCheck(db.Model):
+    """Last health check of a photo URL, see photo_checks.py."""
+    # sha1 of the URL, like Thumbnail.key
+    key = db.Column(db.String(40), primary_key=True)
+    url = db.Column(db.Text, nullable=False)
+    # HTTP status and content type, None when there was no response
+    status = db.Column(db.Integer)
+    content_type = db.Column(db.String(100))
+    error = db.Column(db.String(200))
+    # No response, an error status or not an image
+    dead = db.Column(db.Boolean, nullable=False, default=False, index=True)
+    checked_at = db.Column(db.DateTime, nullable=False)
+
+
+class StashSummary(db.Model):
+    """Yardage and fabric counts of a user's fabrics list, or of every
+    fabric for owner_id 0, kept up to date by summaries.py."""
+    owner_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    fabric_count = db.Column(db.Integer, nullable=False, default=0)
+    total_yardage = db.Column(db.Numeric(precision=12, scale=2),
+                              nullable=False, default=0)
+    # Fabrics no pattern is tagged with
+    untagged_count = db.Column(db.Integer, nullable=False, default=0)
+    # Color -> yardage, as a decimal string
+    yardage_by_color = db.Column(db.JSON, nullable=False, default=dict)
+    # PatternCategory name -> fabrics tagged on a pattern of that category
+    count_by_category = db.Column(db.JSON, nullable=False, default=dict)
+
+    @property
+    def colors(self):
+        """(color, yardage) pairs, the most yardage first."""
+        colors = [(color, Decimal(yardage))
+                  for color, yardage in (self.yardage_by_color or {}).items()]
+        return sorted(colors, key=lambda pair: (-pair[1], pair[0]))
+
+    @property
+    def categories(self):
+        """(category, fabric count) pairs in PatternCategory order."""
+        counts = self.count_by_category or {}
+        return [(category, counts[category.name])
+                for category in PatternCategory if category.name in counts]
+
+
+class StashSummaryChange(db.Model):
+    """A change to add to a StashSummary. Writers only append these;
+    summaries.fold() adds them into the summaries."""
+    __table_args__ = (db.Index('ix_stash_summary_change_owner_id_id',
+                               'owner_id', 'id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.Integer, nullable=False)
+    fabric_count = db.Column(db.Integer, nullable=False, default=0)
+    total_yardage = db.Column(db.Numeric(precision=12, scale=2),
+                              nullable=False, default=0)
+    untagged_count = db.Column(db.Integer, nullable=False, default=0)
+    # Only the colors and categories that change
+    yardage_by_color = db.Column(db.JSON, nullable=False, default=dict)
+    count_by_category = db.Column(db.JSON, nullable=False, default=dict)
+
+
+###########################
+# Tag counters
+###########################
+
+def _tag_pair(obj, other):
+    """Return `obj` and `other` as a (fabric, pattern) tuple."""
+    return (obj, other) if isinstance(obj, Fabric) else (other, obj)
+
+
+def tag_changes(session):
+    """Return the (fabric, pattern) pairs added to and removed from
+    fabrics_patterns by the pending changes in `session`."""
+    added, removed = set(), set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Pattern):
+            attr = 'fabrics'
+        elif isinstance(obj, Fabric):
+            attr = 'patterns'
+        else:
+            continue
+
+        if obj in session.deleted:
+            # Deleting a row also deletes all of its association rows
+            obj_added, obj_removed = [], getattr(obj, attr)
+        else:
+            history = get_history(obj, attr, passive=PASSIVE_NO_INITIALIZE)
+            obj_added, obj_removed = history.added or (), history.deleted or ()
+        added.update(_tag_pair(obj, other) for other in obj_added)
+        removed.update(_tag_pair(obj, other) for other in obj_removed)
+    return added - removed, removed - added
+
+
+def _bump_counter(obj, attr, delta):
+    """Add `delta` to the counter `attr` of `obj`."""
+    state = inspect(obj)
+    if delta == 0 or state.deleted:
+        return
+    if state.persistent:
+        # Let the database do the arithmetic so concurrent writers don't
+        # overwrite each other's increments
+        setattr(obj, attr, getattr(type(obj), attr) + delta)
+    else:
+        setattr(obj, attr, (getattr(obj, attr) or 0) + delta)
+
+
+@event.listens_for(db.session, 'before_flush')
+def update_tag_counters(session, flush_context, instances):
+    """Keep Fabric.pattern_count and Pattern.fabric_count in step with
+    fabrics_patterns whenever the fabrics/patterns relationships change."""
+    added, removed = tag_changes(session)
+    fabric_deltas, pattern_deltas = Counter(), Counter()
+    for fabric, pattern in added:
+        fabric_deltas[fabric] += 1
+        pattern_deltas[pattern] += 1
+    for fabric, pattern in removed:
+        fabric_deltas[fabric] -= 1
+        pattern_deltas[pattern] -= 1
+
+    for fabric, delta in fabric_deltas.items():
+        _bump_counter(fabric, 'pattern_count', delta)
+    for pattern, delta in pattern_deltas.items():
+        _bump_counter(pattern, 'fabric_count', delta)
+
+
+def recount_tags():
+    """Recompute every tag counter from fabrics_patterns in two UPDATEs."""
+    pattern_counts = select([func.count()]).where(
+        fabrics_patterns.c.fabric_id == Fabric.id).as_scalar()
+    fabric_counts = select([func.count()]).where(
+        fabrics_patterns.c.pattern_id == Pattern.id).as_scalar()
+    Fabric.query.update({Fabric.pattern_count: pattern_counts},
+                        synchronize_session=False)
+    Pattern.query.update({Pattern.fabric_count: fabric_counts},
+                         synchronize_session=False)
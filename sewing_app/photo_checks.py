@@ -0,0 +1,299 @@
+"""Health checks of the stored photo URLs.
+
+The forms only check the length of photo_url, so links to deleted photos
+and dead hosts pile up, and every page showing them waits on the host.
+check_all() (`flask check-photos`) requests every distinct photo URL of the
+fabrics and patterns and records the status and content type in
+PhotoCheck, flagging as dead the URLs with no response, an error status or
+something other than an image. The thumbnail route then answers 404 for a
+dead photo instead of sending the browser to it.
+
+Requests are made with asyncio streams: PHOTO_CHECK_CONCURRENCY in
+flight, at most PHOTO_CHECK_PER_HOST per host, each given
+PHOTO_CHECK_TIMEOUT seconds. A HEAD is sent first, then a GET whose body is
+never read for servers that don't allow HEAD, and up to MAX_REDIRECTS
+redirects are followed. Like the thumbnailer, the checker only connects to
+public addresses (see thumbnails.py), checked again on every redirect, so
+it cannot be used to probe the internal network. With PHOTO_CHECK_ON_SAVE,
+URLs are also checked in a background thread when a fabric or pattern is
+saved with a new one.
+"""
+import asyncio
+import os
+import socket
+import ssl
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Lock
+from urllib.parse import urljoin, urlsplit
+
+from flask import current_app
+from sqlalchemy import bindparam, event, inspect, select, union
+
+from sewing_app.extensions import db
+from sewing_app.models import Fabric, Pattern, PhotoCheck, insert_ignore_many
+from sewing_app.thumbnails import public_address, url_key
+
+table = PhotoCheck.__table__
+
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# HEAD is not allowed or not implemented
+RETRY_WITH_GET = (405, 501)
+
+# Results written per transaction
+BATCH_SIZE = 500
+
+_pool = None
+_pool_pid = None
+_pool_lock = Lock()
+
+
+class CheckError(Exception):
+    """A photo URL could not be requested."""
+
+
+###########################
+# Requests
+###########################
+
+async def _request(url, method):
+    """Send one request and return its status and headers."""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise CheckError('Not an http(s) URL')
+    https = parts.scheme == 'https'
+    port = parts.port or (443 if https else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    # Connects to the address checked, not to a second lookup of the name
+    address = public_address(parts.hostname, await asyncio.get_running_loop()
+                             .getaddrinfo(parts.hostname, port,
+                                          type=socket.SOCK_STREAM))
+    reader, writer = await asyncio.open_connection(
+        address, port, ssl=ssl.create_default_context() if https else None,
+        server_hostname=parts.hostname if https else None)
+    try:
+        writer.write(('%s %s HTTP/1.1\r\nHost: %s\r\n'
+                      'User-Agent: sewing-app-photo-check\r\n'
+                      'Accept: image/*\r\nConnection: close\r\n\r\n'
+                      % (method, path, parts.netloc)).encode('latin-1'))
+        await writer.drain()
+        status_line = await reader.readline()
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise CheckError('Not an HTTP response')
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return status, headers
+    finally:
+        writer.close()
+
+
+async def check_url(url, hosts, timeout):
+    """Return (status, content type, error) for `url`, holding the
+    semaphore of its host in `hosts` during each request."""
+    method = 'HEAD'
+    try:
+        for _ in range(MAX_REDIRECTS + 1):
+            async with hosts[urlsplit(url).netloc.lower()]:
+                status, headers = await asyncio.wait_for(
+                    _request(url, method), timeout)
+            if status in RETRY_WITH_GET and method == 'HEAD':
+                method = 'GET'
+                continue
+            if status in REDIRECT_STATUSES and headers.get('location'):
+                url = urljoin(url, headers['location'])
+                continue
+            content_type = headers.get('content-type', '').split(';')[0]
+            return status, content_type.strip().lower() or None, None
+        raise CheckError('Too many redirects')
+    except asyncio.TimeoutError:
+        return None, None, 'Timed out after %g seconds' % timeout
+    except (OSError, ValueError, CheckError) as error:
+        return None, None, (str(error) or error.__class__.__name__)[:200]
+
+
+async def check_urls(urls, on_result, concurrency, per_host, timeout):
+    """Check every URL of the iterable `urls`, calling
+    on_result(url, status, content type, error) as each one finishes."""
+    hosts = defaultdict(lambda: asyncio.Semaphore(per_host))
+    # Bounded, so `urls` is consumed as the checks go
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        while True:
+            url = await queue.get()
+            if url is None:
+                return
+            on_result(url, *await check_url(url, hosts, timeout))
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    for url in urls:
+        await queue.put(url)
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+
+
+###########################
+# Recording
+###########################
+
+def is_dead(status, content_type):
+    return status is None or status >= 400 or \
+        not (content_type or '').startswith('image/')
+
+
+def _record(results):
+    """Write (url, status, content type, error) results."""
+    if not results:
+        return
+    now = datetime.utcnow()
+    rows = {}
+    for url, status, content_type, error in results:
+        rows[url_key(url)] = dict(
+            key=url_key(url), url=url, status=status,
+            content_type=content_type and content_type[:100], error=error,
+            dead=is_dead(status, content_type), checked_at=now)
+    # Insert or update rather than replace, so runs writing the same URLs
+    # at once (the command and a check on save) do not collide
+    with db.engine.begin() as connection:
+        insert_ignore_many(table, list(rows.values()), connection)
+        connection.execute(
+            table.update().where(table.c.key == bindparam('check_key')),
+            [dict(row, check_key=key) for key, row in rows.items()])
+
+
+def run_checks(urls, concurrency=None, per_host=None, timeout=None):
+    """Check `urls`, record the results and return the numbers of URLs
+    checked and dead."""
+    config = current_app.config
+    totals = dict(checked=0, dead=0)
+    batch = []
+
+    def on_result(url, status, content_type, error):
+        batch.append((url, status, content_type, error))
+        totals['checked'] += 1
+        totals['dead'] += is_dead(status, content_type)
+        if len(batch) >= BATCH_SIZE:
+            _record(batch)
+            del batch[:]
+
+    asyncio.run(check_urls(
+        urls, on_result, concurrency or config['PHOTO_CHECK_CONCURRENCY'],
+        per_host or config['PHOTO_CHECK_PER_HOST'],
+        timeout or config['PHOTO_CHECK_TIMEOUT']))
+    _record(batch)
+    return totals['checked'], totals['dead']
+
+
+def stored_urls(unchecked=False):
+    """Yield every distinct photo URL of the fabrics and patterns, or only
+    those never checked."""
+    urls = union(select([Fabric.photo_url.label('url')]),
+                 select([Pattern.photo_url.label('url')])).alias()
+    query = select([urls.c.url]).where(urls.c.url.isnot(None))
+    checked = set()
+    if unchecked:
+        checked = {key for key, in db.session.execute(select([table.c.key]))}
+    with db.engine.connect() as connection:
+        result = connection.execution_options(
+            stream_results=True).execute(query)
+        for url, in result:
+            if url and url_key(url) not in checked:
+                yield url
+
+
+def check_all(unchecked=False, **options):
+    """Check the stored photo URLs; see run_checks()."""
+    return run_checks(stored_urls(unchecked), **options)
+
+
+def dead_links():
+    """Return the dead PhotoChecks with the fabrics and patterns using
+    them, as (check, [Fabric or Pattern]) pairs."""
+    checks = PhotoCheck.query.filter_by(dead=True).order_by(
+        PhotoCheck.url).all()
+    by_url = {check.url: (check, []) for check in checks}
+    if by_url:
+        for model in (Fabric, Pattern):
+            for obj in model.query.filter(model.photo_url.in_(list(by_url))):
+                by_url[obj.photo_url][1].append(obj)
+    return list(by_url.values())
+
+
+def reason(check):
+    """Return why the PhotoCheck `check` was flagged dead."""
+    if check.error:
+        return check.error
+    if check.status is not None and check.status >= 400:
+        return 'HTTP %d' % check.status
+    return 'Not an image (%s)' % (check.content_type or 'no content type')
+
+
+def is_dead_link(key):
+    """Return whether the photo URL with `key` was found dead."""
+    return bool(db.session.query(PhotoCheck.dead).filter_by(key=key).scalar())
+
+
+###########################
+# Checking on save
+###########################
+
+def _get_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        # Threads do not survive a fork, so each worker makes its own pool
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=1)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _check_in_background(app, urls):
+    with app.app_context():
+        try:
+            run_checks(urls)
+        except Exception:
+            app.logger.exception('Checking photo URLs failed')
+
+
+def check_later(urls):
+    """Check `urls` in the background once the transaction commits, when
+    PHOTO_CHECK_ON_SAVE is on."""
+    if current_app.config['PHOTO_CHECK_ON_SAVE']:
+        db.session.info.setdefault('unchecked_photos', set()).update(
+            url for url in urls if url)
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_photo_urls(session, flush_context, instances):
+    if current_app.config['PHOTO_CHECK_ON_SAVE']:
+        check_later(obj.photo_url
+                    for obj in list(session.new) + list(session.dirty)
+                    if isinstance(obj, (Fabric, Pattern)) and
+                    (obj in session.new or
+                     inspect(obj).attrs.photo_url.history.has_changes()))
+
+
+@event.listens_for(db.session, 'after_commit')
+def check_saved_photos(session):
+    urls = session.info.pop('unchecked_photos', None)
+    if urls:
+        _get_pool().submit(_check_in_background,
+                           current_app._get_current_object(), sorted(urls))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_saved_photos(session):
+    session.info.pop('unchecked_photos', None)
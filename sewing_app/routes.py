@@ -1,32 +1,164 @@
-from flask import Blueprint, request, render_template, redirect, url_for, flash
+from flask import current_app, Blueprint, request, render_template, redirect, url_for, flash, jsonify, abort, Response, stream_with_context, send_file
 from flask_login import login_user, logout_user, login_required, current_user
 from datetime import date, datetime
-from sewing_app.models import Fabric, Pattern, User
-from sewing_app.forms import FabricForm, PatternForm, SignUpForm, LoginForm
-
-# Import app and db from sewing_app package so that we can run app
-from sewing_app.extensions import app, db, bcrypt
+import hmac
+import mimetypes
+import sys
+from sqlalchemy import tuple_
+from sewing_app.models import Fabric, Pattern, User, Thumbnail, YardageKind, lower_name, name_key
+from sewing_app.forms import FabricForm, PatternForm, SignUpForm, LoginForm, YardageForm
+from sewing_app.conditional import conditional
+from sewing_app.caching import render_stats
+from sewing_app import admission, assets, cooccurrence, exporter, ledger, matcher, metrics, photo_checks, summaries
+from sewing_app import fragments
+from sewing_app.fragments import bump_version, cached_fragment, current_version
+from sewing_app.hashing import hash_password, needs_rehash
+from sewing_app.importer import IMPORTERS, FORMATS, guess_format, read_rows
+from sewing_app.search import run_search
+from sewing_app import thumbnails
+from sewing_app.utils import keyset_paginate
+
+# Import db from sewing_app package so that we can run app
+from sewing_app.extensions import db, bcrypt, user_cache
 
 main = Blueprint("main", __name__)
 auth = Blueprint("auth", __name__)
 
+# Most ids accepted by one bulk list change
+MAX_BULK_IDS = 1000
+# Endpoints that hash a password, see admission.py
+PASSWORD_ENDPOINTS = ('auth.login', 'auth.signup')
+
+##########################################
+#           Validators                   #
+##########################################
+
+
+def catalog_validators(**kwargs):
+    """Listing pages change only when the catalog version is bumped."""
+    return (request.path, request.query_string,
+            current_version('catalog')), None
+
+
+def row_validators(model):
+    """Detail pages change with their row and with the catalog around it.
+
+    They also show the yardage history, the paired fabrics and who is
+    logged in, which the row's updated_at doesn't cover, so they only get
+    an ETag and no Last-Modified.
+    """
+    def validators(**kwargs):
+        row_id, = kwargs.values()
+        updated_at = db.session.query(model.updated_at).filter(
+            model.id == row_id).scalar()
+        if updated_at is None:
+            return None
+        return (request.path, updated_at.isoformat(),
+                current_version('catalog')), None
+    return validators
+
+
 ##########################################
 #           Routes                       #
 ##########################################
 
 
 @main.route('/')
+@conditional(catalog_validators)
 def homepage():
-    all_fabrics = Fabric.query.all()
-    all_fabrics_names = ', '.join([fabric.name for fabric in all_fabrics])
-    # print(f"All fabric names: {all_fabrics_names}")
-    return render_template('home.html', all_fabrics=all_fabrics)
+    """Show one page of fabrics, paginated with an id cursor."""
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    per_page = current_app.config['FABRICS_PER_PAGE']
+
+    def render_listing():
+        page = keyset_paginate(Fabric.query, Fabric.id, after=after,
+                               before=before, per_page=per_page)
+        return render_template('_fabric_listing.html', page=page)
+
+    listing = cached_fragment(['catalog'], ('home', after, before, per_page),
+                              render_listing)
+    return render_template('home.html', listing=listing)
 
 
 @main.route('/patterns')
+@conditional(catalog_validators)
 def patterns():
-    all_patterns = Pattern.query.all()
-    return render_template('patterns.html', all_patterns=all_patterns)
+    def render_listing():
+        all_patterns = Pattern.query.all()
+        return render_template('_pattern_listing.html',
+                               all_patterns=all_patterns)
+
+    listing = cached_fragment(['catalog'], ('patterns',), render_listing)
+    return render_template('patterns.html', listing=listing)
+
+
+def _search_page():
+    """Run the search in the request's `q`/`page` args."""
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    hits, has_next = run_search(query, page=page,
+                                per_page=current_app.config['SEARCH_RESULTS_PER_PAGE'])
+    return query, page, hits, has_next
+
+
+@main.route('/search')
+def search():
+    """Show ranked fabric and pattern matches for a search query."""
+    query, page, hits, has_next = _search_page()
+    return render_template('search.html', query=query, page=page,
+                           hits=hits, has_next=has_next)
+
+
+@main.route('/api/search')
+def api_search():
+    """Return ranked fabric and pattern matches for a search query as JSON."""
+    query, page, hits, has_next = _search_page()
+    return jsonify(
+        query=query,
+        page=page,
+        next_page=page + 1 if has_next else None,
+        results=[dict(kind=hit.kind, id=hit.id, name=hit.name,
+                      color=hit.color or None,
+                      category=hit.category or None,
+                      url=url_for('main.%s_detail' % hit.kind,
+                                  **{'%s_id' % hit.kind: hit.id}))
+                 for hit in hits])
+
+
+@main.route('/api/fabrics')
+def api_fabrics():
+    """Return one page of fabrics whose name starts with `q`, as JSON.
+
+    Fabrics are matched case-insensitively and sorted by name, then id,
+    both from the (name_key(name), id) index: the prefix is a range of
+    that index and `after`, the id of the last fabric shown, continues
+    right after it.
+    """
+    dialect = db.session.get_bind().dialect.name
+    key = name_key(Fabric.name)
+    query = Fabric.query
+    prefix = lower_name(request.args.get('q', '').strip(), dialect)
+    if prefix:
+        query = query.filter(key >= prefix)
+        if ord(prefix[-1]) < sys.maxunicode:
+            query = query.filter(
+                key < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+    after = request.args.get('after', type=int)
+    if after is not None:
+        after_key = db.session.query(key).filter(Fabric.id == after).scalar()
+        if after_key is None:
+            abort(400)
+        query = query.filter(tuple_(key, Fabric.id) > tuple_(after_key, after))
+
+    per_page = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    rows = query.order_by(key, Fabric.id).limit(per_page + 1).all()
+    fabrics = rows[:per_page]
+    return jsonify(
+        results=[dict(id=fabric.id, name=fabric.name, color=fabric.color)
+                 for fabric in fabrics],
+        next_cursor=fabrics[-1].id if len(rows) > per_page else None)
 
 
 @main.route('/new_fabric', methods=['GET', 'POST'])
@@ -46,6 +178,7 @@ def new_fabric():
             created_by=current_user
         )
         db.session.add(new_fabric)
+        bump_version('catalog')
         db.session.commit()
 
         # flash a success message, and
@@ -67,20 +200,17 @@ def new_pattern():
     # - flash a success message, and
     # - redirect the user to the pattern detail page.
     if form.validate_on_submit():
-        # Extract fabric IDs from form data
-        fabric_ids = [fabric.id for fabric in form.fabrics.data]
-
-        # Retrieve Fabric objects based on extracted IDs
-        fabrics = [Fabric.query.get(id) for id in fabric_ids]
+        # The fabrics field already loaded the selected fabrics in one query
         new_pattern = Pattern(
             name=form.name.data,
             category=form.category.data,
             photo_url=form.photo_url.data,
-            fabrics=fabrics,
+            fabrics=form.fabrics.data,
             created_by=current_user
         )
 
         db.session.add(new_pattern)
+        bump_version('catalog')
         db.session.commit()
 
         flash(f'New pattern "{new_pattern.name}" was created successfully!')
@@ -90,10 +220,119 @@ def new_pattern():
     return render_template('new_pattern.html', form=form)
 
 
+@main.route('/import/<kind>', methods=['POST'])
+@login_required
+def import_data(kind):
+    """Bulk import fabrics or patterns from an uploaded CSV or JSONL file.
+
+    The file is sent as the `file` form field or as the raw request body.
+    Returns a JSON report with the errors of every rejected row.
+    """
+    if kind not in IMPORTERS:
+        abort(404)
+    upload = request.files.get('file')
+    if upload:
+        stream = upload.stream
+        fmt = guess_format(upload.filename, upload.mimetype)
+    else:
+        stream = request.stream
+        fmt = guess_format(content_type=request.mimetype)
+    fmt = request.args.get('format', fmt)
+    if fmt not in FORMATS:
+        return jsonify(error='Send a .csv or .jsonl file'), 400
+
+    report = IMPORTERS[kind](read_rows(stream, fmt), user_id=current_user.id)
+    return jsonify(report.as_dict())
+
+
+@main.route('/export/<kind>')
+@login_required
+def export_data(kind):
+    """Stream the logged in user's fabrics, patterns or tags as a download.
+
+    `format` is csv (default) or jsonl; `gzip=1` compresses the file.
+    """
+    if kind not in exporter.QUERIES:
+        abort(404)
+    fmt = request.args.get('format', 'csv')
+    if fmt not in exporter.FORMATS:
+        abort(400)
+    compress = request.args.get('gzip', type=int) == 1
+
+    chunks = exporter.export_chunks(kind, current_user.id, fmt, compress)
+    filename = exporter.export_filename(kind, fmt, compress)
+    return Response(
+        stream_with_context(chunks),
+        mimetype='application/gzip' if compress else exporter.MIMETYPES[fmt],
+        headers={'Content-Disposition': 'attachment; filename=%s' % filename})
+
+
+@main.route('/metrics')
+def metrics_page():
+    """Per-endpoint request histograms in the Prometheus text format, for
+    scrapers sending the METRICS_TOKEN as a bearer token."""
+    token = current_app.config['METRICS_TOKEN']
+    if not current_app.config['METRICS_ENABLED'] or not token:
+        abort(404)
+    sent = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(sent.encode(), ('Bearer ' + token).encode()):
+        return Response('Send the metrics token as a bearer token\n', 401,
+                        {'WWW-Authenticate': 'Bearer'}, mimetype='text/plain')
+    caches = {'user': user_cache, 'fragment': fragments.fragment_cache}
+    return Response(metrics.render() + admission.render() +
+                    render_stats(caches),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@main.route('/assets/<path:filename>')
+def asset(filename):
+    """Serve a fingerprinted static file, precompressed when the browser
+    accepts it."""
+    path, encoding = assets.negotiate(filename, request.accept_encodings)
+    if path is None:
+        abort(404)
+    max_age = current_app.config['ASSETS_MAX_AGE']
+    response = send_file(path, mimetype=mimetypes.guess_type(filename)[0] or
+                         'application/octet-stream',
+                         conditional=True, cache_timeout=max_age)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # The name holds a hash of the content, so it never changes
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % max_age
+    return response
+
+
+@main.route('/thumbnails/<key>')
+def thumbnail(key):
+    """Serve the thumbnail of a photo, or redirect to the photo itself
+    while the thumbnail is being made."""
+    thumb = Thumbnail.query.get_or_404(key)
+    path = thumbnails.stored_path(thumb)
+    if path is None:
+        # Don't send the browser to a host that is known to be dead
+        if photo_checks.is_dead_link(key):
+            abort(404)
+        if thumbnails.should_fetch(thumb):
+            thumbnails.enqueue(thumb.key)
+        response = redirect(thumb.url)
+        response.cache_control.no_store = True
+        return response
+
+    thumbnails.touch(thumb)
+    max_age = current_app.config['THUMBNAIL_MAX_AGE']
+    response = send_file(path, mimetype=thumb.content_type, conditional=True,
+                         cache_timeout=max_age)
+    # The key is the photo URL, so the thumbnail never changes
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % max_age
+    return response
+
+
 @main.route('/fabric/<fabric_id>', methods=['GET', 'POST'])
 @login_required
+@conditional(row_validators(Fabric), forms=True)
 def fabric_detail(fabric_id):
-    fabric = Fabric.query.get(fabric_id)
+    fabric = Fabric.query.get_or_404(fabric_id)
     # Create a FabricForm and pass in `obj=fabric`
     form = FabricForm(obj=fabric)
 
@@ -102,21 +341,80 @@ def fabric_detail(fabric_id):
     # - flash a success message, and
     # - redirect the user to the fabric detail page.
     if form.validate_on_submit():
+        quantity = fabric.quantity
         form.populate_obj(fabric)
-        db.session.commit()
-
-        flash('Fabric was updated successfully!')
-        return redirect(url_for('main.fabric_detail', fabric_id=fabric.id))
+        # The quantity is the ledger's balance: record the change from the
+        # quantity the form showed, so changes made since then still count
+        fabric.quantity = quantity
+        try:
+            seen = ledger.yards(request.form['quantity_seen'])
+        except (KeyError, ArithmeticError):
+            seen = quantity
+        try:
+            ledger.record(fabric, YardageKind.ADJUSTED,
+                          ledger.yards(form.quantity.data) - seen,
+                          user_id=current_user.id)
+        except ledger.YardageError as error:
+            db.session.rollback()
+            form.quantity.errors.append(str(error))
+        else:
+            bump_version('catalog')
+            db.session.commit()
+
+            flash('Fabric was updated successfully!')
+            return redirect(url_for('main.fabric_detail', fabric_id=fabric.id))
 
     # Send the form to the template and use it to render the form fields
-    fabric = Fabric.query.get(fabric_id)
-    return render_template('fabric_detail.html', fabric=fabric, form=form)
+    return _render_fabric_detail(fabric, form, _yardage_form(fabric))
+
+
+def _yardage_form(fabric):
+    form = YardageForm()
+    form.pattern.query_factory = lambda: fabric.patterns
+    return form
+
+
+def _render_fabric_detail(fabric, form, yardage_form):
+    return render_template(
+        'fabric_detail.html', fabric=fabric, form=form,
+        yardage_form=yardage_form, balance=ledger.balance(fabric.id),
+        history=ledger.history(fabric.id),
+        paired=cooccurrence.paired_with_fabric(fabric.id))
+
+
+@main.route('/fabric/<fabric_id>/yardage', methods=['POST'])
+@login_required
+def record_yardage(fabric_id):
+    """Record yards cut from or purchased for a fabric."""
+    fabric = Fabric.query.get_or_404(fabric_id)
+    yardage_form = _yardage_form(fabric)
+    if yardage_form.validate_on_submit():
+        kind = YardageKind[yardage_form.kind.data]
+        change = yardage_form.yards.data
+        pattern = yardage_form.pattern.data
+        try:
+            ledger.record(fabric, kind,
+                          -change if kind is YardageKind.CUT else change,
+                          user_id=current_user.id,
+                          pattern_id=pattern.id if pattern else None,
+                          note=yardage_form.note.data or None)
+        except ledger.YardageError as error:
+            db.session.rollback()
+            yardage_form.yards.errors.append(str(error))
+        else:
+            bump_version('catalog')
+            db.session.commit()
+
+            flash(f'Recorded {change} yards for "{fabric.name}".')
+            return redirect(url_for('main.fabric_detail', fabric_id=fabric.id))
+    return _render_fabric_detail(fabric, FabricForm(obj=fabric), yardage_form)
 
 
 @main.route('/pattern/<pattern_id>', methods=['GET', 'POST'])
 @login_required
+@conditional(row_validators(Pattern), forms=True)
 def pattern_detail(pattern_id):
-    pattern = Pattern.query.get(pattern_id)
+    pattern = Pattern.query.get_or_404(pattern_id)
     # Create a PatternForm and pass in `obj=pattern`
     form = PatternForm(obj=pattern)
 
@@ -126,82 +424,207 @@ def pattern_detail(pattern_id):
     # - redirect the user to the pattern detail page.
     if form.validate_on_submit():
         form.populate_obj(pattern)
+        bump_version('catalog')
         db.session.commit()
 
         flash('Pattern was updated successfully!')
         return redirect(url_for('main.pattern_detail', pattern_id=pattern.id))
 
     # Send the form to the template and use it to render the form fields
-    pattern = Pattern.query.get(pattern_id)
-    return render_template('pattern_detail.html', pattern=pattern, form=form)
+    paired = cooccurrence.paired_with_pattern(pattern.id)
+    return render_template('pattern_detail.html', pattern=pattern, form=form,
+                           paired=paired)
+
+
+@main.route('/api/matches')
+@login_required
+def api_matches():
+    """Return the logged in user's saved patterns that can be made from
+    their fabrics list: full matches, then partial ones with the fabrics
+    still missing."""
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    full, partial = matcher.match(current_user.id)
+    full, partial = full[:limit], partial[:limit]
+    names = {}
+    ids = [match.pattern_id for match in full + partial]
+    if ids:
+        names = dict(db.session.query(Pattern.id, Pattern.name).filter(
+            Pattern.id.in_(ids)))
+
+    def as_dict(match):
+        return dict(id=match.pattern_id, name=names.get(match.pattern_id),
+                    url=url_for('main.pattern_detail',
+                                pattern_id=match.pattern_id),
+                    owned=match.owned, needed=match.needed,
+                    missing=match.missing)
+
+    return jsonify(full=[as_dict(match) for match in full],
+                   partial=[as_dict(match) for match in partial])
+
+
+def _list_changed(kind, item, on_list, changed, message):
+    """Answer an add/remove list button.
+
+    Scripts get a JSON delta when they accept JSON, or with an X-Fragment
+    header only the button's new HTML (see list_buttons.js); plain form
+    posts are redirected to the list page.
+    """
+    best = request.accept_mimetypes.best_match(
+        ('text/html', 'application/json'))
+    if best == 'application/json':
+        return jsonify(kind=kind, id=item.id, on_list=on_list,
+                       changed=changed, message=message)
+    if request.headers.get('X-Fragment'):
+        return render_template('_list_button.html', kind=kind, item=item,
+                               on_list=on_list, message=message)
+    flash(message)
+    return redirect(url_for('main.%s_list' % kind))
 
 
 @main.route('/add_to_patterns_list/<pattern_id>', methods=['POST'])
 @login_required
 def add_to_patterns_list(pattern_id):
     """Add a pattern to the logged in user's patterns list."""
-    pattern = Pattern.query.get(pattern_id)
-    current_user.patterns_list_items.append(pattern)
+    pattern = Pattern.query.get_or_404(pattern_id)
+    changed = current_user.add_to_list(pattern)
+    if changed:
+        matcher.list_changed(current_user.id, 'patterns', [pattern.id],
+                             added=True)
     db.session.commit()
-    flash(f'Pattern "{pattern.name}" was added to your patterns list!')
-    return redirect(url_for('main.patterns_list'))
+    return _list_changed(
+        'patterns', pattern, True, changed,
+        f'Pattern "{pattern.name}" was added to your patterns list!')
 
 
 @main.route('/remove_from_patterns_list/<pattern_id>', methods=['POST'])
 @login_required
 def remove_from_patterns_list(pattern_id):
     """Remove a pattern from the logged in user's patterns list."""
-    pattern = Pattern.query.get(pattern_id)
-    current_user.patterns_list_items.remove(pattern)
+    pattern = Pattern.query.get_or_404(pattern_id)
+    changed = current_user.remove_from_list(pattern)
+    if changed:
+        matcher.list_changed(current_user.id, 'patterns', [pattern.id],
+                             added=False)
     db.session.commit()
-    flash(f'Pattern "{pattern.name}" was removed from your patterns list!')
-    return redirect(url_for('main.patterns_list'))
+    return _list_changed(
+        'patterns', pattern, False, changed,
+        f'Pattern "{pattern.name}" was removed from your patterns list!')
+
+
+@main.route('/api/lists/<kind>', methods=['POST'])
+@login_required
+def change_list(kind):
+    """Add and remove many fabrics or patterns on the logged in user's list
+    in one transaction.
+
+    Takes JSON {"add": [ids], "remove": [ids]} and returns the ids added,
+    removed, unchanged (already on or off the list) and not found.
+    """
+    if kind not in User.LISTS:
+        abort(404)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(error='Send a JSON object with add and remove'), 400
+    add, remove = data.get('add', []), data.get('remove', [])
+    if not all(isinstance(ids, list) and
+               all(type(item_id) is int for item_id in ids)
+               for ids in (add, remove)):
+        return jsonify(error='add and remove must be lists of ids'), 400
+    if len(add) + len(remove) > MAX_BULK_IDS:
+        return jsonify(error='At most %d ids at a time' % MAX_BULK_IDS), 400
+    if set(add) & set(remove):
+        return jsonify(error='Ids cannot be both added and removed'), 400
+
+    added, removed, unknown = current_user.change_list(kind, add, remove)
+    for ids, was_added in ((added, True), (removed, False)):
+        if ids:
+            matcher.list_changed(current_user.id, kind, ids, added=was_added)
+            if kind == 'fabrics':
+                summaries.stash_changed(current_user.id, ids, added=was_added)
+    db.session.commit()
+    unchanged = set(add) | set(remove)
+    unchanged -= set(added) | set(removed) | set(unknown)
+    return jsonify(added=added, removed=removed, unchanged=sorted(unchanged),
+                   unknown=unknown)
 
 
 @main.route('/patterns_list')
 @login_required
 def patterns_list():
     """Get logged in user's patterns list and display in a template."""
-    patterns_list = current_user.patterns_list_items
-    return render_template('patterns_list.html', patterns_list=patterns_list)
+    listing = cached_fragment(
+        ['catalog', 'patterns_list:%d' % current_user.id], ('patterns_list',),
+        lambda: render_template('_patterns_list_items.html',
+                                patterns_list=current_user.patterns_list_items))
+    return render_template('patterns_list.html', listing=listing)
 
 
 @main.route('/add_to_fabrics_list/<fabric_id>', methods=['POST'])
 @login_required
 def add_to_fabrics_list(fabric_id):
     """Add a fabric to the logged in user's fabrics list."""
-    fabric = Fabric.query.get(fabric_id)
-    current_user.fabrics_list_items.append(fabric)
+    fabric = Fabric.query.get_or_404(fabric_id)
+    changed = current_user.add_to_list(fabric)
+    if changed:
+        matcher.list_changed(current_user.id, 'fabrics', [fabric.id],
+                             added=True)
+        summaries.stash_changed(current_user.id, [fabric.id], added=True)
     db.session.commit()
-    flash(f'Fabric "{fabric.name}" was added to your fabrics list!')
-    return redirect(url_for('main.fabrics_list'))
+    return _list_changed(
+        'fabrics', fabric, True, changed,
+        f'Fabric "{fabric.name}" was added to your fabrics list!')
 
 
 @main.route('/remove_from_fabrics_list/<fabric_id>', methods=['POST'])
 @login_required
 def remove_from_fabrics_list(fabric_id):
     """Remove a fabric from the logged in user's fabrics list."""
-    fabric = Fabric.query.get(fabric_id)
-    current_user.fabrics_list_items.remove(fabric)
+    fabric = Fabric.query.get_or_404(fabric_id)
+    changed = current_user.remove_from_list(fabric)
+    if changed:
+        matcher.list_changed(current_user.id, 'fabrics', [fabric.id],
+                             added=False)
+        summaries.stash_changed(current_user.id, [fabric.id], added=False)
     db.session.commit()
-    flash(f'Fabric "{fabric.name}" was removed from your fabrics list!')
-    return redirect(url_for('main.fabrics_list'))
+    return _list_changed(
+        'fabrics', fabric, False, changed,
+        f'Fabric "{fabric.name}" was removed from your fabrics list!')
 
 
 @main.route('/fabrics_list')
 @login_required
 def fabrics_list():
     """Get logged in user's fabrics list and display in a template."""
-    fabrics_list = current_user.fabrics_list_items
-    return render_template('fabrics_list.html', fabrics_list=fabrics_list)
+    listing = cached_fragment(
+        ['catalog', 'fabrics_list:%d' % current_user.id], ('fabrics_list',),
+        lambda: render_template('_fabrics_list_items.html',
+                                fabrics_list=current_user.fabrics_list_items))
+    return render_template('fabrics_list.html', listing=listing)
+
+
+@main.route('/dashboard')
+@login_required
+def dashboard():
+    """Show the yardage and fabric counts of the logged in user's stash
+    next to those of the whole catalog."""
+    return render_template('dashboard.html',
+                           stash=summaries.summary_for(current_user.id),
+                           catalog=summaries.summary_for(summaries.CATALOG))
+
+
+@auth.before_request
+def admit_password_attempts():
+    """Turn away login and signup attempts over their budget before any
+    password is hashed."""
+    if request.method == 'POST' and request.endpoint in PASSWORD_ENDPOINTS:
+        admission.admit(request.form.get('username'), request.remote_addr)
 
 
 @auth.route('/signup', methods=['GET', 'POST'])
 def signup():
     form = SignUpForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(
-            form.password.data).decode('utf-8')
+        hashed_password = hash_password(form.password.data)
         user = User(
             username=form.username.data,
             password=hashed_password
@@ -217,7 +640,12 @@ def signup():
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=form.username.data).first()
+        user = form.user
+        if needs_rehash(user.password):
+            # The configured cost changed; upgrade the stored hash now that
+            # we have the plaintext password
+            user.password = hash_password(form.password.data)
+            db.session.commit()
         login_user(user, remember=True)
         next_page = request.args.get('next')
         return redirect(next_page if next_page else url_for('main.homepage'))
@@ -0,0 +1,240 @@
+"""Full-text search over fabrics and patterns.
+
+SQLite databases get an FTS5 virtual table and Postgres databases a table
+with a weighted tsvector column behind a GIN index. Both cover the name,
+color and PatternCategory of every row and are kept in sync by mapper
+events, so the routes never have to touch the index themselves.
+"""
+import re
+from collections import namedtuple
+
+from sqlalchemy import event, inspect, text
+
+from sewing_app.extensions import db
+from sewing_app.models import Fabric, Pattern
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+SearchHit = namedtuple('SearchHit', 'kind id name color category rank')
+
+
+def search_terms(query):
+    """Split a user query into lowercase word tokens."""
+    return [token.lower() for token in TOKEN_RE.findall(query or '')]
+
+
+def document_for(obj):
+    """Return the (kind, id, name, color, category) row indexed for `obj`."""
+    if isinstance(obj, Fabric):
+        return ('fabric', obj.id, obj.name, obj.color, '')
+    category = str(obj.category) if obj.category else ''
+    return ('pattern', obj.id, obj.name, '', category)
+
+
+class SqliteSearchIndex(object):
+    """Search index stored in an SQLite FTS5 virtual table.
+
+    FTS5 can only look rows up quickly by rowid, so each row is stored
+    under a rowid made from its id and kind (see rowid()) and deleted by
+    it; kind and ref_id are only kept to be returned.
+    """
+
+    KINDS = {'fabric': 0, 'pattern': 1}
+
+    def rowid(self, kind, ref_id):
+        return ref_id * len(self.KINDS) + self.KINDS[kind]
+
+    def create(self, connection):
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+            "kind UNINDEXED, ref_id UNINDEXED, name, color, category, "
+            "prefix='2 3')"))
+
+    def drop(self, connection):
+        connection.execute(text("DROP TABLE IF EXISTS search_index"))
+
+    def delete(self, connection, kind, ref_id):
+        connection.execute(text(
+            "DELETE FROM search_index WHERE rowid = :rowid"),
+            rowid=self.rowid(kind, ref_id))
+
+    def upsert(self, connection, documents):
+        if documents:
+            connection.execute(text(
+                "DELETE FROM search_index WHERE rowid = :rowid"),
+                [dict(rowid=self.rowid(kind, ref_id))
+                 for kind, ref_id, name, color, category in documents])
+        self.insert(connection, documents)
+
+    def insert(self, connection, documents):
+        if documents:
+            connection.execute(text(
+                "INSERT INTO search_index "
+                "(rowid, kind, ref_id, name, color, category) "
+                "VALUES (:rowid, :kind, :ref_id, :name, :color, :category)"),
+                [dict(_params(document),
+                      rowid=self.rowid(document[0], document[1]))
+                 for document in documents])
+
+    def clear(self, connection):
+        connection.execute(text("DELETE FROM search_index"))
+
+    def search(self, connection, terms, limit, offset):
+        # Every term is a quoted prefix query, e.g. "lin"* AND "gre"*
+        match = ' AND '.join('"%s"*' % term for term in terms)
+        rows = connection.execute(text(
+            "SELECT kind, ref_id, name, color, category, "
+            "bm25(search_index, 0, 0, 10.0, 4.0, 2.0) AS rank "
+            "FROM search_index WHERE search_index MATCH :match "
+            "ORDER BY rank, ref_id LIMIT :limit OFFSET :offset"),
+            match=match, limit=limit, offset=offset)
+        return [SearchHit(*row) for row in rows]
+
+
+class PostgresSearchIndex(object):
+    """Search index stored in a tsvector column with a GIN index."""
+
+    DOCUMENT = ("setweight(to_tsvector('simple', :name), 'A') || "
+                "setweight(to_tsvector('simple', :color), 'B') || "
+                "setweight(to_tsvector('simple', :category), 'C')")
+
+    def create(self, connection):
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS search_index ("
+            "kind VARCHAR(10) NOT NULL, ref_id INTEGER NOT NULL, "
+            "name TEXT NOT NULL, color TEXT NOT NULL, category TEXT NOT NULL, "
+            "document TSVECTOR NOT NULL, PRIMARY KEY (kind, ref_id))"))
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_search_index_document "
+            "ON search_index USING GIN (document)"))
+
+    def drop(self, connection):
+        connection.execute(text("DROP TABLE IF EXISTS search_index"))
+
+    def delete(self, connection, kind, ref_id):
+        connection.execute(text(
+            "DELETE FROM search_index WHERE kind = :kind AND ref_id = :ref_id"),
+            kind=kind, ref_id=ref_id)
+
+    def upsert(self, connection, documents):
+        if documents:
+            connection.execute(text(
+                "INSERT INTO search_index "
+                "(kind, ref_id, name, color, category, document) "
+                "VALUES (:kind, :ref_id, :name, :color, :category, %s) "
+                "ON CONFLICT (kind, ref_id) DO UPDATE SET "
+                "name = EXCLUDED.name, color = EXCLUDED.color, "
+                "category = EXCLUDED.category, document = EXCLUDED.document"
+                % self.DOCUMENT),
+                [_params(document) for document in documents])
+
+    insert = upsert
+
+    def clear(self, connection):
+        connection.execute(text("TRUNCATE search_index"))
+
+    def search(self, connection, terms, limit, offset):
+        # Every term is a prefix query, e.g. lin:* & gre:*
+        query = ' & '.join('%s:*' % term for term in terms)
+        rows = connection.execute(text(
+            "SELECT kind, ref_id, name, color, category, "
+            "ts_rank(document, to_tsquery('simple', :query)) AS rank "
+            "FROM search_index WHERE document @@ to_tsquery('simple', :query) "
+            "ORDER BY rank DESC, ref_id LIMIT :limit OFFSET :offset"),
+            query=query, limit=limit, offset=offset)
+        return [SearchHit(*row) for row in rows]
+
+
+BACKENDS = {
+    'sqlite': SqliteSearchIndex(),
+    'postgresql': PostgresSearchIndex(),
+}
+
+
+def _params(document):
+    kind, ref_id, name, color, category = document
+    return dict(kind=kind, ref_id=ref_id, name=name or '',
+                color=color or '', category=category or '')
+
+
+def index_for(connection):
+    """Return the search index backend for the database of `connection`."""
+    return BACKENDS.get(connection.dialect.name)
+
+
+def run_search(query, page=1, per_page=20):
+    """Return (hits, has_next) for one page of ranked prefix matches."""
+    terms = search_terms(query)
+    connection = db.session.connection()
+    index = index_for(connection)
+    if not terms or index is None:
+        return [], False
+    hits = index.search(connection, terms, limit=per_page + 1,
+                        offset=(page - 1) * per_page)
+    return hits[:per_page], len(hits) > per_page
+
+
+def rebuild_index(batch_size=1000):
+    """Rebuild the whole search index from the fabric and pattern tables."""
+    connection = db.session.connection()
+    index = index_for(connection)
+    index.create(connection)
+    index.clear(connection)
+    for model in (Fabric, Pattern):
+        batch = []
+        for obj in model.query.order_by(model.id).yield_per(batch_size):
+            batch.append(document_for(obj))
+            if len(batch) >= batch_size:
+                index.insert(connection, batch)
+                batch = []
+        index.insert(connection, batch)
+
+
+###########################
+# Keeping the index in sync
+###########################
+
+@event.listens_for(db.metadata, 'after_create')
+def create_search_index(target, connection, **kw):
+    index = index_for(connection)
+    if index is not None:
+        index.create(connection)
+
+
+@event.listens_for(db.metadata, 'before_drop')
+def drop_search_index(target, connection, **kw):
+    index = index_for(connection)
+    if index is not None:
+        index.drop(connection)
+
+
+INDEXED_FIELDS = ('name', 'color', 'category')
+
+
+def index_row(mapper, connection, target):
+    """Index a fabric or pattern after it was inserted."""
+    index = index_for(connection)
+    if index is not None:
+        index.upsert(connection, [document_for(target)])
+
+
+def reindex_row(mapper, connection, target):
+    """Reindex a fabric or pattern after one of its indexed fields changed."""
+    state = inspect(target)
+    if any(state.attrs[field].history.has_changes()
+           for field in INDEXED_FIELDS if field in mapper.attrs):
+        index_row(mapper, connection, target)
+
+
+def unindex_row(mapper, connection, target):
+    """Remove a fabric or pattern from the index after it was deleted."""
+    index = index_for(connection)
+    if index is not None:
+        kind = 'fabric' if isinstance(target, Fabric) else 'pattern'
+        index.delete(connection, kind, target.id)
+
+
+for model in (Fabric, Pattern):
+    event.listen(model, 'after_insert', index_row)
+    event.listen(model, 'after_update', reindex_row)
+    event.listen(model, 'after_delete', unindex_row)
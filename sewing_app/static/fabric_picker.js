@@ -0,0 +1,71 @@
+// Typeahead for the pattern form's fabrics select.
+//
+// The select only renders the fabrics that are already tagged. Typing in the
+// search box queries /api/fabrics and clicking a suggestion adds it to the
+// select as a selected option; clicking a selected option removes it.
+(function () {
+  'use strict';
+
+  function debounce(fn, wait) {
+    var timer;
+    return function () {
+      var args = arguments;
+      clearTimeout(timer);
+      timer = setTimeout(function () { fn.apply(null, args); }, wait);
+    };
+  }
+
+  function setUp(select) {
+    var lookupUrl = select.getAttribute('data-fabric-lookup');
+    var input = document.createElement('input');
+    var suggestions = document.createElement('ul');
+    input.type = 'search';
+    input.placeholder = 'Type to find fabrics';
+    input.className = 'fabric-picker-search';
+    suggestions.className = 'fabric-picker-suggestions';
+    select.parentNode.insertBefore(input, select);
+    select.parentNode.insertBefore(suggestions, select);
+
+    function addFabric(fabric) {
+      var existing = select.querySelector('option[value="' + fabric.id + '"]');
+      if (!existing) {
+        existing = new Option(fabric.name, fabric.id);
+        select.add(existing);
+      }
+      existing.selected = true;
+    }
+
+    function showSuggestions(results) {
+      suggestions.innerHTML = '';
+      results.forEach(function (fabric) {
+        var item = document.createElement('li');
+        item.textContent = fabric.name + ' (' + fabric.color + ')';
+        item.addEventListener('click', function () {
+          addFabric(fabric);
+          suggestions.innerHTML = '';
+          input.value = '';
+        });
+        suggestions.appendChild(item);
+      });
+    }
+
+    input.addEventListener('input', debounce(function () {
+      var query = input.value.trim();
+      if (!query) {
+        suggestions.innerHTML = '';
+        return;
+      }
+      fetch(lookupUrl + '?q=' + encodeURIComponent(query))
+        .then(function (response) { return response.json(); })
+        .then(function (data) { showSuggestions(data.results); });
+    }, 200));
+
+    select.addEventListener('click', function (event) {
+      if (event.target.tagName === 'OPTION') {
+        select.removeChild(event.target);
+      }
+    });
+  }
+
+  document.querySelectorAll('select[data-fabric-lookup]').forEach(setUp);
+})();
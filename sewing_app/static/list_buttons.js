@@ -0,0 +1,33 @@
+// Add/remove list buttons without a page reload.
+//
+// A list button posts its form in the background with an X-Fragment header,
+// and the route answers with just the button for the new state (see
+// _list_button.html), which replaces the old one. Anything unexpected falls
+// back to the plain form post and its redirect.
+(function () {
+  'use strict';
+
+  document.addEventListener('submit', function (event) {
+    var form = event.target;
+    if (!form.matches('form.list-button') || !window.fetch) {
+      return;
+    }
+    event.preventDefault();
+    fetch(form.action, {
+      method: 'POST',
+      body: new FormData(form),
+      credentials: 'same-origin',
+      headers: {'X-Fragment': '1'}
+    }).then(function (response) {
+      // e.g. sent to the login page
+      if (!response.ok || response.redirected) {
+        throw new Error('Unexpected response');
+      }
+      return response.text();
+    }).then(function (html) {
+      form.outerHTML = html;
+    }).catch(function () {
+      form.submit();
+    });
+  });
+})();
@@ -0,0 +1,321 @@
+"""Stash dashboard summaries, kept up to date by deltas.
+
+Every fabric contributes its quantity, its color, and the categories of
+the patterns tagged with it (none when untagged) to the StashSummary of
+the whole catalog (owner_id 0) and to that of every user with it on their
+fabrics list. Rather than scanning Fabric and the association tables when
+the dashboard is shown, writers take the contributions of the fabrics they
+touch before and after the change and append the difference to the
+affected rows as StashSummaryChanges, so writers don't queue up behind
+the catalog's row, which every fabric change touches. summary_for() adds a
+row's pending changes to it, and fold() adds them into the rows. A writer
+that leaves a row with more than SUMMARY_MAX_PENDING changes folds that
+row itself, skipping it when another transaction is already folding it,
+so the dashboard reads one row and a tail of bounded length whether or
+not `flask fold-summaries` runs.
+
+Changes made through the ORM (new, edited and deleted fabrics, tags, and
+pattern categories) are picked up by flush listeners. Code that writes
+with Core statements calls stash_changed() for list changes, and
+snapshot() then fabrics_changed() around anything else. rebuild()
+recomputes every row from scratch.
+"""
+from collections import Counter, namedtuple
+from decimal import Decimal
+
+from flask import current_app
+from sqlalchemy import event, func, inspect, select
+
+from sewing_app.extensions import db
+from sewing_app.models import Fabric, Pattern, StashSummary, \
+    StashSummaryChange, fabrics_list, fabrics_patterns, insert_ignore, \
+    tag_changes
+
+table = StashSummary.__table__
+changes = StashSummaryChange.__table__
+fabric_table = Fabric.__table__
+pattern_table = Pattern.__table__
+
+# owner_id of the summary of every fabric
+CATALOG = 0
+
+# What a fabric adds to the summaries it is counted in
+Contribution = namedtuple('Contribution', 'quantity color categories')
+
+
+class SummaryDelta(object):
+    """Changes to add to one StashSummary row."""
+
+    def __init__(self):
+        self.fabric_count = 0
+        self.total_yardage = Decimal(0)
+        self.untagged_count = 0
+        self.colors = Counter()
+        self.categories = Counter()
+
+    def add(self, contribution, sign):
+        self.fabric_count += sign
+        self.total_yardage += sign * contribution.quantity
+        self.colors[contribution.color] += sign * contribution.quantity
+        if not contribution.categories:
+            self.untagged_count += sign
+        for category in contribution.categories:
+            if category is not None:
+                self.categories[category.name] += sign
+
+    def __bool__(self):
+        return bool(self.fabric_count or self.total_yardage or
+                    self.untagged_count or any(self.colors.values()) or
+                    any(self.categories.values()))
+
+
+def _empty(owner_id):
+    return dict(owner_id=owner_id, fabric_count=0, total_yardage=0,
+                untagged_count=0, yardage_by_color={}, count_by_category={})
+
+
+def _add(deltas, owner_id, before, after):
+    if before == after:
+        return
+    delta = deltas.get(owner_id)
+    if delta is None:
+        delta = deltas[owner_id] = SummaryDelta()
+    if before is not None:
+        delta.add(before, -1)
+    if after is not None:
+        delta.add(after, 1)
+
+
+def _merge(values, changes, convert):
+    merged = {key: convert(value) for key, value in (values or {}).items()}
+    for key, change in changes.items():
+        merged[key] = merged.get(key, 0) + convert(change)
+    return {key: value for key, value in merged.items() if value}
+
+
+def _write(deltas):
+    """Append `deltas` (owner id -> SummaryDelta) as changes to their rows."""
+    rows = [dict(owner_id=owner_id, fabric_count=delta.fabric_count,
+                 total_yardage=delta.total_yardage,
+                 untagged_count=delta.untagged_count,
+                 yardage_by_color={color: str(yardage) for color, yardage
+                                   in delta.colors.items() if yardage},
+                 count_by_category={name: count for name, count
+                                    in delta.categories.items() if count})
+            for owner_id, delta in sorted(deltas.items()) if delta]
+    if rows:
+        db.session.execute(changes.insert(), rows)
+        _fold_backlog([row['owner_id'] for row in rows])
+
+
+def _fold_backlog(owner_ids):
+    """Fold the summaries of `owner_ids` with too many pending changes."""
+    query = select([changes.c.owner_id]).where(
+        changes.c.owner_id.in_(owner_ids)).group_by(changes.c.owner_id) \
+        .having(func.count() > current_app.config['SUMMARY_MAX_PENDING'])
+    backlogged = [owner_id for owner_id, in db.session.execute(query)]
+    if backlogged:
+        fold(backlogged, skip_locked=True)
+
+
+def _combine(row, pending):
+    """Return the values of the summary `row` with the `pending` changes
+    added."""
+    fabric_count = row['fabric_count']
+    total_yardage = Decimal(row['total_yardage'])
+    untagged_count = row['untagged_count']
+    colors = _merge(row['yardage_by_color'], {}, Decimal)
+    categories = _merge(row['count_by_category'], {}, int)
+    for change in pending:
+        fabric_count += change.fabric_count
+        total_yardage += Decimal(change.total_yardage)
+        untagged_count += change.untagged_count
+        colors = _merge(colors, change.yardage_by_color, Decimal)
+        categories = _merge(categories, change.count_by_category, int)
+    return dict(owner_id=row['owner_id'], fabric_count=fabric_count,
+                total_yardage=total_yardage, untagged_count=untagged_count,
+                yardage_by_color={color: str(yardage)
+                                  for color, yardage in colors.items()},
+                count_by_category=categories)
+
+
+def _pending(owner_id):
+    """Return the changes of `owner_id` not folded yet, oldest first."""
+    return db.session.execute(select([changes]).where(
+        changes.c.owner_id == owner_id).order_by(changes.c.id)).fetchall()
+
+
+def fold(owner_ids=None, skip_locked=False):
+    """Add the pending changes into the summaries of `owner_ids` (all of
+    them by default) and return the number of summaries folded. With
+    `skip_locked`, rows another transaction is folding are left to it."""
+    if owner_ids is None:
+        owner_ids = [owner_id for owner_id, in db.session.execute(
+            select([changes.c.owner_id]).distinct())]
+    owner_ids = sorted(owner_ids)
+    for owner_id in owner_ids:
+        # Concurrent folds of a row wait for each other here
+        query = select([table]).where(
+            table.c.owner_id == owner_id).with_for_update(
+            skip_locked=skip_locked)
+        row = db.session.execute(query).first()
+        if row is None:
+            insert_ignore(table, **_empty(owner_id))
+            row = db.session.execute(query).first()
+            if row is None:
+                # Locked by another fold
+                continue
+        pending = _pending(owner_id)
+        if not pending:
+            continue
+        db.session.execute(table.update().where(
+            table.c.owner_id == owner_id).values(**_combine(row, pending)))
+        # By id, as changes committed since they were read are not added
+        db.session.execute(changes.delete().where(
+            changes.c.id.in_([change.id for change in pending])))
+    return len(owner_ids)
+
+
+def contributions(fabric_ids):
+    """Return fabric id -> Contribution for the existing `fabric_ids`."""
+    if not fabric_ids:
+        return {}
+    categories = {}
+    query = select([fabrics_patterns.c.fabric_id,
+                    pattern_table.c.category]).distinct().select_from(
+        fabrics_patterns.join(pattern_table)).where(
+        fabrics_patterns.c.fabric_id.in_(fabric_ids))
+    for fabric_id, category in db.session.execute(query):
+        categories.setdefault(fabric_id, set()).add(category)
+
+    query = select([fabric_table.c.id, fabric_table.c.quantity,
+                    fabric_table.c.color]).where(
+        fabric_table.c.id.in_(fabric_ids))
+    return {fabric_id: Contribution(Decimal(quantity), color,
+                                    frozenset(categories.get(fabric_id, ())))
+            for fabric_id, quantity, color in db.session.execute(query)}
+
+
+def _owners(fabric_ids):
+    """Return fabric id -> set of the ids of the users listing it."""
+    owners = {}
+    if fabric_ids:
+        query = select([fabrics_list.c.fabric_id, fabrics_list.c.user_id]) \
+            .where(fabrics_list.c.fabric_id.in_(fabric_ids))
+        for fabric_id, user_id in db.session.execute(query):
+            owners.setdefault(fabric_id, set()).add(user_id)
+    return owners
+
+
+def snapshot(fabric_ids):
+    """Return what fabrics_changed() needs to know about `fabric_ids`
+    before they are changed."""
+    fabric_ids = list(fabric_ids)
+    return contributions(fabric_ids), _owners(fabric_ids)
+
+
+def fabrics_changed(fabric_ids, before=None):
+    """Update the summaries after `fabric_ids` were inserted, changed or
+    deleted, given their snapshot() from before the change (None for new
+    fabrics)."""
+    fabric_ids = list(fabric_ids)
+    old, old_owners = before or ({}, {})
+    new, new_owners = snapshot(fabric_ids)
+    deltas = {}
+    for fabric_id in fabric_ids:
+        was, now = old.get(fabric_id), new.get(fabric_id)
+        listed_before = old_owners.get(fabric_id, set())
+        listed_after = new_owners.get(fabric_id, set())
+        _add(deltas, CATALOG, was, now)
+        for user_id in listed_before | listed_after:
+            _add(deltas, user_id,
+                 was if user_id in listed_before else None,
+                 now if user_id in listed_after else None)
+    _write(deltas)
+
+
+def stash_changed(user_id, fabric_ids, added):
+    """Update a user's summary after `fabric_ids` were added to or removed
+    from their fabrics list."""
+    deltas = {}
+    for contribution in contributions(list(fabric_ids)).values():
+        if added:
+            _add(deltas, user_id, None, contribution)
+        else:
+            _add(deltas, user_id, contribution, None)
+    _write(deltas)
+
+
+def rebuild(batch_size=1000):
+    """Recompute every summary from Fabric and the association tables."""
+    db.session.execute(table.delete())
+    db.session.execute(changes.delete())
+    deltas = {CATALOG: SummaryDelta()}
+    fabric_ids = [fabric_id for fabric_id, in db.session.execute(
+        select([fabric_table.c.id]).order_by(fabric_table.c.id))]
+    for start in range(0, len(fabric_ids), batch_size):
+        found, owners = snapshot(fabric_ids[start:start + batch_size])
+        for fabric_id, contribution in found.items():
+            _add(deltas, CATALOG, None, contribution)
+            for user_id in owners.get(fabric_id, ()):
+                _add(deltas, user_id, None, contribution)
+    _write(deltas)
+    # The catalog has a row even when there are no fabrics
+    insert_ignore(table, **_empty(CATALOG))
+    fold()
+    return len(deltas) - 1
+
+
+def summary_for(owner_id):
+    """Return the StashSummary of a user, or of the catalog for CATALOG,
+    with its pending changes added. It is not added to the session."""
+    row = db.session.execute(select([table]).where(
+        table.c.owner_id == owner_id)).first()
+    return StashSummary(**_combine(row or _empty(owner_id),
+                                   _pending(owner_id)))
+
+
+###########################
+# ORM changes
+###########################
+
+def _changed_fabrics(session):
+    """Return the fabrics whose contribution the pending changes in
+    `session` may change."""
+    fabrics = set()
+    for obj in session.new | session.deleted:
+        if isinstance(obj, Fabric):
+            fabrics.add(obj)
+    for obj in session.dirty:
+        attrs = inspect(obj).attrs
+        if isinstance(obj, Fabric):
+            if attrs.quantity.history.has_changes() or \
+                    attrs.color.history.has_changes():
+                fabrics.add(obj)
+        elif isinstance(obj, Pattern) and attrs.category.history.has_changes():
+            fabrics.update(obj.fabrics)
+    for pairs in tag_changes(session):
+        fabrics.update(fabric for fabric, pattern in pairs)
+    return fabrics
+
+
+@event.listens_for(db.session, 'before_flush')
+def snapshot_changed_fabrics(session, flush_context, instances):
+    fabrics = _changed_fabrics(session)
+    if fabrics:
+        fabric_ids = [inspect(fabric).identity[0] for fabric in fabrics
+                      if inspect(fabric).identity is not None]
+        session.info.setdefault('summary_snapshots', []).append(
+            (fabrics, snapshot(fabric_ids)))
+
+
+@event.listens_for(db.session, 'after_flush')
+def update_summaries(session, flush_context):
+    for fabrics, before in session.info.pop('summary_snapshots', ()):
+        # New fabrics only have their id from here on
+        fabrics_changed([fabric.id for fabric in fabrics], before)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_snapshots(session):
+    session.info.pop('summary_snapshots', None)
@@ -1,10 +1,27 @@
+import gzip
+import io
+import json
 import os
+import shutil
+import struct
+import tempfile
+import threading
 import unittest
-import app
+import zlib
 
+from concurrent.futures import Future
 from datetime import datetime, date
-from sewing_app.extensions import app, db, bcrypt
-from sewing_app.models import Fabric, Pattern, User, PatternCategory
+from decimal import Decimal
+from sewing_app.extensions import db, bcrypt, user_cache
+from sewing_app.caching import SharedCache, FragmentCache
+from sewing_app import admission, assets, benchmark, cooccurrence, fragments, hashing, importer, ledger, matcher, metrics, photo_checks, summaries, thumbnails
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from sewing_app.models import CacheVersion, Fabric, FabricPair, Pattern, YardageEntry, YardageKind, YardageSnapshot, User, PatternCategory, PhotoCheck, StashSummary, TagChange, Thumbnail, recount_tags, fabrics_patterns
+from sewing_app.hashing import hash_password, check_password
+from sewing_app import create_app, migrations
+from sewing_app.migrations import dedupe_association_tables
+
+app = create_app()
 
 """
 Run these tests with the command:
@@ -30,6 +47,16 @@ def logout(client):
     return client.get('/logout', follow_redirects=True)
 
 
+def scrape_metrics(test):
+    """Serve /metrics for the rest of `test` and return its text."""
+    test.addCleanup(app.config.update,
+                    METRICS_ENABLED=app.config['METRICS_ENABLED'],
+                    METRICS_TOKEN=app.config['METRICS_TOKEN'])
+    app.config.update(METRICS_ENABLED=True, METRICS_TOKEN='scraper')
+    return test.app.get('/metrics', headers={
+        'Authorization': 'Bearer scraper'}).get_data(as_text=True)
+
+
 def new_fabric():
     f1 = Fabric(
         name='green canvas',
@@ -51,6 +78,74 @@ def new_pattern():
     # db.session.commit()
 
 
+class FakeRedis(object):
+    """Dict-backed stand-in for a redis client."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+def png(red, green, blue):
+    """Return a 1x1 PNG image of the given color."""
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data)))
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(bytes([0, red, green, blue]))) +
+            chunk(b'IEND', b''))
+
+
+class PhotoServer(object):
+    """Local HTTP stand-in for the hosts of the photos.
+
+    `files` maps paths to (content type, body), or to the URL they
+    redirect to.
+    """
+
+    def __init__(self, files):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path not in files:
+                    self.send_error(404)
+                    return
+                if isinstance(files[path], str):
+                    self.send_response(302)
+                    self.send_header('Location', files[path])
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                content_type, body = files[path]
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_port, path)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
 def create_user():
     # Creates a user with username 'timtam' and password of 'password'
     password_hash = bcrypt.generate_password_hash('password').decode('utf-8')
@@ -68,11 +163,24 @@ class MainTests(unittest.TestCase):
 
     def setUp(self):
         """Executed prior to each test."""
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
         app.config['TESTING'] = True
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['DEBUG'] = False
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['FABRICS_PER_PAGE'] = 24
+        app.config['BCRYPT_LOG_ROUNDS'] = 12
+        app.config['BCRYPT_POOL_SIZE'] = 0
+        app.config['THUMBNAIL_WORKERS'] = 0
+        app.config['THUMBNAIL_DIR'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, app.config['THUMBNAIL_DIR'])
         self.app = app.test_client()
+        user_cache.clear()
+        fragments.reset()
+        admission.reset()
+        matcher.reset()
         db.drop_all()
         db.create_all()
 
@@ -231,6 +339,9 @@ class MainTests(unittest.TestCase):
         # Create a user & login (so that the user can access the route)
         create_user()
         login(self.app, 'timtam', 'password')
+        for name in ['red wool', 'blue silk']:
+            db.session.add(Fabric(name=name, color='mixed', quantity=1))
+        db.session.commit()
 
         # Make a POST request to the /new_pattern route,
         post_data = {
@@ -245,6 +356,49 @@ class MainTests(unittest.TestCase):
         created_pattern = Pattern.query.filter_by(name='Sweatshirt').first()
         self.assertIsNotNone(created_pattern)
         self.assertEqual(created_pattern.name, 'Sweatshirt')
+        self.assertEqual(sorted(f.name for f in created_pattern.fabrics),
+                         ['blue silk', 'red wool'])
+
+    def test_new_pattern_unknown_fabric(self):
+        """Test that tagging a fabric id that doesn't exist fails validation."""
+        create_user()
+        login(self.app, 'timtam', 'password')
+
+        post_data = {
+            'name': 'Sweatshirt',
+            'category': 'OTHER',
+            'fabrics': [1, 2],
+            'photo_url': 'https://example.com/sweatshirt.jpg'
+        }
+        response = self.app.post('/new_pattern', data=post_data)
+        self.assertIn('Not a valid choice', response.get_data(as_text=True))
+        self.assertIsNone(Pattern.query.filter_by(name='Sweatshirt').first())
+
+    def test_api_fabrics(self):
+        """Test the paginated fabric typeahead lookup."""
+        for name in ['red wool', 'red silk', 'blue silk', 'red_felt']:
+            db.session.add(Fabric(name=name, color='mixed', quantity=1))
+        db.session.commit()
+
+        data = self.app.get('/api/fabrics?q=Red&limit=2').get_json()
+        self.assertEqual([f['name'] for f in data['results']],
+                         ['red silk', 'red wool'])
+        self.assertEqual(data['next_cursor'], 1)
+
+        data = self.app.get('/api/fabrics?q=red&limit=2&after=1').get_json()
+        self.assertEqual([f['name'] for f in data['results']], ['red_felt'])
+        self.assertIsNone(data['next_cursor'])
+
+        # LIKE wildcards in the query match literally
+        data = self.app.get('/api/fabrics?q=red_').get_json()
+        self.assertEqual([f['name'] for f in data['results']], ['red_felt'])
+
+        # The prefix is a range of the name index, not a scan
+        plan = db.session.execute(
+            'EXPLAIN QUERY PLAN SELECT id FROM fabric WHERE lower(name) >= '
+            "'red' AND lower(name) < 'ree' ORDER BY lower(name), id").fetchall()
+        self.assertIn('ix_fabric_name_key_id', str(plan))
+        self.assertNotIn('TEMP B-TREE', str(plan))
 
     def test_add_to_fabrics_list(self):
         new_fabric()
@@ -292,3 +446,1359 @@ class MainTests(unittest.TestCase):
             fabric.id == 1 for Fabric in fabrics_list_items)
         self.assertFalse(fabrics_in_fabrics_list,
                          "Fabric with id 1 was found in the user's fabrics list")
+
+    def test_homepage_pagination(self):
+        """Test that the homepage pages through fabrics with id cursors."""
+        app.config['FABRICS_PER_PAGE'] = 2
+        for name in ['red wool', 'blue silk', 'gray felt']:
+            db.session.add(Fabric(name=name, color='mixed', quantity=1))
+        db.session.commit()
+
+        response = self.app.get('/')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('red wool', response_text)
+        self.assertIn('blue silk', response_text)
+        self.assertNotIn('gray felt', response_text)
+        self.assertIn('/?after=2', response_text)
+        self.assertNotIn('before=', response_text)
+
+        response = self.app.get('/?after=2')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('gray felt', response_text)
+        self.assertNotIn('red wool', response_text)
+        self.assertIn('/?before=3', response_text)
+        self.assertNotIn('after=', response_text)
+
+        response = self.app.get('/?before=3')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('red wool', response_text)
+        self.assertNotIn('gray felt', response_text)
+
+    def test_tag_counters(self):
+        """Test that the tag counters follow the fabrics/patterns relationships."""
+        create_user()
+        login(self.app, 'timtam', 'password')
+        for name in ['red wool', 'blue silk']:
+            db.session.add(Fabric(name=name, color='mixed', quantity=1))
+        db.session.commit()
+
+        post_data = {
+            'name': 'Sweatshirt',
+            'category': 'OTHER',
+            'fabrics': [1, 2],
+            'photo_url': 'https://example.com/sweatshirt.jpg'
+        }
+        self.app.post('/new_pattern', data=post_data)
+        pattern = Pattern.query.filter_by(name='Sweatshirt').one()
+        self.assertEqual(pattern.fabric_count, 2)
+        self.assertEqual(Fabric.query.get(1).pattern_count, 1)
+        self.assertEqual(Fabric.query.get(2).pattern_count, 1)
+
+        # Untag the first fabric through the edit form
+        post_data['fabrics'] = [2]
+        self.app.post(f'/pattern/{pattern.id}', data=post_data)
+        db.session.expire_all()
+        self.assertEqual(Pattern.query.get(pattern.id).fabric_count, 1)
+        self.assertEqual(Fabric.query.get(1).pattern_count, 0)
+        self.assertEqual(Fabric.query.get(2).pattern_count, 1)
+
+        # The repair command recomputes drifted counters
+        Fabric.query.update({Fabric.pattern_count: 7})
+        db.session.commit()
+        recount_tags()
+        db.session.commit()
+        self.assertEqual(Fabric.query.get(1).pattern_count, 0)
+        self.assertEqual(Fabric.query.get(2).pattern_count, 1)
+
+    def test_search(self):
+        """Test that fabrics and patterns can be found by name prefix."""
+        new_fabric()
+        create_user()
+        login(self.app, 'timtam', 'password')
+        new_pattern()
+        db.session.commit()
+
+        response = self.app.get('/search?q=gre+canv')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('green canvas', response.get_data(as_text=True))
+
+        response = self.app.get('/api/search?q=jump')
+        results = response.get_json()['results']
+        self.assertEqual([(r['kind'], r['name']) for r in results],
+                         [('pattern', 'cute jumpsuit')])
+
+        # Pattern categories are indexed too
+        response = self.app.get('/api/search?q=other')
+        self.assertEqual(len(response.get_json()['results']), 1)
+
+        # Edits through the detail page are reindexed
+        post_data = {
+            'name': 'Light Linen',
+            'color': 'Lavender',
+            'quantity': 3,
+            'photo_url': 'testurlstring'
+        }
+        self.app.post('/fabric/1', data=post_data)
+        response = self.app.get('/api/search?q=canvas')
+        self.assertEqual(response.get_json()['results'], [])
+        response = self.app.get('/api/search?q=lav')
+        self.assertEqual(response.get_json()['results'][0]['name'],
+                         'Light Linen')
+
+        # Fabric 1 and pattern 1 are separate rows of the index
+        db.session.delete(Pattern.query.get(1))
+        db.session.commit()
+        self.assertEqual(self.app.get('/api/search?q=jump').get_json()['results'],
+                         [])
+        response = self.app.get('/api/search?q=lav')
+        self.assertEqual([r['kind'] for r in response.get_json()['results']],
+                         ['fabric'])
+
+    def test_add_to_list_is_idempotent(self):
+        """Test that adding an item twice stores it once."""
+        new_fabric()
+        create_user()
+        login(self.app, 'timtam', 'password')
+
+        self.app.post('/add_to_fabrics_list/1')
+        self.app.post('/add_to_fabrics_list/1')
+        user = User.query.filter_by(username='timtam').one()
+        self.assertEqual([f.id for f in user.fabrics_list_items], [1])
+
+        response = self.app.post('/add_to_fabrics_list/2')
+        self.assertEqual(response.status_code, 404)
+
+        self.app.post('/remove_from_fabrics_list/1')
+        self.app.post('/remove_from_fabrics_list/1')
+        user = User.query.filter_by(username='timtam').one()
+        self.assertEqual(user.fabrics_list_items, [])
+
+    def test_dedupe_association_tables(self):
+        """Test upgrading a legacy association table without a primary key."""
+        new_fabric()
+        new_pattern()
+        db.session.commit()
+        db.session.execute('DROP TABLE fabrics_patterns')
+        db.session.execute(
+            'CREATE TABLE fabrics_patterns (fabric_id INTEGER, pattern_id INTEGER)')
+        db.session.execute(
+            'INSERT INTO fabrics_patterns VALUES (1, 1), (1, 1), (1, NULL)')
+
+        rebuilt = dedupe_association_tables(db.session.connection())
+        recount_tags()
+        db.session.commit()
+        self.assertIn('fabrics_patterns', rebuilt)
+        self.assertEqual(
+            db.session.execute('SELECT * FROM fabrics_patterns').fetchall(),
+            [(1, 1)])
+        self.assertEqual(Fabric.query.get(1).pattern_count, 1)
+        self.assertEqual(dedupe_association_tables(db.session.connection()), [])
+
+    def test_upgrade_db(self):
+        """Test applying the versioned migrations to a legacy database."""
+        new_fabric()
+        db.session.execute('DROP TABLE stash_summary')
+        db.session.commit()
+
+        applied = migrations.upgrade()
+        self.assertEqual([version for version, name in applied],
+                         [version for version, migration in migrations.MIGRATIONS])
+        self.assertEqual(StashSummary.query.get(0).fabric_count, 1)
+        self.assertEqual(migrations.upgrade(), [])
+        self.assertEqual(migrations.applied_versions(),
+                         {version for version, name in applied})
+
+    def test_create_app(self):
+        """Test that every call of the factory makes its own app."""
+        other = create_app({'FABRICS_PER_PAGE': 2, 'USER_CACHE_SIZE': 3,
+                            'MATCHER_CACHE_SIZE': 4})
+        self.assertIsNot(other, app)
+        self.assertEqual(other.config['FABRICS_PER_PAGE'], 2)
+        self.assertEqual(app.config['FABRICS_PER_PAGE'], 24)
+        self.assertEqual(set(other.blueprints),
+                         {'main', 'auth', 'maintenance'})
+        self.assertIn('upgrade-db', other.cli.commands)
+        # Caches are made per app, with its settings
+        with other.app_context():
+            self.assertEqual(user_cache.maxsize, 3)
+            self.assertEqual(matcher._lists.maxsize, 4)
+        self.assertEqual(user_cache.maxsize, app.config['USER_CACHE_SIZE'])
+
+    def test_fragment_cache(self):
+        """Test that listings are served from the cache until a write."""
+        new_fabric()
+        create_user()
+        login(self.app, 'timtam', 'password')
+
+        self.app.get('/')
+        hits = fragments.fragment_cache.stats.hits
+        response = self.app.get('/')
+        self.assertIn('green canvas', response.get_data(as_text=True))
+        self.assertEqual(fragments.fragment_cache.stats.hits, hits + 1)
+        text = scrape_metrics(self)
+        self.assertIn('sewing_cache_hits_total{cache="fragment"} %d'
+                      % (hits + 1), text)
+        self.assertIn('sewing_cache_misses_total{cache="fragment"} %d'
+                      % fragments.fragment_cache.stats.misses, text)
+
+        post_data = {
+            'name': 'Light Linen',
+            'color': 'Lavender',
+            'quantity': 3,
+            'photo_url': 'testurlstring'
+        }
+        self.app.post('/new_fabric', data=post_data)
+        response = self.app.get('/')
+        self.assertIn('Light Linen', response.get_data(as_text=True))
+
+        # Per-user lists are invalidated by list changes
+        response = self.app.get('/fabrics_list')
+        self.assertIn('Your fabrics list is empty',
+                      response.get_data(as_text=True))
+        self.app.post('/add_to_fabrics_list/2')
+        response = self.app.get('/fabrics_list')
+        self.assertIn('Light Linen', response.get_data(as_text=True))
+
+    def test_fragment_cache_eviction(self):
+        """Test that the fragment cache stays under its memory limit."""
+        cache = FragmentCache(max_bytes=10)
+        cache.set('a', '12345')
+        cache.set('b', '12345')
+        cache.get('a')
+        cache.set('c', '12345')
+        self.assertEqual(cache.size, 10)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), '12345')
+        self.assertEqual(cache.get('c'), '12345')
+
+    def test_conditional_get_homepage(self):
+        """Test that an unchanged homepage is answered with 304."""
+        new_fabric()
+        response = self.app.get('/')
+        etag = response.headers['ETag']
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+
+        response = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+
+        # Other pages of the listing have their own validators
+        response = self.app.get('/?after=1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        # Writes bump the catalog version
+        create_user()
+        post_data = {
+            'name': 'Light Linen',
+            'color': 'Lavender',
+            'quantity': 3,
+            'photo_url': 'testurlstring'
+        }
+        login(self.app, 'timtam', 'password')
+        self.app.post('/new_fabric', data=post_data)
+        logout(self.app)
+        response = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Light Linen', response.get_data(as_text=True))
+
+    def test_conditional_get_fabric_detail(self):
+        """Test ETag validation of the fabric detail page."""
+        new_fabric()
+        create_user()
+        login(self.app, 'timtam', 'password')
+        self.app.get('/fabric/1')
+
+        response = self.app.get('/fabric/1')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertIn('private', response.headers['Cache-Control'])
+        # The page shows more than the row, so updated_at is no validator
+        self.assertNotIn('Last-Modified', response.headers)
+
+        response = self.app.get('/fabric/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # A recorded cut shows even to clients sending If-Modified-Since
+        self.app.post('/fabric/1/yardage', data=dict(kind='CUT', yards='1'),
+                      follow_redirects=True)
+        response = self.app.get('/fabric/1', headers={
+            'If-None-Match': etag,
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('-1.00 yds', response.get_data(as_text=True))
+        etag = response.headers['ETag']
+
+        fabric = Fabric.query.get(1)
+        fabric.updated_at = datetime(2100, 1, 1)
+        db.session.commit()
+        response = self.app.get('/fabric/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_import_fabrics_csv(self):
+        """Test bulk importing fabrics from a CSV upload."""
+        create_user()
+        login(self.app, 'timtam', 'password')
+
+        csv_data = (b'name,color,quantity,photo_url\n'
+                    b'red wool,red,2.5,https://example.com/red.jpg\n'
+                    b'x,blue,1,https://example.com/x.jpg\n'
+                    b'blue silk,blue,lots,https://example.com/blue.jpg\n'
+                    b'gray felt,gray,1,https://example.com/gray.jpg\n'
+                    b'bolt,tan,10000000,https://example.com/bolt.jpg\n'
+                    b'full bolt,tan,9999999.99,https://example.com/bolt.jpg\n'
+                    + b'long name,' + b'c' * 81 +
+                    b',1,https://example.com/long.jpg\n')
+        response = self.app.post('/import/fabrics', data={
+            'file': (io.BytesIO(csv_data), 'stash.csv')})
+        report = response.get_json()
+        self.assertEqual(report['inserted'], 3)
+        self.assertEqual(report['failed'], 4)
+        self.assertEqual([error['line'] for error in report['errors']],
+                         [3, 4, 6, 8])
+        self.assertIn('name', report['errors'][0]['errors'])
+        self.assertIn('quantity', report['errors'][1]['errors'])
+        self.assertIn('quantity', report['errors'][2]['errors'])
+        self.assertIn('color', report['errors'][3]['errors'])
+        fabric = Fabric.query.filter_by(name='full bolt').one()
+        self.assertEqual(str(fabric.quantity), '9999999.99')
+
+        fabric = Fabric.query.filter_by(name='gray felt').one()
+        self.assertEqual(fabric.created_by.username, 'timtam')
+        self.assertEqual(float(fabric.quantity), 1)
+        # Imported rows are searchable
+        response = self.app.get('/api/search?q=gray')
+        self.assertEqual(response.get_json()['results'][0]['name'], 'gray felt')
+
+    def test_import_invalid_utf8(self):
+        """Test that lines which are not UTF-8 are reported as row errors."""
+        create_user()
+        login(self.app, 'timtam', 'password')
+
+        csv_data = (b'name,color,quantity,photo_url\n'
+                    b'\xff\xfe,red,1,https://example.com/a.jpg\n'
+                    b'tan felt,tan,1,https://example.com/b.jpg\n')
+        response = self.app.post('/import/fabrics', data={
+            'file': (io.BytesIO(csv_data), 'stash.csv')})
+        self.assertEqual(response.status_code, 200)
+        report = response.get_json()
+        self.assertEqual(report['inserted'], 1)
+        self.assertEqual(report['errors'],
+                         [{'line': 2, 'errors': {'row': 'Invalid UTF-8'}}])
+
+        body = (b'{"name": "\xff"}\n'
+                b'{"name": "Tote", "photo_url": "https://example.com/t.jpg"}\n')
+        response = self.app.post('/import/patterns', data=body,
+                                 content_type='application/x-ndjson')
+        report = response.get_json()
+        self.assertEqual(report['inserted'], 1)
+        self.assertEqual(report['errors'],
+                         [{'line': 1, 'errors': {'row': 'Invalid UTF-8'}}])
+
+    def test_import_patterns_jsonl(self):
+        """Test bulk importing patterns with fabric tags from JSONL."""
+        new_fabric()
+        create_user()
+        login(self.app, 'timtam', 'password')
+
+        lines = [
+            {'name': 'Sweatshirt', 'category': 'shirt',
+             'photo_url': 'https://example.com/s.jpg',
+             'fabrics': ['green canvas']},
+            {'name': 'Tote', 'photo_url': 'https://example.com/t.jpg',
+             'fabrics': ['missing fabric']},
+            # Longer than the 80 characters of pattern.name
+            {'name': 'Q' * 90, 'photo_url': 'https://example.com/q.jpg'},
+        ]
+        body = '\n'.join(json.dumps(line) for line in lines) + '\nnot json\n'
+        response = self.app.post('/import/patterns', data=body,
+                                 content_type='application/x-ndjson')
+        report = response.get_json()
+        self.assertEqual(report['inserted'], 1)
+        self.assertEqual([error['line'] for error in report['errors']],
+                         [2, 3, 4])
+        self.assertIn('name', report['errors'][1]['errors'])
+
+        pattern = Pattern.query.filter_by(name='Sweatshirt').one()
+        self.assertEqual(pattern.category, PatternCategory.SHIRT)
+        self.assertEqual([f.name for f in pattern.fabrics], ['green canvas'])
+        self.assertEqual(pattern.fabric_count, 1)
+        self.assertEqual(Fabric.query.get(1).pattern_count, 1)
+
+    def test_export(self):
+        """Test streaming a user's stash as CSV, JSONL and gzip."""
+        new_fabric()
+        create_user()
+        login(self.app, 'timtam', 'password')
+        self.app.post('/new_pattern', data={
+            'name': 'Sweatshirt',
+            'category': 'SHIRT',
+            'fabrics': [1],
+            'photo_url': 'https://example.com/sweatshirt.jpg'
+        })
+        self.app.post('/add_to_fabrics_list/1')
+        self.app.post('/add_to_patterns_list/1')
+
+        response = self.app.get('/export/fabrics')
+        self.assertEqual(response.mimetype, 'text/csv')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'id,name,color,quantity,photo_url')
+        self.assertTrue(lines[1].startswith('1,green canvas,green,2.75,'))
+
+        response = self.app.get('/export/patterns?format=jsonl')
+        rows = [json.loads(line) for line in
+                response.get_data(as_text=True).splitlines()]
+        self.assertEqual(rows, [{
+            'id': 1, 'name': 'Sweatshirt', 'category': 'SHIRT',
+            'photo_url': 'https://example.com/sweatshirt.jpg',
+            'fabrics': ['green canvas']}])
+
+        response = self.app.get('/export/tags?gzip=1')
+        self.assertIn('tags.csv.gz', response.headers['Content-Disposition'])
+        self.assertEqual(
+            gzip.decompress(response.get_data()).decode('utf-8').splitlines(),
+            ['pattern_id,pattern_name,fabric_id,fabric_name',
+             '1,Sweatshirt,1,green canvas'])
+
+    def test_export_round_trip(self):
+        """Test that exported fabrics and patterns import back."""
+        new_fabric()
+        db.session.add(Fabric(name='red wool', color='red', quantity=3,
+                              photo_url='https://example.com/red.jpg'))
+        db.session.commit()
+        create_user()
+        login(self.app, 'timtam', 'password')
+        self.app.post('/new_pattern', data={
+            'name': 'Sweatshirt', 'category': 'SHIRT', 'fabrics': [1, 2],
+            'photo_url': 'https://example.com/sweatshirt.jpg'})
+        self.app.post('/new_pattern', data={
+            'name': 'Tote', 'category': 'OTHER', 'fabrics': [],
+            'photo_url': 'https://example.com/tote.jpg'})
+        for fabric_id in (1, 2):
+            self.app.post('/add_to_fabrics_list/%d' % fabric_id)
+        for pattern_id in (1, 2):
+            self.app.post('/add_to_patterns_list/%d' % pattern_id)
+
+        exports = {fmt: [self.app.get('/export/%s?format=%s' % (kind, fmt))
+                         .get_data() for kind in ('fabrics', 'patterns')]
+                   for fmt in importer.FORMATS}
+        for fmt, (fabrics, patterns) in exports.items():
+            # Import into an empty database
+            user_cache.clear()
+            fragments.reset()
+            matcher.reset()
+            db.drop_all()
+            db.create_all()
+            report = importer.import_fabrics(
+                importer.read_rows(io.BytesIO(fabrics), fmt))
+            self.assertEqual((report.inserted, report.failed), (2, 0))
+            report = importer.import_patterns(
+                importer.read_rows(io.BytesIO(patterns), fmt))
+            self.assertEqual((report.inserted, report.failed), (2, 0))
+
+            sweatshirt = Pattern.query.filter_by(name='Sweatshirt').one()
+            self.assertEqual(sweatshirt.category, PatternCategory.SHIRT)
+            self.assertEqual(sorted(f.name for f in sweatshirt.fabrics),
+                             ['green canvas', 'red wool'])
+            self.assertEqual(
+                Pattern.query.filter_by(name='Tote').one().fabrics, [])
+            self.assertEqual(
+                float(Fabric.query.filter_by(name='red wool').one().quantity),
+                3)
+
+    def start_photo_server(self):
+        server = PhotoServer({
+            '/green.png': ('image/png', png(0, 255, 0)),
+            '/red.png': ('image/png', png(255, 0, 0)),
+            '/page.html': ('text/html', b'<html></html>'),
+            '/metadata.png': 'http://169.254.169.254/latest/meta-data/',
+        })
+        self.addCleanup(server.close)
+        # The stub listens on loopback, which is refused otherwise
+        allowed = app.config['PHOTO_ALLOWED_NETWORKS']
+        app.config['PHOTO_ALLOWED_NETWORKS'] = ['127.0.0.1/32']
+        self.addCleanup(app.config.__setitem__, 'PHOTO_ALLOWED_NETWORKS',
+                        allowed)
+        return server
+
+    def test_thumbnails(self):
+        """Test that photos are served from local content-addressed thumbnails."""
+        server = self.start_photo_server()
+        green_url = server.url('/green.png')
+        db.session.add(Fabric(name='green canvas', color='green',
+                              quantity=1, photo_url=green_url))
+        db.session.add(Fabric(name='broken', color='gray', quantity=1,
+                              photo_url=server.url('/page.html')))
+        # Same photo under another URL
+        db.session.add(Pattern(name='cute jumpsuit',
+                               category=PatternCategory.OTHER,
+                               photo_url=green_url + '?w=370'))
+        db.session.commit()
+
+        thumb_path = '/thumbnails/%s' % thumbnails.url_key(green_url)
+        self.assertIn(thumb_path, self.app.get('/').get_data(as_text=True))
+
+        # Until the thumbnail is made the photo itself is shown
+        response = self.app.get(thumb_path)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.location, green_url)
+        self.assertIn('no-store', response.headers['Cache-Control'])
+
+        self.assertEqual(thumbnails.fetch_pending(), (2, 1))
+        files = [name for _, _, names in os.walk(app.config['THUMBNAIL_DIR'])
+                 for name in names]
+        self.assertEqual(len(files), 1)
+        broken = Thumbnail.query.filter(Thumbnail.url.like('%page.html')).one()
+        self.assertIsNone(broken.digest)
+        self.assertIn('text/html', broken.error)
+
+        response = self.app.get(thumb_path)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.mimetype.startswith('image/'))
+        self.assertIn('max-age=%d' % app.config['THUMBNAIL_MAX_AGE'],
+                      response.headers['Cache-Control'])
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        response.close()
+        response = self.app.get(thumb_path, headers={
+            'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        response.close()
+
+    def test_thumbnail_internal_addresses(self):
+        """Test that photos are not fetched from internal addresses."""
+        server = self.start_photo_server()
+        urls = dict(metadata='http://169.254.169.254/latest/meta-data/',
+                    private='http://10.0.0.1/x.png',
+                    redirected=server.url('/metadata.png'))
+        for name, url in urls.items():
+            db.session.add(Fabric(name=name, color='red', quantity=1,
+                                  photo_url=url))
+        db.session.commit()
+        self.assertEqual(thumbnails.fetch_pending(), (0, 3))
+        for url in urls.values():
+            thumb = Thumbnail.query.get(thumbnails.url_key(url))
+            self.assertIn('not a public address', thumb.error)
+
+        # Loopback is only allowed through PHOTO_ALLOWED_NETWORKS
+        app.config['PHOTO_ALLOWED_NETWORKS'] = []
+        with self.assertRaises(thumbnails.BlockedAddress):
+            thumbnails.check_url(server.url('/green.png'))
+        with self.assertRaises(thumbnails.BlockedAddress):
+            thumbnails.check_url('http://[::ffff:127.0.0.1]/x.png')
+
+    def test_photo_checks(self):
+        """Test flagging the photo URLs that are not images any more."""
+        server = self.start_photo_server()
+        closed = PhotoServer({})
+        closed.close()
+        urls = dict(green=server.url('/green.png'), page=server.url('/page.html'),
+                    gone=server.url('/gone.png'), closed=closed.url('/x.png'),
+                    internal=server.url('/metadata.png'))
+        for name, url in urls.items():
+            db.session.add(Fabric(name=name, color='red', quantity=1,
+                                  photo_url=url))
+        db.session.add(Pattern(name='same photo', photo_url=urls['green']))
+        db.session.commit()
+
+        self.assertEqual(photo_checks.check_all(per_host=1), (5, 4))
+        checks = {check.url: check for check in PhotoCheck.query}
+        # The stub has no HEAD, so the checker falls back to GET
+        self.assertEqual((checks[urls['green']].status,
+                          checks[urls['green']].content_type,
+                          checks[urls['green']].dead), (200, 'image/png', False))
+        self.assertEqual(photo_checks.reason(checks[urls['page']]),
+                         'Not an image (text/html)')
+        self.assertEqual(photo_checks.reason(checks[urls['gone']]), 'HTTP 404')
+        self.assertIsNone(checks[urls['closed']].status)
+        self.assertTrue(checks[urls['closed']].dead)
+        # The redirect to the metadata service is not followed
+        self.assertIsNone(checks[urls['internal']].status)
+        self.assertIn('not a public address',
+                      photo_checks.reason(checks[urls['internal']]))
+        self.assertEqual([check.url for check, used_by
+                          in photo_checks.dead_links()],
+                         sorted([urls['page'], urls['gone'], urls['closed'],
+                                 urls['internal']]))
+        self.assertEqual(photo_checks.check_all(unchecked=True), (0, 0))
+        # Writing results of URLs already checked updates them
+        photo_checks._record([(urls['gone'], 200, 'image/png', None)])
+        db.session.expire_all()
+        self.assertFalse(PhotoCheck.query.get(
+            thumbnails.url_key(urls['gone'])).dead)
+        photo_checks._record([(urls['gone'], 404, None, None)])
+
+        # Dead photos are not redirected to
+        response = self.app.get('/thumbnails/%s' % thumbnails.url_key(urls['gone']))
+        self.assertEqual(response.status_code, 404)
+
+        # Checking on save
+        app.config['PHOTO_CHECK_ON_SAVE'] = True
+        try:
+            fabric = Fabric.query.filter_by(name='gone').one()
+            fabric.photo_url = server.url('/red.png')
+            db.session.commit()
+            photo_checks._get_pool().submit(lambda: None).result()
+        finally:
+            app.config['PHOTO_CHECK_ON_SAVE'] = False
+        check = PhotoCheck.query.get(thumbnails.url_key(server.url('/red.png')))
+        self.assertFalse(check.dead)
+
+    def test_thumbnail_eviction(self):
+        """Test that the least recently used thumbnails are evicted."""
+        server = self.start_photo_server()
+        green_url, red_url = server.url('/green.png'), server.url('/red.png')
+        db.session.add(Fabric(name='green canvas', color='green',
+                              quantity=1, photo_url=green_url))
+        db.session.commit()
+        thumbnails.fetch_pending()
+        green = Thumbnail.query.get(thumbnails.url_key(green_url))
+        max_bytes = app.config['THUMBNAIL_MAX_BYTES']
+        app.config['THUMBNAIL_MAX_BYTES'] = green.size
+        try:
+            db.session.add(Fabric(name='red canvas', color='red',
+                                  quantity=1, photo_url=red_url))
+            db.session.commit()
+            self.assertEqual(thumbnails.fetch_pending(), (1, 0))
+        finally:
+            app.config['THUMBNAIL_MAX_BYTES'] = max_bytes
+
+        db.session.expire_all()
+        self.assertIsNone(Thumbnail.query.get(green.key).digest)
+        self.assertEqual(self.app.get('/thumbnails/%s' % green.key).location,
+                         green_url)
+        red = Thumbnail.query.get(thumbnails.url_key(red_url))
+        self.assertIsNotNone(thumbnails.stored_path(red))
+
+    def test_read_replica(self):
+        """Test that GET requests read from the replica until the client
+        writes something."""
+        path = tempfile.mkstemp(suffix='.db')[1]
+        self.addCleanup(os.remove, path)
+        app.config['SQLALCHEMY_BINDS'] = {'replica': 'sqlite:///' + path}
+        self.addCleanup(app.config.__setitem__, 'SQLALCHEMY_BINDS', None)
+        replica = db.get_engine(app, bind='replica')
+        self.assertEqual(replica.execute('PRAGMA journal_mode').scalar(), 'wal')
+        db.Model.metadata.create_all(replica)
+        replica.execute(Fabric.__table__.insert().values(
+            name='replica canvas', color='blue', quantity=1,
+            photo_url='https://example.com/blue.jpg'))
+        new_fabric()
+
+        response_text = self.app.get('/').get_data(as_text=True)
+        self.assertIn('replica canvas', response_text)
+        self.assertNotIn('green canvas', response_text)
+
+        # Signing up writes to the primary, which is then read for a while
+        self.app.post('/signup', data=dict(username='timtam',
+                                           password='password'))
+        fragments.reset()
+        response_text = self.app.get('/').get_data(as_text=True)
+        self.assertIn('green canvas', response_text)
+        self.assertNotIn('replica canvas', response_text)
+
+        app.config['REPLICA_STICKY_SECONDS'] = 0
+        self.addCleanup(app.config.__setitem__, 'REPLICA_STICKY_SECONDS', 10)
+        self.app.post('/signup', data=dict(username='tamtim',
+                                           password='password'))
+        fragments.reset()
+        self.assertIn('replica canvas', self.app.get('/').get_data(as_text=True))
+
+    def test_metrics(self):
+        """Test the Server-Timing header, slow request log and /metrics."""
+        new_fabric()
+        self.assertNotIn('Server-Timing', self.app.get('/').headers)
+        self.assertEqual(self.app.get('/metrics').status_code, 404)
+
+        app.config['METRICS_ENABLED'] = True
+        app.config['SLOW_REQUEST_SECONDS'] = 0
+        self.addCleanup(app.config.update, METRICS_ENABLED=False,
+                        SLOW_REQUEST_SECONDS=0.5)
+        # Only scrapers with the token get the numbers
+        self.assertEqual(self.app.get('/metrics').status_code, 404)
+        app.config['METRICS_TOKEN'] = 'scraper'
+        self.addCleanup(app.config.__setitem__, 'METRICS_TOKEN', None)
+        self.assertEqual(self.app.get('/metrics').status_code, 401)
+        self.assertEqual(self.app.get('/metrics', headers={
+            'Authorization': 'Bearer wrong'}).status_code, 401)
+        metrics.reset()
+        fragments.reset()
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            response = self.app.get('/')
+            text = self.app.get('/metrics', headers={
+                'Authorization': 'Bearer scraper'}).get_data(as_text=True)
+        self.assertRegex(response.headers['Server-Timing'],
+                         r'^sql;dur=[0-9.]+;desc="[1-9][0-9]* queries", '
+                         r'render;dur=[0-9.]+, total;dur=[0-9.]+$')
+        self.assertIn('Slow request: GET /?', logs.output[0])
+
+        self.assertIn('# TYPE sewing_request_duration_seconds histogram', text)
+        self.assertIn('sewing_request_duration_seconds_count'
+                      '{endpoint="main.homepage"} 1', text)
+        self.assertIn('sewing_request_queries_bucket'
+                      '{endpoint="main.homepage",le="+Inf"} 1', text)
+        # Static files are not instrumented
+        self.app.get('/static/style.css').close()
+        self.assertNotIn('endpoint="static"', metrics.render())
+
+    def test_benchmark(self):
+        """Test the synthetic data generator and the benchmark runner."""
+        counts = benchmark.generate(users=3, fabrics=30, patterns=10, seed=7)
+        self.assertEqual(Fabric.query.count(), 30)
+        self.assertEqual(db.session.query(fabrics_patterns).count(),
+                         counts['fabrics_patterns'])
+        self.assertEqual(sum(f.pattern_count for f in Fabric.query),
+                         counts['fabrics_patterns'])
+
+        results = benchmark.run_benchmark(
+            [dict(users=3, fabrics=30, patterns=10)], requests=3,
+            scenarios=['homepage', 'fabrics_list', 'login'])
+        endpoints = results['sizes']['3u-30f-10p']['endpoints']
+        self.assertEqual(set(endpoints), {'homepage', 'fabrics_list', 'login'})
+        for figures in endpoints.values():
+            self.assertEqual(figures['errors'], 0)
+            self.assertGreater(figures['peak_kib'], 0)
+        json.dumps(results)
+
+        self.assertEqual(benchmark.compare(results, results), [])
+        slower = json.loads(json.dumps(results))
+        slower['sizes']['3u-30f-10p']['endpoints']['login']['queries'] += 5
+        self.assertEqual(len(benchmark.compare(results, slower)), 1)
+
+    def test_stash_matches(self):
+        """Test ranking saved patterns by the fabric the user owns."""
+        fabrics = [Fabric(name='fabric %d' % i, color='red', quantity=1,
+                          photo_url='https://example.com/%d.jpg' % i)
+                   for i in range(1, 5)]
+        db.session.add_all(fabrics)
+        tagged = [[0, 1], [0, 2], [2], []]
+        for i, fabric_indexes in enumerate(tagged, start=1):
+            db.session.add(Pattern(
+                name='pattern %d' % i, category=PatternCategory.OTHER,
+                photo_url='https://example.com/p%d.jpg' % i,
+                fabrics=[fabrics[index] for index in fabric_indexes]))
+        db.session.commit()
+        create_user()
+        login(self.app, 'timtam', 'password')
+        for pattern_id in (1, 2, 3, 4):
+            self.app.post('/add_to_patterns_list/%d' % pattern_id)
+        for fabric_id in (1, 2):
+            self.app.post('/add_to_fabrics_list/%d' % fabric_id)
+
+        result = self.app.get('/api/matches').get_json()
+        self.assertEqual([match['name'] for match in result['full']],
+                         ['pattern 1'])
+        self.assertEqual([(match['id'], match['owned'], match['needed'],
+                           match['missing']) for match in result['partial']],
+                         [(2, 1, 2, [3])])
+
+        # Changes are applied to the index in place
+        stash = matcher._lists.get('fabrics_list:1')
+        self.app.post('/add_to_fabrics_list/3')
+        result = self.app.get('/api/matches').get_json()
+        self.assertEqual([match['id'] for match in result['full']], [1, 2, 3])
+        self.assertEqual(result['partial'], [])
+        self.assertIs(matcher._lists.get('fabrics_list:1'), stash)
+
+        tags = matcher._tags
+        version = tags.version
+        pattern = Pattern.query.get(1)
+        pattern.fabrics.append(Fabric.query.get(4))
+        # The counter is only bumped, and its row locked, at commit
+        db.session.flush()
+        self.assertEqual(CacheVersion.query.get('tags').version, version)
+        db.session.commit()
+        self.assertEqual(CacheVersion.query.get('tags').version, version + 1)
+        self.assertEqual(TagChange.query.get(version + 1).changes,
+                         [[True, 4, 1]])
+        result = self.app.get('/api/matches').get_json()
+        self.assertEqual([match['id'] for match in result['full']], [2, 3])
+        self.assertEqual(result['partial'][0]['missing'], [4])
+        self.assertIs(matcher._tags, tags)
+
+        # Another process applies the logged changes it missed instead of
+        # reloading every tag
+        behind = matcher.TagIndex(tags.version, [
+            (fabric_id, pattern_id)
+            for pattern_id, fabric_ids in tags.tags.items()
+            for fabric_id in fabric_ids])
+        matcher.reset()
+        pattern = Pattern.query.get(1)
+        pattern.fabrics.remove(Fabric.query.get(4))
+        db.session.commit()
+        matcher._tags = behind
+        result = self.app.get('/api/matches').get_json()
+        self.assertEqual([match['id'] for match in result['full']], [1, 2, 3])
+        self.assertIs(matcher._tags, behind)
+        self.assertEqual(behind.tags[1], {1, 2})
+
+        # One too far behind for the log reloads
+        matcher._tags = matcher.TagIndex(0, [])
+        result = self.app.get('/api/matches').get_json()
+        self.assertEqual([match['id'] for match in result['full']], [1, 2, 3])
+        self.assertEqual(matcher._tags.tags, behind.tags)
+
+    def test_bulk_list_changes(self):
+        """Test adding and removing many list items in one request."""
+        for i in range(1, 4):
+            db.session.add(Fabric(name='fabric %d' % i, color='red', quantity=1,
+                                  photo_url='https://example.com/%d.jpg' % i))
+        db.session.commit()
+        create_user()
+        login(self.app, 'timtam', 'password')
+
+        response = self.app.post('/api/lists/fabrics',
+                                 json=dict(add=[1, 2, 99], remove=[3]))
+        self.assertEqual(response.get_json(), dict(
+            added=[1, 2], removed=[], unchanged=[3], unknown=[99]))
+        response = self.app.post('/api/lists/fabrics',
+                                 json=dict(add=[2, 3], remove=[1]))
+        self.assertEqual(response.get_json(), dict(
+            added=[3], removed=[1], unchanged=[2], unknown=[]))
+
+        user = User.query.filter_by(username='timtam').one()
+        self.assertEqual([fabric.id for fabric in user.fabrics_list_items],
+                         [2, 3])
+        # The cached list fragment and the summaries follow
+        self.assertIn('fabric 3', self.app.get('/fabrics_list').get_data(
+            as_text=True))
+        self.assertEqual(summaries.summary_for(user.id).fabric_count, 2)
+
+        response = self.app.post('/api/lists/patterns', json=dict(add=[1]))
+        self.assertEqual(response.get_json()['unknown'], [1])
+        for body in (dict(add='1'), dict(add=[True]), dict(add=[1], remove=[1]),
+                     dict(add=list(range(2000)))):
+            response = self.app.post('/api/lists/fabrics', json=body)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.app.post('/api/lists/users', json={}).status_code,
+                         404)
+
+    def test_stash_summaries(self):
+        """Test the dashboard summaries kept up to date by deltas."""
+        def all_summaries():
+            summaries.fold()
+            return {row.owner_id: (row.fabric_count, float(row.total_yardage),
+                                   row.untagged_count, row.yardage_by_color,
+                                   row.count_by_category)
+                    for row in StashSummary.query}
+
+        create_user()
+        login(self.app, 'timtam', 'password')
+        self.app.post('/new_fabric', data=dict(
+            name='red wool', color='red', quantity=2.5,
+            photo_url='https://example.com/red.jpg'))
+        self.app.post('/new_fabric', data=dict(
+            name='blue silk', color='blue', quantity=1,
+            photo_url='https://example.com/blue.jpg'))
+        self.app.post('/add_to_fabrics_list/1')
+        self.app.post('/add_to_fabrics_list/2')
+        self.app.post('/new_pattern', data=dict(
+            name='Vest', category='SHIRT', photo_url='https://example.com/v.jpg',
+            fabrics=['1']))
+
+        summary = summaries.summary_for(1)
+        self.assertEqual(summary.fabric_count, 2)
+        self.assertEqual(summary.total_yardage, 3.5)
+        self.assertEqual(summary.untagged_count, 1)
+        self.assertEqual(summary.colors, [('red', 2.5), ('blue', 1)])
+        self.assertEqual(summary.categories, [(PatternCategory.SHIRT, 1)])
+
+        # Edits, category changes, removals, imports and deletes
+        self.app.post('/fabric/2', data=dict(
+            name='blue silk', color='red', quantity=3,
+            photo_url='https://example.com/blue.jpg'))
+        self.app.post('/pattern/1', data=dict(
+            name='Vest', category='JACKET', photo_url='https://example.com/v.jpg',
+            fabrics=['1', '2']))
+        self.app.post('/remove_from_fabrics_list/1')
+        self.app.post('/import/patterns', data=json.dumps(dict(
+            name='Tote', category='accessory',
+            photo_url='https://example.com/t.jpg', fabrics=['blue silk'])),
+            content_type='application/x-ndjson')
+        self.app.post('/import/fabrics', data={'file': (io.BytesIO(
+            b'name,color,quantity,photo_url\n'
+            b'gray felt,gray,1.25,https://example.com/gray.jpg\n'),
+            'stash.csv')})
+        db.session.delete(Fabric.query.get(1))
+        db.session.commit()
+
+        summary = summaries.summary_for(1)
+        self.assertEqual(summary.fabric_count, 1)
+        self.assertEqual(summary.colors, [('red', 3)])
+        self.assertEqual(summary.categories, [(PatternCategory.ACCESSORY, 1),
+                                              (PatternCategory.JACKET, 1)])
+        incremental = all_summaries()
+        self.assertEqual(incremental[summaries.CATALOG][:3], (2, 4.25, 1))
+        summaries.rebuild()
+        db.session.commit()
+        self.assertEqual(all_summaries(), incremental)
+
+        response = self.app.get('/dashboard')
+        self.assertIn(b'red: 3.00 yards', response.data)
+        self.assertIn(b'gray: 1.25 yards', response.data)
+        self.assertIn(b'Jacket: 1 fabrics', response.data)
+
+    def test_stash_summaries_fold_backlog(self):
+        """Test that writers keep the tail of pending changes short."""
+        self.addCleanup(app.config.__setitem__, 'SUMMARY_MAX_PENDING',
+                        app.config['SUMMARY_MAX_PENDING'])
+        app.config['SUMMARY_MAX_PENDING'] = 2
+        for i in range(7):
+            db.session.add(Fabric(name='fabric %d' % i, color='red',
+                                  quantity=1))
+            db.session.commit()
+            self.assertLessEqual(
+                len(summaries._pending(summaries.CATALOG)), 2)
+        catalog = summaries.summary_for(summaries.CATALOG)
+        self.assertEqual((catalog.fabric_count, catalog.total_yardage),
+                         (7, 7))
+
+        # Without a tail the dashboard reads the summary row alone
+        app.config['SUMMARY_MAX_PENDING'] = 0
+        db.session.add(Fabric(name='fabric 7', color='blue', quantity=2))
+        db.session.commit()
+        self.assertEqual(summaries._pending(summaries.CATALOG), [])
+        row = StashSummary.query.get(summaries.CATALOG)
+        self.assertEqual((row.fabric_count, row.yardage_by_color),
+                         (8, {'red': '7.00', 'blue': '2.00'}))
+
+    def test_stash_summaries_pattern_changes(self):
+        """Test that retagging and deleting patterns reach the summaries."""
+        red = Fabric(name='red wool', color='red', quantity=2)
+        blue = Fabric(name='blue silk', color='blue', quantity=1)
+        vest = Pattern(name='Vest', category=PatternCategory.SHIRT,
+                       fabrics=[red])
+        db.session.add_all([red, blue, vest])
+        db.session.commit()
+        catalog = summaries.summary_for(summaries.CATALOG)
+        self.assertEqual((catalog.untagged_count, catalog.categories),
+                         (1, [(PatternCategory.SHIRT, 1)]))
+        # Writers only append changes
+        self.assertEqual(StashSummary.query.count(), 0)
+
+        vest.fabrics = [blue]
+        db.session.commit()
+        catalog = summaries.summary_for(summaries.CATALOG)
+        self.assertEqual((catalog.untagged_count, catalog.categories),
+                         (1, [(PatternCategory.SHIRT, 1)]))
+        self.assertEqual(summaries.fold(), 1)
+        self.assertEqual(StashSummary.query.get(summaries.CATALOG)
+                         .count_by_category, {'SHIRT': 1})
+
+        db.session.delete(vest)
+        db.session.commit()
+        catalog = summaries.summary_for(summaries.CATALOG)
+        self.assertEqual((catalog.fabric_count, catalog.untagged_count,
+                          catalog.categories), (2, 2, []))
+        summaries.fold()
+        folded = StashSummary.query.get(summaries.CATALOG)
+        self.assertEqual((folded.untagged_count, folded.count_by_category),
+                         (2, {}))
+
+    def test_fabric_pairs(self):
+        """Test the co-occurrence index behind "often paired with"."""
+        def all_pairs():
+            return {(row.fabric_id, row.other_id): row.count
+                    for row in FabricPair.query}
+
+        create_user()
+        login(self.app, 'timtam', 'password')
+        for name in ('red wool', 'blue silk', 'gray felt', 'tan linen'):
+            self.app.post('/new_fabric', data=dict(
+                name=name, color=name.split()[0], quantity=1,
+                photo_url='https://example.com/%s.jpg' % name.split()[0]))
+        for name, fabrics in (('Vest', ['1', '2', '3']), ('Coat', ['1', '2']),
+                              ('Bag', ['2', '4'])):
+            self.app.post('/new_pattern', data=dict(
+                name=name, category='SHIRT', photo_url='https://example.com/p.jpg',
+                fabrics=fabrics))
+
+        self.assertEqual([(fabric.id, shared) for fabric, shared
+                          in cooccurrence.paired_with_fabric(2)],
+                         [(1, 2), (3, 1), (4, 1)])
+        self.assertEqual([(fabric.id, shared) for fabric, shared
+                          in cooccurrence.paired_with_pattern(2)],
+                         [(3, 2), (4, 1)])
+        # Only the top neighbours of each of the pattern's fabrics are read
+        self.addCleanup(app.config.__setitem__, 'PAIRED_FABRICS_CANDIDATES',
+                        app.config['PAIRED_FABRICS_CANDIDATES'])
+        app.config['PAIRED_FABRICS_CANDIDATES'] = 2
+        self.assertEqual([(fabric.id, shared) for fabric, shared
+                          in cooccurrence.paired_with_pattern(2)], [(3, 2)])
+        self.assertEqual([(fabric.id, shared) for fabric, shared
+                          in cooccurrence.paired_with_pattern(3)],
+                         [(1, 2), (3, 1)])
+        app.config['PAIRED_FABRICS_CANDIDATES'] = 1
+        self.assertEqual(cooccurrence.paired_with_pattern(2), [])
+        response = self.app.get('/fabric/1')
+        self.assertIn(b'Often Paired With', response.data)
+        self.assertIn(b'blue silk</a>\n        (2 patterns)', response.data)
+        self.assertEqual(self.app.get('/fabric/99').status_code, 404)
+
+        # A retag only counts the pairs of the fabrics it adds or removes
+        deltas = cooccurrence._pair_deltas([({1, 2, 3}, {4}, {5})])
+        expected = {}
+        for other_id in (1, 2, 3):
+            expected.update({(4, other_id): 1, (other_id, 4): 1,
+                             (5, other_id): -1, (other_id, 5): -1})
+        self.assertEqual(deltas, expected)
+
+        # Retagging, imports and deletes
+        self.app.post('/pattern/2', data=dict(
+            name='Coat', category='SHIRT', photo_url='https://example.com/p.jpg',
+            fabrics=['1', '4']))
+        self.app.post('/import/patterns', data=json.dumps(dict(
+            name='Tote', category='accessory',
+            photo_url='https://example.com/t.jpg',
+            fabrics=['gray felt', 'tan linen'])),
+            content_type='application/x-ndjson')
+        db.session.delete(Pattern.query.get(1))
+        db.session.commit()
+
+        incremental = all_pairs()
+        self.assertEqual(incremental, {(1, 4): 1, (4, 1): 1, (2, 4): 1,
+                                       (4, 2): 1, (3, 4): 1, (4, 3): 1})
+        cooccurrence.rebuild()
+        db.session.commit()
+        self.assertEqual(all_pairs(), incremental)
+
+    def test_static_assets(self):
+        """Test the fingerprinted, precompressed static files."""
+        static_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_dir)
+        saved = dict(app.config)
+        self.addCleanup(app.config.update, saved)
+        self.addCleanup(assets.reset)
+        app.config['ASSETS_DIR'] = os.path.join(static_dir, 'build')
+        self.assertEqual(self.app.get('/').status_code, 200)
+        self.assertIn(b'href="/static/style.css"', self.app.get('/').data)
+
+        server = PhotoServer({
+            '/css2': ('text/css', b'@font-face { src: url(/m.woff2); }'),
+            '/m.woff2': ('font/woff2', b'wOF2 font'),
+        })
+        self.addCleanup(server.close)
+        self.assertEqual(assets.fetch_fonts(server.url('/css2'), static_dir), 2)
+        with open(os.path.join(static_dir, 'style.css'), 'w') as f:
+            f.write('body { font-family: Manrope; }\n' * 50)
+        built = assets.build(static_dir)
+        self.assertEqual(sorted(built), ['fonts/manrope-1.woff2',
+                                         'fonts/manrope.css', 'style.css'])
+        self.assertEqual(built['style.css']['encodings'], ['gzip'])
+        self.assertEqual(built['fonts/manrope-1.woff2']['encodings'], [])
+        with open(os.path.join(app.config['ASSETS_DIR'],
+                               built['fonts/manrope.css']['path'])) as f:
+            self.assertIn('url(%s)' % built['fonts/manrope-1.woff2']['path']
+                          .split('/')[1], f.read())
+
+        app.config['SELF_HOST_FONTS'] = True
+        page = self.app.get('/').get_data(as_text=True)
+        url = '/assets/' + built['style.css']['path']
+        self.assertIn('href="%s"' % url, page)
+        self.assertIn('/assets/' + built['fonts/manrope.css']['path'], page)
+        self.assertNotIn('fonts.googleapis.com', page)
+
+        response = self.app.get(url, headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(response.data),
+                         b'body { font-family: Manrope; }\n' * 50)
+        response = self.app.get(url)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(len(response.data), 31 * 50)
+        for missing in ('/assets/manifest.json', url + '.gz',
+                        '/assets/../style.css', '/assets/style.css'):
+            self.assertEqual(self.app.get(missing).status_code, 404)
+
+    def test_list_button_fragments(self):
+        """Test the fragment and JSON answers of the list buttons."""
+        create_user()
+        login(self.app, 'timtam', 'password')
+        self.app.post('/new_fabric', data=dict(
+            name='red wool', color='red', quantity=2,
+            photo_url='https://example.com/red.jpg'))
+        self.app.post('/new_pattern', data=dict(
+            name='Vest', category='SHIRT', photo_url='https://example.com/v.jpg',
+            fabrics=['1']))
+        self.assertIn(b'Add to Patterns List', self.app.get('/pattern/1').data)
+
+        response = self.app.post('/add_to_fabrics_list/1',
+                                 headers={'X-Fragment': '1'})
+        html = response.get_data(as_text=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('<html', html)
+        self.assertIn('action="/remove_from_fabrics_list/1"', html)
+        self.assertIn('was added to your fabrics list', html)
+
+        response = self.app.post('/add_to_fabrics_list/1',
+                                 headers={'Accept': 'application/json'})
+        self.assertEqual(response.get_json(), dict(
+            kind='fabrics', id=1, on_list=True, changed=False,
+            message='Fabric "red wool" was added to your fabrics list!'))
+        response = self.app.post('/add_to_patterns_list/1',
+                                 headers={'Accept': 'application/json'})
+        self.assertTrue(response.get_json()['changed'])
+        page = self.app.get('/patterns_list').get_data(as_text=True)
+        self.assertIn('<a href="/pattern/1">Vest</a>', page)
+        self.assertIn('action="/remove_from_patterns_list/1"', page)
+
+        response = self.app.post('/remove_from_patterns_list/1',
+                                 headers={'X-Fragment': '1'})
+        self.assertIn('action="/add_to_patterns_list/1"',
+                      response.get_data(as_text=True))
+        self.assertIn(b'Your patterns list is empty',
+                      self.app.get('/patterns_list').data)
+
+        # Plain form posts still redirect to the list
+        response = self.app.post('/remove_from_fabrics_list/1')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith('/fabrics_list'))
+        self.assertIsNotNone(app.jinja_env.bytecode_cache)
+
+    def test_yardage_ledger(self):
+        """Test the yardage ledger and its cached quantities."""
+        def quantity(fabric_id):
+            return db.session.query(Fabric.quantity).filter_by(
+                id=fabric_id).scalar()
+
+        create_user()
+        login(self.app, 'timtam', 'password')
+        self.app.post('/new_fabric', data=dict(
+            name='red wool', color='red', quantity=5,
+            photo_url='https://example.com/red.jpg'))
+        self.app.post('/new_pattern', data=dict(
+            name='Vest', category='SHIRT', photo_url='https://example.com/v.jpg',
+            fabrics=['1']))
+        self.assertEqual(ledger.balance(1), 5)
+
+        response = self.app.post('/fabric/1/yardage', data=dict(
+            kind='CUT', yards='1.5', pattern='1', note='front panels'))
+        self.assertEqual(response.status_code, 302)
+        # Edited from a page showing the quantity before the cut
+        self.app.post('/fabric/1', data=dict(
+            name='red wool', color='red', quantity=4.5, quantity_seen='5.00',
+            photo_url='https://example.com/red.jpg'))
+        self.app.post('/fabric/1/yardage', data=dict(kind='PURCHASED',
+                                                     yards='2'))
+        self.assertEqual(ledger.balance(1), 5)
+        self.assertEqual(quantity(1), 5)
+        response = self.app.post('/fabric/1/yardage', data=dict(
+            kind='CUT', yards='lots'))
+        self.assertIn(b'Yards are required', response.data)
+        # A cut can't take more than the balance
+        response = self.app.post('/fabric/1/yardage', data=dict(
+            kind='CUT', yards='5.01'))
+        self.assertIn(b'Only 5.00 yards of this fabric are left.',
+                      response.data)
+        self.assertEqual(YardageEntry.query.count(), 4)
+
+        page = self.app.get('/fabric/1').get_data(as_text=True)
+        self.assertIn('<strong>Quantity:</strong> 5.00 yds', page)
+        self.assertIn('Cut for a pattern: -1.50 yds', page)
+        self.assertIn('>Vest</a>', page)
+        self.assertIn('(front panels)', page)
+
+        # Imports and ORM writes go through the ledger too
+        self.app.post('/import/fabrics', data={'file': (io.BytesIO(
+            b'name,color,quantity,photo_url\n'
+            b'gray felt,gray,1.25,https://example.com/gray.jpg\n'),
+            'stash.csv')})
+        fabric = Fabric.query.get(1)
+        fabric.quantity = 6
+        db.session.commit()
+        self.assertEqual(ledger.balances([1, 2]), {1: 6, 2: Decimal('1.25')})
+        self.assertEqual([entry.kind for entry in ledger.history(1)], [
+            YardageKind.ADJUSTED, YardageKind.PURCHASED, YardageKind.ADJUSTED,
+            YardageKind.CUT, YardageKind.ADJUSTED])
+
+        # Snapshots fold the entries without changing the balances
+        self.assertEqual(ledger.take_snapshots(lag=3600), 0)
+        self.assertEqual(ledger.take_snapshots(lag=0), 2)
+        self.assertEqual(ledger.take_snapshots(lag=0), 0)
+        self.app.post('/fabric/1/yardage', data=dict(kind='CUT', yards='0.5'))
+        snapshot = YardageSnapshot.query.get(1)
+        self.assertEqual((snapshot.balance, snapshot.entry_id), (6, 6))
+        self.assertEqual(ledger.balances([1, 2]),
+                         {1: Decimal('5.5'), 2: Decimal('1.25')})
+        self.assertEqual(quantity(1), Decimal('5.5'))
+        self.assertEqual(YardageEntry.query.count(), 7)
+        self.assertEqual(summaries.summary_for(summaries.CATALOG)
+                         .total_yardage, Decimal('6.75'))
+
+        # Balances can grow past what one purchase may add
+        for _ in range(2):
+            self.app.post('/fabric/2/yardage', data=dict(kind='PURCHASED',
+                                                         yards='999.99'))
+        self.assertEqual(quantity(2), Decimal('2001.23'))
+        self.assertEqual(ledger.balance(2), Decimal('2001.23'))
+
+
+class AuthTests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['DEBUG'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['BCRYPT_LOG_ROUNDS'] = 12
+        app.config['BCRYPT_POOL_SIZE'] = 0
+        self.app = app.test_client()
+        user_cache.clear()
+        fragments.reset()
+        admission.reset()
+        db.drop_all()
+        db.create_all()
+
+    def test_login_wrong_password(self):
+        """Test that a wrong password is rejected."""
+        create_user()
+        response = login(self.app, 'timtam', 'wrong')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('Password doesn&#39;t match', response_text)
+        self.assertNotIn('You are logged in', response_text)
+
+    def test_login_unknown_user(self):
+        """Test that an unknown username is rejected."""
+        response = login(self.app, 'nobody', 'password')
+        self.assertIn('No user with that username',
+                      response.get_data(as_text=True))
+
+    def test_login_upgrades_hash_cost(self):
+        """Test that logging in rehashes passwords made with another cost."""
+        create_user()
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        response = login(self.app, 'timtam', 'password')
+        self.assertIn('You are logged in as timtam',
+                      response.get_data(as_text=True))
+
+        user = User.query.filter_by(username='timtam').one()
+        self.assertTrue(user.password.startswith('$2b$04$'))
+        self.assertTrue(check_password(user.password, 'password'))
+
+    def test_hashing_pool(self):
+        """Test hashing and checking passwords in worker processes."""
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config['BCRYPT_POOL_SIZE'] = 1
+        pw_hash = hash_password('password')
+        self.assertTrue(check_password(pw_hash, 'password'))
+        self.assertFalse(check_password(pw_hash, 'wrong'))
+
+        # A hash stuck behind a backed up pool is shed like the others
+        class StuckPool(object):
+            def submit(self, fn, *args):
+                return Future()
+
+        self.addCleanup(setattr, hashing, '_get_pool', hashing._get_pool)
+        self.addCleanup(app.config.__setitem__, 'BCRYPT_TIMEOUT',
+                        app.config['BCRYPT_TIMEOUT'])
+        hashing._get_pool = lambda size: StuckPool()
+        app.config['BCRYPT_TIMEOUT'] = 0.01
+        with self.assertRaises(admission.Overloaded) as raised:
+            check_password(pw_hash, 'password')
+        self.assertEqual(raised.exception.code, 429)
+        self.assertEqual(admission.stats()['timeout'], 1)
+
+    def test_user_cache(self):
+        """Test that logged in users are served from the cache until they change."""
+        create_user()
+        login(self.app, 'timtam', 'password')
+
+        hits = user_cache.stats.hits
+        self.app.get('/')
+        response = self.app.get('/')
+        self.assertIn('You are logged in as timtam',
+                      response.get_data(as_text=True))
+        self.assertEqual(user_cache.stats.hits, hits + 2)
+
+        # Dropped from the cache on commit, not by a flush that rolls back
+        user = User.query.filter_by(username='timtam').one()
+        user.username = 'other'
+        db.session.flush()
+        self.assertIsNotNone(user_cache.get(user.id))
+        db.session.rollback()
+        self.assertIsNotNone(user_cache.get(user.id))
+
+        user = User.query.filter_by(username='timtam').one()
+        user.username = 'timtam2'
+        db.session.flush()
+        self.assertIsNotNone(user_cache.get(user.id))
+        db.session.commit()
+        self.assertIsNone(user_cache.get(user.id))
+        response = self.app.get('/')
+        self.assertIn('You are logged in as timtam2',
+                      response.get_data(as_text=True))
+
+        # Relationships still load from a cached user
+        response = self.app.get('/fabrics_list')
+        self.assertIn('Your fabrics list is empty',
+                      response.get_data(as_text=True))
+
+        text = scrape_metrics(self)
+        self.assertIn('sewing_cache_hits_total{cache="user"} %d'
+                      % user_cache.stats.hits, text)
+
+    def test_shared_cache(self):
+        """Test the shared cache backend against a local stand-in."""
+        client = FakeRedis()
+        cache = SharedCache(client, prefix='user:', ttl=60)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, {'id': 1, 'username': 'timtam'})
+        self.assertIn('user:1', client.data)
+        self.assertEqual(cache.get(1), {'id': 1, 'username': 'timtam'})
+        cache.delete(1)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual((cache.stats.hits, cache.stats.misses), (1, 2))
+
+
+    def test_admission_control(self):
+        """Test that password attempts over budget are turned away."""
+        create_user()
+        saved = dict(app.config)
+        self.addCleanup(app.config.update, saved)
+        app.config.update(ADMISSION_USER_PER_MINUTE=1, ADMISSION_USER_BURST=2,
+                          ADMISSION_IP_PER_MINUTE=1, ADMISSION_IP_BURST=5)
+
+        for _ in range(2):
+            response = self.app.post('/login', data=dict(
+                username='timtam', password='wrong'))
+            self.assertEqual(response.status_code, 200)
+        response = self.app.post('/login', data=dict(
+            username='TimTam', password='password'))
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+        # Other usernames from the same address still get through
+        response = self.app.post('/signup', data=dict(
+            username='tamtim', password='password'))
+        self.assertEqual(response.status_code, 302)
+        response = self.app.post('/login', data=dict(
+            username='tamtim', password='password'))
+        self.assertEqual(response.status_code, 302)
+        response = self.app.post('/login', data=dict(
+            username='someone', password='password'))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(admission.stats()['ip'], 1)
+
+        # A full hashing cap turns requests away before they hash
+        admission.reset()
+        app.config['ADMISSION_MAX_HASHING'] = 1
+        with admission.hashing_slot():
+            response = self.app.post('/login', data=dict(
+                username='timtam', password='password'))
+        self.assertEqual(response.status_code, 429)
+        counts = admission.stats()
+        self.assertEqual((counts['admitted'], counts['hashing']), (1, 1))
+
+        # Buckets refill over time and can live in a shared store
+        client = FakeRedis()
+        self.addCleanup(setattr, admission, 'buckets', admission.buckets)
+        admission.buckets = SharedCache(client, prefix='admission:', ttl=60)
+        self.assertEqual(admission.take('ip:a', 60, 1, now=100), 0)
+        self.assertAlmostEqual(admission.take('ip:a', 60, 1, now=100.5), 0.5)
+        self.assertIn('admission:ip:a', client.data)
+        self.assertEqual(admission.take('ip:a', 60, 1, now=101), 0)
+        self.assertIn('sewing_auth_shed_total{reason="hashing"} 1',
+                      scrape_metrics(self))
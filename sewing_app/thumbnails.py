@@ -0,0 +1,427 @@
+"""Local thumbnails of the fabric and pattern photos.
+
+Photos are hotlinked from third-party hosts, often at several megabytes
+each. Every photo_url gets a Thumbnail row when it is saved, and a pool of
+THUMBNAIL_WORKERS background threads downloads it once, shrinks it to
+THUMBNAIL_SIZE pixels (when Pillow is installed; the photo is kept as is
+otherwise) and stores it under THUMBNAIL_DIR named by its sha256, so
+photos used by several rows are stored once. Templates link to
+/thumbnails/<sha1 of the URL> with the `thumbnail` filter; until the file
+exists that route redirects to the photo itself.
+
+The files are kept under THUMBNAIL_MAX_BYTES by evicting the least recently
+used ones, which are fetched again the next time they are shown.
+
+The URLs come from users, so before connecting, here and in
+photo_checks.py, the host is resolved and refused unless every address it
+resolves to is public: no loopback, private, link-local, reserved or
+multicast addresses, such as the cloud metadata service at
+169.254.169.254, unless PHOTO_ALLOWED_NETWORKS lists them. The connection
+is made to the address that was checked, and every redirect is checked
+the same way.
+"""
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.client import HTTPException
+from threading import Lock
+from urllib.parse import urlsplit
+
+from flask import current_app, url_for
+from sqlalchemy import event, func, inspect, select
+
+from sewing_app.extensions import db
+from sewing_app.models import Fabric, Pattern, Thumbnail, insert_ignore
+
+table = Thumbnail.__table__
+
+# Image types that are stored, and the extension of their files. SVG is
+# left out on purpose: served from our origin it could run scripts.
+EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+}
+
+# used_at is only refreshed this often, so serving stays read-only
+TOUCH_INTERVAL = timedelta(hours=1)
+
+_pool = None
+_pool_pid = None
+_pool_lock = Lock()
+# Keys queued or being fetched by this process
+_pending = set()
+_pending_lock = Lock()
+
+
+class ThumbnailError(Exception):
+    """A photo could not be turned into a thumbnail."""
+
+
+class BlockedAddress(ValueError):
+    """A photo URL points at an address that is not public."""
+
+
+def url_key(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def thumbnail_url(url):
+    """Template filter: the URL of the thumbnail of the photo at `url`."""
+    if not url:
+        return ''
+    return url_for('main.thumbnail', key=url_key(url))
+
+
+def init_app(app):
+    app.add_template_filter(thumbnail_url, 'thumbnail')
+
+
+def _path(digest, content_type):
+    return os.path.join(current_app.config['THUMBNAIL_DIR'], digest[:2],
+                        digest + EXTENSIONS[content_type])
+
+
+def stored_path(thumb):
+    """Return the path of the file of `thumb`, or None if there is none."""
+    if thumb.digest is None:
+        return None
+    path = _path(thumb.digest, thumb.content_type)
+    return path if os.path.exists(path) else None
+
+
+def should_fetch(thumb):
+    """Return whether to fetch `thumb`, whose file is not on disk."""
+    if thumb.digest is not None or thumb.fetched_at is None:
+        return True
+    retry_after = timedelta(seconds=current_app.config['THUMBNAIL_RETRY_AFTER'])
+    return thumb.fetched_at < datetime.utcnow() - retry_after
+
+
+def touch(thumb):
+    """Record that `thumb` was served, at most once per TOUCH_INTERVAL."""
+    now = datetime.utcnow()
+    if thumb.used_at is None or thumb.used_at < now - TOUCH_INTERVAL:
+        Thumbnail.query.filter_by(key=thumb.key).update(
+            {Thumbnail.used_at: now}, synchronize_session=False)
+        db.session.commit()
+
+
+###########################
+# Registering photo URLs
+###########################
+
+def register_urls(urls):
+    """Add a Thumbnail row for every new URL in `urls` and return their keys.
+
+    The new thumbnails are fetched once the transaction commits.
+    """
+    urls = {url_key(url): url for url in urls if url}
+    if not urls:
+        return []
+    existing = {key for key, in db.session.execute(
+        select([table.c.key]).where(table.c.key.in_(list(urls))))}
+    added = []
+    for key, url in urls.items():
+        if key not in existing and insert_ignore(table, key=key, url=url):
+            added.append(key)
+    db.session.info.setdefault('new_thumbnails', set()).update(added)
+    return added
+
+
+def register_all(batch_size=1000):
+    """Add Thumbnail rows for the photos of every fabric and pattern."""
+    added = 0
+    for model in (Fabric, Pattern):
+        urls = db.session.query(model.photo_url).distinct()
+        batch = []
+        for url, in urls.yield_per(batch_size):
+            batch.append(url)
+            if len(batch) >= batch_size:
+                added += len(register_urls(batch))
+                batch = []
+        added += len(register_urls(batch))
+    return added
+
+
+@event.listens_for(db.session, 'before_flush')
+def register_photo_urls(session, flush_context, instances):
+    urls = [obj.photo_url for obj in list(session.new) + list(session.dirty)
+            if isinstance(obj, (Fabric, Pattern)) and obj.photo_url and
+            (obj in session.new or
+             inspect(obj).attrs.photo_url.history.has_changes())]
+    if urls:
+        register_urls(urls)
+
+
+@event.listens_for(db.session, 'after_commit')
+def fetch_new_thumbnails(session):
+    for key in session.info.pop('new_thumbnails', ()):
+        enqueue(key)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_new_thumbnails(session):
+    session.info.pop('new_thumbnails', None)
+
+
+###########################
+# Outbound requests
+###########################
+
+def public_address(host, infos):
+    """Return the address to connect to of the getaddrinfo() results
+    `infos` for `host`, raising BlockedAddress if any of them is not
+    public and not in PHOTO_ALLOWED_NETWORKS."""
+    allowed = [ipaddress.ip_network(network, strict=False)
+               for network in current_app.config['PHOTO_ALLOWED_NETWORKS']]
+    addresses = []
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split('%')[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if (not address.is_global or address.is_multicast) and \
+                not any(address in network for network in allowed):
+            raise BlockedAddress('%s is not a public address' % host)
+        addresses.append(info[4][0])
+    if not addresses:
+        raise BlockedAddress('%s has no address' % host)
+    return addresses[0]
+
+
+def resolve_public(host, port):
+    """Resolve `host` and return its address if it is public; see
+    public_address()."""
+    return public_address(
+        host, socket.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+
+
+def check_url(url):
+    """Raise ThumbnailError or BlockedAddress unless `url` is an http(s)
+    URL of a public host."""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ThumbnailError('Not an http(s) URL')
+    resolve_public(parts.hostname,
+                   parts.port or (443 if parts.scheme == 'https' else 80))
+
+
+def _connect_public(address, timeout, source_address=None):
+    host, port = address
+    return socket.create_connection((resolve_public(host, port), port),
+                                    timeout, source_address)
+
+
+def _public_connection(connection_class):
+    """Wrap `connection_class` so it only connects to the checked address
+    of its host, which a second lookup could not swap for another."""
+    def connection(host, **kwargs):
+        connection = connection_class(host, **kwargs)
+        connection._create_connection = _connect_public
+        return connection
+    return connection
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, request):
+        return self.do_open(
+            _public_connection(http.client.HTTPConnection), request)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, request):
+        return self.do_open(
+            _public_connection(http.client.HTTPSConnection), request,
+            context=self._context)
+
+
+class _PublicRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, request, fp, code, msg, headers, newurl):
+        check_url(newurl)
+        return super(_PublicRedirectHandler, self).redirect_request(
+            request, fp, code, msg, headers, newurl)
+
+
+# No proxies: they would connect to the hosts on our behalf, unchecked
+_opener = urllib.request.build_opener(
+    urllib.request.ProxyHandler({}), _PublicHTTPHandler, _PublicHTTPSHandler,
+    _PublicRedirectHandler)
+
+
+###########################
+# Fetching
+###########################
+
+def _download(url):
+    """Return the bytes and content type of the image at `url`."""
+    check_url(url)
+    request = urllib.request.Request(
+        url, headers={'User-Agent': 'sewing-app-thumbnailer'})
+    max_bytes = current_app.config['THUMBNAIL_MAX_SOURCE_BYTES']
+    with _opener.open(
+            request, timeout=current_app.config['THUMBNAIL_FETCH_TIMEOUT']) as response:
+        content_type = response.headers.get_content_type()
+        if content_type not in EXTENSIONS:
+            raise ThumbnailError('Unsupported content type %s' % content_type)
+        data = response.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise ThumbnailError('Photo larger than %d bytes' % max_bytes)
+    return data, content_type
+
+
+def _resize(data, content_type):
+    """Shrink the image to THUMBNAIL_SIZE, keeping it as is without Pillow."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return data, content_type
+
+    size = current_app.config['THUMBNAIL_SIZE']
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.draft('RGB', (size, size))
+        image.thumbnail((size, size))
+        output = io.BytesIO()
+        if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+            image.save(output, 'PNG', optimize=True)
+            return output.getvalue(), 'image/png'
+        image.convert('RGB').save(output, 'JPEG', quality=85, optimize=True)
+        return output.getvalue(), 'image/jpeg'
+    except (OSError, Image.DecompressionBombError) as error:
+        raise ThumbnailError('Unreadable image: %s' % error)
+
+
+def _store(data, content_type):
+    """Write the thumbnail under its content hash and return the hash."""
+    digest = hashlib.sha256(data).hexdigest()
+    path = _path(digest, content_type)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so nobody serves half a file
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                                         delete=False) as temp:
+            temp.write(data)
+        os.replace(temp.name, path)
+    return digest
+
+
+def fetch(key):
+    """Download the photo of the Thumbnail `key` and store its thumbnail.
+
+    Runs on its own connection, so it is safe in a background thread.
+    Returns the digest of the thumbnail, or None when the photo could not
+    be fetched; the error is recorded on the row.
+    """
+    with db.engine.connect() as connection:
+        url = connection.execute(
+            select([table.c.url]).where(table.c.key == key)).scalar()
+    if url is None:
+        return None
+
+    now = datetime.utcnow()
+    try:
+        data, content_type = _resize(*_download(url))
+        digest = _store(data, content_type)
+    except (OSError, ValueError, HTTPException, ThumbnailError) as error:
+        with db.engine.begin() as connection:
+            connection.execute(table.update().where(table.c.key == key).values(
+                digest=None, size=0, fetched_at=now,
+                error=(str(error) or error.__class__.__name__)[:200]))
+        return None
+
+    with db.engine.begin() as connection:
+        connection.execute(table.update().where(table.c.key == key).values(
+            digest=digest, content_type=content_type, size=len(data),
+            fetched_at=now, used_at=now, error=None))
+    evict()
+    return digest
+
+
+def evict():
+    """Delete the least recently used files until the total size of the
+    thumbnails is under THUMBNAIL_MAX_BYTES. Returns the number deleted."""
+    max_bytes = current_app.config['THUMBNAIL_MAX_BYTES']
+    files = select([table.c.digest, table.c.content_type,
+                    func.max(table.c.size).label('size'),
+                    func.max(table.c.used_at).label('used_at')]).where(
+        table.c.digest.isnot(None)).group_by(
+        table.c.digest, table.c.content_type)
+    with db.engine.begin() as connection:
+        total = connection.execute(
+            select([func.coalesce(func.sum(files.c.size), 0)])).scalar()
+        if total <= max_bytes:
+            return 0
+
+        evicted = 0
+        lru = connection.execute(
+            select([files]).order_by(files.c.used_at)).fetchall()
+        for digest, content_type, size, used_at in lru:
+            if total <= max_bytes:
+                break
+            # Rows sharing the file are fetched again when next shown
+            connection.execute(table.update().where(
+                table.c.digest == digest).values(
+                digest=None, size=0, fetched_at=None))
+            try:
+                os.remove(_path(digest, content_type))
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+    return evicted
+
+
+def fetch_pending(retry=False):
+    """Fetch every thumbnail not fetched yet, and with `retry` the failed
+    ones. Returns the numbers of thumbnails stored and failed."""
+    query = select([table.c.key]).where(table.c.digest.is_(None))
+    if not retry:
+        query = query.where(table.c.fetched_at.is_(None))
+    with db.engine.connect() as connection:
+        keys = [key for key, in connection.execute(query)]
+    stored = sum(1 for key in keys if fetch(key) is not None)
+    return stored, len(keys) - stored
+
+
+def _get_pool(size):
+    global _pool, _pool_pid
+    with _pool_lock:
+        # Threads do not survive a fork, so each worker makes its own pool
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=size)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _fetch_in_background(app, key):
+    try:
+        with app.app_context():
+            fetch(key)
+    except Exception:
+        app.logger.exception('Fetching thumbnail %s failed', key)
+    finally:
+        with _pending_lock:
+            _pending.discard(key)
+
+
+def enqueue(key):
+    """Fetch the thumbnail `key` in the background, unless it is already
+    queued or THUMBNAIL_WORKERS is 0. Returns whether it was queued."""
+    size = current_app.config['THUMBNAIL_WORKERS']
+    if not size:
+        return False
+    with _pending_lock:
+        if key in _pending:
+            return False
+        _pending.add(key)
+    _get_pool(size).submit(_fetch_in_background,
+                           current_app._get_current_object(), key)
+    return True
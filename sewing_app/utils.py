@@ -8,4 +8,45 @@ class FormEnum(enum.Enum):
         return [(choice.name, choice) for choice in cls]
 
     def __str__(self):
-        return str(self.value)
\ No newline at end of file
+        return str(self.value)
+
+
+class KeysetPage(object):
+    """A page of rows fetched with an id cursor instead of an OFFSET."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def keyset_paginate(query, column, after=None, before=None, per_page=20):
+    """Return a KeysetPage of `query` ordered by the unique `column`.
+
+    `after` selects the rows that follow that cursor value and `before` the
+    rows that precede it, so every page costs one indexed range scan no matter
+    how deep into the table it is.
+    """
+    if before is not None:
+        rows = query.filter(column < before).order_by(
+            column.desc()).limit(per_page + 1).all()
+        items = list(reversed(rows[:per_page]))
+        has_prev = len(rows) > per_page
+        has_next = True
+    else:
+        if after is not None:
+            query = query.filter(column > after)
+        rows = query.order_by(column).limit(per_page + 1).all()
+        items = rows[:per_page]
+        has_prev = after is not None
+        has_next = len(rows) > per_page
+
+    next_cursor = getattr(items[-1], column.key) if items and has_next else None
+    prev_cursor = getattr(items[0], column.key) if items and has_prev else None
+    return KeysetPage(items, next_cursor, prev_cursor)